@@ -1,8 +1,14 @@
 import sys
-from PyQt5.QtCore import Qt, pyqtSignal, QTimer
+import threading
+import weakref
+from PyQt5.QtCore import Qt, pyqtSignal, QTimer, QRectF
 from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget, QHBoxLayout
 import pyqtgraph as pg
-from skimage import io, transform, color
+from image_io import write_image
+import image_cache
+from pyramid import ImagePyramid, min_downsample
+from transformations import crop_image
+from timing import span, image_fields
 import numpy as np
 from dataclasses import dataclass
 import logging
@@ -10,14 +16,147 @@ import logging
 pg.setConfigOption('background', 'k')
 pg.setConfigOption('foreground', 'w')
 
+def display_view(image):
+    # pyqtgraph shows gray, RGB and RGBA images, anything else is shown by its
+    # first channel (a view, not a copy)
+    if image.ndim == 3 and image.shape[2] not in (3, 4):
+        return image[:, :, 0]
+    return image
+
+def display_levels(image, max_size=1024):
+    # Display range of image, from a strided sample of it. Images keep their
+    # own dtype and values, contrast is only ever set through the item levels
+    step = max(1, int(np.ceil(max(image.shape[:2]) / max_size)))
+    sample = image[::step, ::step]
+    if image.ndim == 3 and image.shape[2] == 4:
+        # Not the alpha channel
+        sample = sample[:, :, :3]
+    lo, hi = float(np.min(sample)), float(np.max(sample))
+    return (lo, hi if hi > lo else lo + 1)
+
+# (weak reference to an image, {key: its zero mask, or the mask's pyramid})
+# of the last few overlaid images, which are overlaid again on every align
+_masks = []
+MASK_CACHE = 2
+
+def _cached_mask(image, key, compute):
+    # Masks of images that are gone are dropped
+    _masks[:] = [(ref, masks) for ref, masks in _masks if ref() is not None]
+    for ref, masks in _masks:
+        if ref() is image:
+            break
+    else:
+        masks = {}
+        _masks.insert(0, (weakref.ref(image), masks))
+        del _masks[MASK_CACHE:]
+    if key not in masks:
+        masks[key] = compute()
+    return masks[key]
+
+def zero_mask(image):
+    # uint8 image that is 0 where every color channel of image is and 1
+    # elsewhere (the alpha channel of an opaque image would hide every zero)
+    if image.ndim < 3:
+        return (image != 0).view(np.uint8)
+    mask = image[:, :, 0] != 0
+    for c in range(1, 3 if image.shape[2] == 4 else image.shape[2]):
+        mask |= image[:, :, c] != 0
+    return mask.view(np.uint8)
+
+def overlay_mask(image, size=None):
+    # zero_mask of image, cached, shrunk to size (w, h) with min_downsample so
+    # thin lines aren't averaged away
+    if size is None or tuple(size) == image.shape[1::-1]:
+        return _cached_mask(image, 'mask', lambda: zero_mask(image))
+    return _cached_mask(image, tuple(size), lambda: min_downsample(overlay_mask(image), size))
+
+def mask_pyramid(image):
+    # Pyramid of overlay_mask(image), built once in the background. Its
+    # levels take the minimum of the pixels they cover, averaging would wash
+    # thin lines out of every level but the first
+    def build():
+        pyramid = ImagePyramid(overlay_mask(image), reduce=min_downsample)
+        threading.Thread(target=pyramid.build, daemon=True).start()
+        return pyramid
+    return _cached_mask(image, 'pyramid', build)
+
+class PyramidImageItem(pg.ImageItem):
+    # Shows only the tiles of the pyramid level that fits the current view,
+    # positioned in full resolution coordinates
+    def __init__(self, pyramid, tile_size=512, levels=None, **kargs):
+        super(PyramidImageItem, self).__init__(**kargs)
+        self.setOpts(axisOrder='row-major')
+        self.pyramid = pyramid
+        self.tile_size = tile_size
+        self.tiles = None
+        preview = pyramid.preview
+        if levels is None:
+            levels = display_levels(preview)
+        self.setLevels(levels)
+        self.showTiles(preview, 0, 0, *pyramid.scale(preview))
+
+    def showTiles(self, image, x0, y0, sx, sy):
+        # x0, y0 is the position of image in its level, sx, sy the level scale
+        self.setImage(image, autoLevels=False)
+        self.setRect(QRectF(x0 * sx, y0 * sy, image.shape[1] * sx, image.shape[0] * sy))
+
+    def updateView(self, rect, pixel_size):
+        levels = self.pyramid.levels
+        level = self.pyramid.level_for(pixel_size)
+        if level >= len(levels):
+            if not self.pyramid.done:
+                if self.tiles != 'preview':
+                    self.tiles = 'preview'
+                    preview = self.pyramid.preview
+                    self.showTiles(preview, 0, 0, *self.pyramid.scale(preview))
+                return
+            level = len(levels) - 1
+
+        image = levels[level]
+        sx, sy = self.pyramid.scale(image)
+        t = self.tile_size
+        x0 = max(int(rect.left() / sx) // t * t, 0)
+        y0 = max(int(rect.top() / sy) // t * t, 0)
+        x1 = min(int(np.ceil(rect.right() / sx / t)) * t, image.shape[1])
+        y1 = min(int(np.ceil(rect.bottom() / sy / t)) * t, image.shape[0])
+        if x1 <= x0 or y1 <= y0:
+            return
+
+        tiles = (level, x0, y0, x1, y1)
+        if tiles == self.tiles:
+            return
+        self.tiles = tiles
+        self.showTiles(image[y0:y1, x0:x1], x0, y0, sx, sy)
+
 class ImagePlot(pg.GraphicsLayoutWidget):
     sigKeyPress = pyqtSignal(object)
-    color_dict = { 'r':(255,0,0), 'g':(0,255,0), 'b':(0,0,255),
-                   'p':(255,0,255), 'y':(255,255,0) }
+    sigPyramidReady = pyqtSignal()
+    sigPointsChanged = pyqtSignal()
+    sigPointSelected = pyqtSignal(int)
+    # Point colors, cycled through when there are more points than colors
+    colors = [(255,0,0), (0,255,0), (0,0,255), (255,0,255), (255,255,0),
+              (0,255,255), (255,128,0), (128,0,255)]
+    # Spot sizes in screen pixels, the selected point is drawn bigger
+    point_size = 10
+    selected_size = 18
+    # Clicks within this many screen pixels of a point select it
+    pick_radius = 10
+    # Images with more pixels than this are displayed from a pyramid
+    tiled_pixels = 4096 * 4096
+    # Overlay colors, zero pixels of the overlaid image are drawn red and
+    # everything else is transparent
+    overlay_lut = np.zeros((256, 4), dtype=np.uint8)
+    overlay_lut[0] = (255, 0, 0, 255)
 
-    def __init__(self, use_roi=False, select_pts=True):
+    def __init__(self, use_roi=False, select_pts=True, tiled=None):
+        # tiled: None picks the pyramid display for images over tiled_pixels
         self.pti = 0
         self.image = np.array([])
+        self.tiled = tiled
+        self.pyramids = []
+        self.image_item = None
+        self.overlay_item = None
+        self.overlay_opacity = 1.0
 
         super(ImagePlot, self).__init__()
 
@@ -26,16 +165,23 @@ class ImagePlot(pg.GraphicsLayoutWidget):
         self.p1.vb.invertY(True) # Images need inverted Y axis
         self.p1.showAxes(False)
 
-        # Use ScatterPlotItem to draw points
+        # Use ScatterPlotItem to draw points, with one spot per row of
+        # self.points (hidden while unset)
         self.scatterItem = pg.ScatterPlotItem(
-            size=10, 
+            size=self.point_size,
             pen=pg.mkPen(None), 
             brush=pg.mkBrush(255, 0, 0),
+            symbol='+',
             hoverable=True,
             hoverBrush=pg.mkBrush(0, 255, 255)
         )
         self.scatterItem.setZValue(2) # Ensure scatterPlotItem is always at top
-        self.points = np.zeros((5,2))
+        self.brushes = [pg.mkBrush(c) for c in self.colors]
+        # (n, 2) x, y of every point, NaN for unset points
+        self.points = np.full((0, 2), np.nan)
+        # KD-tree of the set points for picking, rebuilt when next needed
+        # after the points change
+        self.point_tree = None
 
         self.p1.addItem(self.scatterItem)
 
@@ -47,62 +193,156 @@ class ImagePlot(pg.GraphicsLayoutWidget):
             self.roi.setZValue(20)
             self.p1.addItem(self.roi)
 
+        self.p1.vb.sigRangeChanged.connect(self.updateTiles)
+        self.sigPyramidReady.connect(self.updateTiles)
+
+        self.flicker_timer = QTimer()
+        self.flicker_timer.timeout.connect(self.flicker)
+
+        self.scene().sigMouseClicked.connect(self.mouseClicked)
+
+    def useTiles(self, image):
+        if self.tiled is None:
+            return image.shape[0] * image.shape[1] > self.tiled_pixels
+        return self.tiled
+
+    def makeImageItem(self, image, levels=None):
+        image = display_view(image)
+        if self.useTiles(image):
+            pyramid = ImagePyramid(image)
+            self.pyramids.append(pyramid)
+            item = PyramidImageItem(pyramid, levels=levels)
+            threading.Thread(target=pyramid.build, daemon=True,
+                    kwargs={'callback': lambda level: self.sigPyramidReady.emit()}).start()
+        else:
+            item = pg.ImageItem(image, levels=levels or display_levels(image))
+            item.setOpts(axisOrder='row-major')
+        return item
+
+    def makeMaskItem(self, image):
+        # Overlay layer of image, from its cached mask (or mask pyramid)
+        if self.useTiles(image):
+            return PyramidImageItem(mask_pyramid(image), levels=(0, 1))
+        item = pg.ImageItem(overlay_mask(image), levels=(0, 1))
+        item.setOpts(axisOrder='row-major')
+        return item
+
+    def clearItems(self):
+        self.p1.clear()
+        self.p1.addItem(self.scatterItem)
+        if self.use_roi:
+            self.p1.addItem(self.roi)
+        for pyramid in self.pyramids:
+            pyramid.cancelled = True
+        self.pyramids = []
+        self.image_item = None
+        self.overlay_item = None
+
+    def pixelSize(self):
+        # Image pixels per screen pixel
+        rect = self.p1.vb.viewRect()
+        return max(rect.width() / max(self.p1.vb.width(), 1),
+                   rect.height() / max(self.p1.vb.height(), 1))
+
+    def updateTiles(self, *args):
+        rect = self.p1.vb.viewRect()
+        pixel_size = self.pixelSize()
+        for item in (self.image_item, self.overlay_item):
+            if isinstance(item, PyramidImageItem):
+                item.updateView(rect, pixel_size)
+
+    def home(self):
+        if isinstance(self.image_item, PyramidImageItem):
+            self.p1.vb.setRange(QRectF(0, 0, self.image.shape[1], self.image.shape[0]))
+        else:
+            self.p1.autoRange()
+
     def setImage(self, image, size=None, disp=True):
         # pg.ImageItem.__init__ method takes input as an image array
         if image is None:
             return
 
         if isinstance(image, str):
-            img = io.imread(image)
-            if len(img.shape) > 2:
-                try:
-                    img = color.rgb2gray(img)
-                except ValueError:
-                    img = img[:,:,0]
-
-            if img.dtype != np.uint8:
-                img = np.uint8(255/np.max(img) * img)
-            image = img
+            image = image_cache.read(image)
 
         if size is not None:
-            image = transform.resize(image, size)
+            from skimage import transform
+            image = transform.resize(image, size, preserve_range=True).astype(image.dtype)
 
         self.image = image
 
         if disp:
-            self.p1.clear()
-            self.p1.addItem(self.scatterItem)
-            if self.use_roi:
-                self.p1.addItem(self.roi)
-            self.image_item = pg.ImageItem(image)
-            self.image_item.setOpts(axisOrder='row-major')
-            self.p1.getViewBox().setAspectLocked(True, ratio=(image.shape[1]/image.shape[0]))
-            self.p1.addItem(self.image_item)
+            with span('display', **image_fields(image)):
+                self.clearItems()
+                self.image_item = self.makeImageItem(image)
+                self.p1.getViewBox().setAspectLocked(True, ratio=(image.shape[1]/image.shape[0]))
+                self.p1.addItem(self.image_item)
+                if self.pyramids:
+                    self.home()
 
     def overlayImage(self, image):
-        # TODO: Add other color/opacity support
-        self.p1.clear()
-        self.p1.addItem(self.scatterItem)
-        if self.use_roi:
-            self.p1.addItem(self.roi)
+        # Draws the zero pixels of image in red over this image. This is a
+        # separate layer colored by a lookup table, so opacity and flicker
+        # changes don't touch the image data, and the mask of image is only
+        # made the first time it's overlaid
+        with span('overlay', **image_fields(self.image)):
+            self.clearItems()
+            self.showLayers(self.makeImageItem(self.image), self.makeMaskItem(image),
+                            self.image.shape)
+            self.updateTiles()
+
+    def setPreview(self, image, overlay):
+        # Same as overlayImage, for a downsampled image. It's stretched over
+        # the full resolution overlay, so the roi and crop stay in full
+        # resolution coordinates. The overlay is the mask of the full
+        # resolution image, shrunk to the size of image. self.image is left
+        # alone
+        self.clearItems()
+        shape = overlay.shape
+        rect = QRectF(0, 0, shape[1], shape[0])
+        image = display_view(image)
+        image_item = pg.ImageItem(image, levels=display_levels(image))
+        overlay_item = pg.ImageItem(overlay_mask(overlay, image.shape[1::-1]), levels=(0, 1))
+        for item in (image_item, overlay_item):
+            item.setOpts(axisOrder='row-major')
+            item.setRect(rect)
+        self.showLayers(image_item, overlay_item, shape)
 
-        fuse = np.zeros((self.image.shape[0], self.image.shape[1], 3))
-        fuse[:,:,:] = np.dstack((self.image,self.image,self.image))
-        fuse[image == 0, 0] = 255
-        fuse[image == 0, 1] = 0
-        fuse[image == 0, 2] = 0
+    def showLayers(self, image_item, overlay_item, shape):
+        self.image_item = image_item
+        self.overlay_item = overlay_item
+        self.overlay_item.setLookupTable(self.overlay_lut)
+        self.overlay_item.setOpacity(self.overlay_opacity)
+        self.overlay_item.setZValue(1)
 
-        self.image_item = pg.ImageItem(fuse)
-        self.image_item.setOpts(axisOrder='row-major')
-        self.p1.getViewBox().setAspectLocked(True, ratio=(fuse.shape[1]/fuse.shape[0]))
+        self.p1.getViewBox().setAspectLocked(True, ratio=(shape[1]/shape[0]))
         self.p1.addItem(self.image_item)
+        self.p1.addItem(self.overlay_item)
+
+    def setOverlayOpacity(self, opacity):
+        self.overlay_opacity = opacity
+        if self.overlay_item is not None:
+            self.overlay_item.setOpacity(opacity)
+
+    def setFlicker(self, enabled, interval=500):
+        # Alternates between showing and hiding the overlay every interval ms
+        if enabled:
+            self.flicker_timer.start(interval)
+        else:
+            self.flicker_timer.stop()
+            if self.overlay_item is not None:
+                self.overlay_item.setVisible(True)
+
+    def flicker(self):
+        if self.overlay_item is not None:
+            self.overlay_item.setVisible(not self.overlay_item.isVisible())
 
     def keyPressEvent(self, event):
         if event.key() in (Qt.Key_Backspace, Qt.Key_Delete):
-            self.points[self.pti, :] = [0, 0]
-            self.setPoints()
+            if self.pti < len(self.points):
+                self.setPoint(self.pti, None)
         if event.key() == Qt.Key_H:
-            self.p1.autoRange()
+            self.home()
         self.sigKeyPress.emit(event)
 
     def mouseDoubleClickEvent(self, event):
@@ -111,63 +351,103 @@ class ImagePlot(pg.GraphicsLayoutWidget):
         point = self.p1.vb.mapSceneToView(event.pos()) # get the point clicked
         # Get pixel position of the mouse click
         x, y = int(point.x()), int(point.y())
-        self.points[self.pti, :] = [x, y]
-        self.setPoints()
+        self.setPoint(self.pti, (x, y))
         super().mouseDoubleClickEvent(event)
 
+    def mouseClicked(self, event):
+        # A single click on (or near) a point selects it
+        if not self.select_pts or event.double() or event.button() != Qt.LeftButton:
+            return
+        point = self.p1.vb.mapSceneToView(event.scenePos())
+        pti = self.nearestPoint((point.x(), point.y()), self.pick_radius * self.pixelSize())
+        if pti is not None:
+            self.selectPoint(pti)
+            self.sigPointSelected.emit(pti)
+
+    def nearestPoint(self, pos, radius=np.inf):
+        # Index of the set point nearest to pos, if it's within radius
+        if self.point_tree is None:
+            from scipy.spatial import cKDTree
+            index = np.flatnonzero(~np.isnan(self.points).any(axis=1))
+            self.point_tree = (cKDTree(self.points[index]), index)
+        tree, index = self.point_tree
+        if len(index) == 0:
+            return None
+        distance, i = tree.query(pos, distance_upper_bound=radius)
+        return int(index[i]) if np.isfinite(distance) else None
+
+    def selectPoint(self, pti):
+        old, self.pti = self.pti, pti
+        data = self.scatterItem.data
+        for i, size in ((old, self.point_size), (pti, self.selected_size)):
+            if i < len(data):
+                data['size'][i] = size
+                data['sourceRect'][i] = (0, 0, 0, 0)
+        self.scatterItem.updateSpots()
+        self.scatterItem.invalidate()
+
     def setPoints(self):
-        spots = []
-        ind = 0
-        for point in self.points:
-            if point.all() != 0:
-                spot = {'pos':point, 'brush':self.color_dict[['r','g','b','p','y'][ind]], \
-                        'symbol':'+'}
-                spots.append(spot)
-            ind += 1
-        self.scatterItem.setData(spots=spots)
+        # Redraws every point, for when self.points was replaced as a whole
+        self.points = np.array(self.points, dtype=np.float64).reshape(-1, 2)
+        n = len(self.points)
+        self.scatterItem.setData(x=self.points[:, 0], y=self.points[:, 1],
+                                 brush=[self.brushes[i % len(self.brushes)] for i in range(n)])
+        self.scatterItem.data['visible'] = ~np.isnan(self.points).any(axis=1)
+        self.point_tree = None
+        self.selectPoint(self.pti)
+        self.sigPointsChanged.emit()
+
+    def setPoint(self, pti, pos):
+        # Sets (or clears, with pos None) a single point. Only its spot is
+        # changed, so this stays quick with many points
+        if pti >= len(self.points):
+            self.growPoints(pti + 1)
+        self.points[pti] = np.nan if pos is None else pos
+        data = self.scatterItem.data
+        data['x'][pti], data['y'][pti] = self.points[pti]
+        data['visible'][pti] = pos is not None
+        self.scatterItem.prepareGeometryChange()
+        self.scatterItem.bounds = [None, None]
+        self.scatterItem.informViewBoundsChanged()
+        self.scatterItem.invalidate()
+        self.point_tree = None
+        self.sigPointsChanged.emit()
+
+    def growPoints(self, n):
+        # Adds unset points (and hidden spots), doubling the room each time
+        old = len(self.points)
+        new = max(n, 2 * old, len(self.colors))
+        self.points = np.vstack([self.points, np.full((new - old, 2), np.nan)])
+        self.scatterItem.addPoints(x=self.points[old:, 0], y=self.points[old:, 1],
+                                   brush=[self.brushes[i % len(self.brushes)] for i in range(old, new)])
+        self.scatterItem.data['visible'][old:] = False
+        if old <= self.pti < new:
+            self.selectPoint(self.pti)
+
+    def clearPoints(self):
+        self.points = np.full((0, 2), np.nan)
+        self.setPoints()
 
     def getCrop(self):
         pos = np.array([self.roi.pos().x(), self.roi.pos().y()])
         dimensions = np.array([self.roi.size().x(), self.roi.size().y()])
         return [pos, dimensions]
 
-    # TODO:
-    # Figure out a better way to do all of this cropping, obviously this is pretty suboptimal
     # NOTE:
-    # You definitely could use something other than qt as your export plugin, 
-    # I found that the default was some 14x slower
+    # Files are written by image_io.write_image, which picks the fastest
+    # encoder for the format (the default skimage plugin was some 14x slower)
     def saveImage(self, fname, c_pos=None, c_size=None):
-        if c_pos is None or c_size is None:
-            io.imsave(fname, self.image, plugin='qt')
-            return
-
         if fname is None:
             logging.error('Image name not defined, cannot save')
             return 0
-        if any(c_pos < 0):
-            logging.info(f'Oversized crop (and negative roi), adding black border to {fname}')
-            x = -int(c_pos[0]) if c_pos[0] < 0 else 0
-            y = -int(c_pos[1]) if c_pos[1] < 0 else 0
-            matt = np.zeros((int(c_size[1]), int(c_size[0])), dtype=np.uint8)
-            off_x = int(c_pos[0]) if c_pos[0] > 0 else 0
-            off_y = int(c_pos[1]) if c_pos[1] > 0 else 0
-
-            matt[y:, x:] = self.image[off_y:int(c_size[1]) - y + off_y,off_x:int(c_size[0]) - x + off_x]
-            # see note
-            io.imsave(fname, matt, plugin='qt')
-        else:
-            if int(c_pos[1] + c_size[0]) > self.image.shape[0] or int(c_pos[0] + c_size[1]) > self.image.shape[1]:
-                logging.info(f'Oversized crop, adding black border to {fname}')
-                matt = np.zeros((int(c_pos[1] + c_size[0]), int(c_pos[0] + c_size[1])), dtype=np.uint8)
-                matt[:self.image.shape[0], :self.image.shape[1]] = self.image[:matt.shape[0], :matt.shape[1]]
-                # see note
-                io.imsave(fname, \
-                        matt[int(c_pos[1]):int(c_pos[1]+c_size[0]), \
-                        int(c_pos[0]):int(c_pos[0]+c_size[1])], plugin='qt')
-            else:
-                io.imsave(fname, \
-                        self.image[int(c_pos[1]):int(c_pos[1]+c_size[0]), \
-                        int(c_pos[0]):int(c_pos[0]+c_size[1])], plugin='qt')
+        if c_pos is None or c_size is None:
+            write_image(fname, self.image)
+            return
+
+        if (any(c_pos < 0) or c_pos[1] + c_size[1] > self.image.shape[0]
+                           or c_pos[0] + c_size[0] > self.image.shape[1]):
+            logging.info(f'Oversized crop, adding black border to {fname}')
+        write_image(fname, crop_image(self.image, c_pos, c_size))
             
 
 if __name__ == "__main__":
@@ -2,18 +2,33 @@
 
 from PyQt5.QtCore import Qt, pyqtSignal, QTimer
 from PyQt5.QtGui import QKeySequence
-from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget, QHBoxLayout, QGridLayout, QFileDialog, QAction, QLineEdit, QLabel, QFormLayout
+from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget, QHBoxLayout, QGridLayout, QFileDialog, QAction, QLineEdit, QLabel, QFormLayout, QSlider, QActionGroup, QProgressBar, QPushButton, QMessageBox, QInputDialog
 from ImagePlot import ImagePlot
+from workers import IOPool, Cancelled
+import image_io
+import image_cache
+import timing
+from timing import span
+from image_io import read_image, write_image
 from transformations import *
+from pyramid import downsample
+from autoseed import auto_seed
+import nonrigid
+from nonrigid import remap_maps, remap
+from points import read_csv, write_csv
+from sequence import ImageSequence
+from project import Project, pair_points
+from server import Client, job_spec, DEFAULT_ADDRESS
+import metrics
 import pyqtgraph as pg
-from skimage import io
 import numpy as np
-import csv
+import os
 import sys
+import tempfile
 import time
 import logging
 from dataclasses import dataclass
-from functools import partialmethod
+from functools import partial, partialmethod
 from pathlib import Path
 
 logging.basicConfig(filename='align.log', filemode='w', level=logging.DEBUG)
@@ -27,52 +42,23 @@ class FilePaths:
     RAW_PATH_SAVE: str = None
     PTS_CSV_READ: str = None
     PTS_CSV_SAVE: str = None
+    PROJECT_PATH: str = None
 
 # Set default values here
 paths = FilePaths()
 
-def read_csv(csv_fname):
-    logging.info(f'Loading points from {csv_fname}')
-    c_pos = np.zeros(2)
-    c_size = np.zeros(2)
-    pts = np.zeros((2, 5, 2))
-    with open(csv_fname, mode='r') as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=',')
-        line_count = 0
-        for row in csv_reader:
-            if line_count == 0:
-                c_pos[0] = row[0]
-                c_pos[1] = row[1]
-                c_size[0] = float(row[2])
-                c_size[1] = float(row[3])
-            else:
-                pts[0, line_count - 1, 0] = row[0]
-                pts[0, line_count - 1, 1] = row[1]
-                pts[1, line_count - 1, 0] = row[2]
-                pts[1, line_count - 1, 1] = row[3]
-            line_count += 1
-    return [pts, c_pos, c_size]
-
-def save_csv(csv_fname):
-    if csv_fname is None:
-        logging.error('CSV Points save path not defined')
-        return 0
-
-    logging.info(f'Saving points to {csv_fname}')
-    pts = np.zeros((2, 5, 2))
-    for i in range(2):
-        pts[i,:,:] = image_plot[i].points
-        image_plot[i].setPoints()
-    [c_pos, c_size] = image_plot[2].getCrop()
-
-    with open(csv_fname, mode='w') as csv_file:
-        csv_writer = csv.writer(csv_file, delimiter=',')
-        csv_writer.writerow([c_pos[0], c_pos[1], c_size[0], c_size[1]])
-        for pt in range(5):
-            csv_writer.writerow([pts[0, pt, 0], pts[0, pt, 1], pts[1, pt, 0], pts[1, pt, 1]])
+def same_points(a, b):
+    # Whether two (ref_pts, trans_pts) are the same points
+    return b is not None and all(np.array_equal(x, y) for x, y in zip(a, b))
 
 class Window(QMainWindow):
     sigKeyPress = pyqtSignal(object)
+    # Longest side of the live preview images, and how long (ms) points have
+    # to stay still before it is updated
+    preview_size = 1024
+    preview_delay = 30
+    # Priority of jobs sent to the alignment server, ahead of batch scripts
+    server_priority = 10
     def __init__(self):
         super(Window, self).__init__()
         self.setWindowTitle("Manual Align")
@@ -87,14 +73,59 @@ class Window(QMainWindow):
 
         # Setting up the image plots
         self.image_plot = []
+        # Matrix taking the raw image onto the reference, set by align (and
+        # the live preview), and the one image_plot[2].image was warped with
+        self.transform = None
+        self.aligned_transform = None
+        # The points transform was solved from, which the non-rigid models
+        # warp with directly, and the model image_plot[2].image was warped with
+        self.transform_points = None
+        self.warp_model = 'affine'
+        self.aligned_model = None
+        # metrics.Metrics of the last align, and the points it was solved from
+        self.metrics = None
+        self.metrics_points = None
+        # server.Client of the alignment server align and save run on, if set
+        self.server = None
+        self.server_address = DEFAULT_ADDRESS
+        # Downsampled copies of the reference and raw image for the preview
+        self.proxies = {}
+        self.preview_timer = QTimer()
+        self.preview_timer.setSingleShot(True)
+        self.preview_timer.setInterval(self.preview_delay)
+        self.preview_timer.timeout.connect(self.preview)
+
+        # Set by openSequence (and openProject)
+        self.sequence = None
+        self.project = None
+
+        # Every file read and write runs on this pool
+        self.io = IOPool()
+        self.io.sigBusy.connect(self.ioBusy)
+        self.io.sigProgress.connect(self.ioProgress)
+        self.io.sigIdle.connect(self.ioIdle)
+        self.io.sigError.connect(lambda message: self.statusBar().showMessage(message, 10000))
+        self.metricsLabel = QLabel()
+        self.statusBar().addPermanentWidget(self.metricsLabel)
+        self.progressBar = QProgressBar()
+        self.progressBar.setMaximumWidth(200)
+        self.cancelButton = QPushButton("Cancel")
+        self.cancelButton.clicked.connect(self.io.cancelAll)
+        self.statusBar().addPermanentWidget(self.progressBar)
+        self.statusBar().addPermanentWidget(self.cancelButton)
+        self.ioIdle()
 
         plot = ImagePlot()
         plot.sigKeyPress.connect(self.keyPress)
+        plot.sigPointsChanged.connect(self.schedulePreview)
+        plot.sigPointSelected.connect(self.selectPoint)
         self.layout.addWidget(plot, 0, 0, 2, 1)
         self.image_plot.append(plot)
 
         plot = ImagePlot()
         plot.sigKeyPress.connect(self.keyPress)
+        plot.sigPointsChanged.connect(self.schedulePreview)
+        plot.sigPointSelected.connect(self.selectPoint)
         self.layout.addWidget(plot, 2, 0, 2, 1)
         self.image_plot.append(plot)
 
@@ -119,11 +150,34 @@ class Window(QMainWindow):
         openReferenceAction.triggered.connect(self.openReference)
         fileMenu.addAction(openReferenceAction)
 
+        openSequenceAction = QAction("Open Image &Sequence...", self)
+        openSequenceAction.triggered.connect(self.openSequence)
+        fileMenu.addAction(openSequenceAction)
+
+        nextImageAction = QAction("&Next Image", self)
+        nextImageAction.setShortcut(QKeySequence(Qt.Key_PageDown))
+        nextImageAction.triggered.connect(partial(self.stepSequence, 1))
+        fileMenu.addAction(nextImageAction)
+
+        previousImageAction = QAction("&Previous Image", self)
+        previousImageAction.setShortcut(QKeySequence(Qt.Key_PageUp))
+        previousImageAction.triggered.connect(partial(self.stepSequence, -1))
+        fileMenu.addAction(previousImageAction)
+
         openPointsAction = QAction("&Open Points CSV", self)
         openPointsAction.triggered.connect(self.openPoints)
         openPointsAction.setShortcut(QKeySequence(Qt.CTRL + Qt.Key_L))
         fileMenu.addAction(openPointsAction)
 
+        openProjectAction = QAction("Open P&roject...", self)
+        openProjectAction.triggered.connect(self.openProject)
+        fileMenu.addAction(openProjectAction)
+
+        saveProjectAction = QAction("Save Pair to Pro&ject...", self)
+        saveProjectAction.setShortcut(QKeySequence(Qt.CTRL + Qt.Key_J))
+        saveProjectAction.triggered.connect(self.saveProject)
+        fileMenu.addAction(saveProjectAction)
+
         saveFullAction = QAction("&Save Aligned Image...", self)
         saveFullAction.setShortcut(QKeySequence(Qt.CTRL + Qt.Key_S))
         saveFullAction.triggered.connect(self.saveFullImage)
@@ -143,11 +197,58 @@ class Window(QMainWindow):
         savePointsAction.triggered.connect(self.savePoints)
         fileMenu.addAction(savePointsAction)
 
+        encoderMenu = fileMenu.addMenu("Image &Encoder")
+        encoderGroup = QActionGroup(self)
+        for name, label in [('auto', "&Auto (fastest)"), ('tifffile', "&tifffile"),
+                            ('cv2', "&OpenCV"), ('pillow', "&Pillow"), ('qt', "&Qt")]:
+            encoderAction = QAction(label, self, checkable=True)
+            encoderAction.setChecked(name == image_io.encoder)
+            encoderAction.triggered.connect(partial(self.setEncoder, name))
+            encoderGroup.addAction(encoderAction)
+            encoderMenu.addAction(encoderAction)
+
+        diskCacheAction = QAction("Disk &Cache", self, checkable=True)
+        diskCacheAction.setChecked(image_cache.enabled)
+        diskCacheAction.triggered.connect(self.setDiskCache)
+        fileMenu.addAction(diskCacheAction)
+
+        clearCacheAction = QAction("C&lear Disk Cache", self)
+        clearCacheAction.triggered.connect(self.clearDiskCache)
+        fileMenu.addAction(clearCacheAction)
+
         alignAction = QAction("&Align", self)
         alignAction.setShortcut(QKeySequence(Qt.CTRL + Qt.Key_A))
         alignAction.triggered.connect(self.align)
         editMenu.addAction(alignAction)
 
+        modelMenu = editMenu.addMenu("&Warp Model")
+        modelGroup = QActionGroup(self)
+        for name, label in [('affine', "&Affine"), ('tps', "&Thin-Plate Spline"),
+                            ('piecewise', "&Piecewise Affine")]:
+            modelAction = QAction(label, self, checkable=True)
+            modelAction.setChecked(name == self.warp_model)
+            modelAction.triggered.connect(partial(self.setWarpModel, name))
+            modelGroup.addAction(modelAction)
+            modelMenu.addAction(modelAction)
+
+        self.livePreviewAction = QAction("&Live Preview", self, checkable=True)
+        self.livePreviewAction.setShortcut(QKeySequence(Qt.CTRL + Qt.SHIFT + Qt.Key_A))
+        self.livePreviewAction.triggered.connect(self.schedulePreview)
+        editMenu.addAction(self.livePreviewAction)
+
+        autoSeedAction = QAction("Auto-&Seed Points", self)
+        autoSeedAction.setShortcut(QKeySequence(Qt.CTRL + Qt.Key_E))
+        autoSeedAction.triggered.connect(self.autoSeed)
+        editMenu.addAction(autoSeedAction)
+
+        self.useServerAction = QAction("Use Alignment Se&rver", self, checkable=True)
+        self.useServerAction.triggered.connect(self.setUseServer)
+        editMenu.addAction(self.useServerAction)
+
+        serverAddressAction = QAction("Alignment Server &Address...", self)
+        serverAddressAction.triggered.connect(self.setServerAddress)
+        editMenu.addAction(serverAddressAction)
+
         clearPointsAction = QAction("&Clear Points", self)
         clearPointsAction.setShortcut(QKeySequence(Qt.CTRL + Qt.Key_X))
         clearPointsAction.triggered.connect(self.clearPoints)
@@ -163,12 +264,37 @@ class Window(QMainWindow):
         self.autoSavePointsAction.setChecked(True)
         editMenu.addAction(self.autoSavePointsAction)
 
+        timingAction = QAction("&Timing Report...", self)
+        timingAction.triggered.connect(self.showTiming)
+        editMenu.addAction(timingAction)
+
+        flickerAction = QAction("&Flicker Overlay", self, checkable=True)
+        flickerAction.setShortcut(QKeySequence(Qt.CTRL + Qt.Key_F))
+        flickerAction.triggered.connect(self.flickerOverlay)
+        editMenu.addAction(flickerAction)
+
+        overlayBar = self.addToolBar("Overlay")
+        overlayBar.addWidget(QLabel(" Overlay opacity "))
+        self.opacitySlider = QSlider(Qt.Horizontal)
+        self.opacitySlider.setRange(0, 100)
+        self.opacitySlider.setValue(100)
+        self.opacitySlider.setMaximumWidth(150)
+        self.opacitySlider.valueChanged.connect(self.setOverlayOpacity)
+        overlayBar.addWidget(self.opacitySlider)
+        overlayBar.addAction(flickerAction)
+
     def keyPress(self, event):
-        if ( event.text().isdigit() and int(event.text()) <= 5 
-                                    and int(event.text()) > 0 ):
-            pti = int(event.text()) - 1
-            for plot in self.image_plot:
-                plot.pti = pti
+        # 1-9 and 0 select points 1 to 10, N the first point unset in both
+        # images (clicking a point selects it too)
+        if event.text().isdigit():
+            self.selectPoint((int(event.text()) - 1) % 10)
+        elif event.key() == Qt.Key_N:
+            unset = np.isnan(self.getPoints()).any(axis=2).all(axis=0)
+            self.selectPoint(int(np.argmax(unset)) if unset.any() else len(unset))
+
+    def selectPoint(self, pti):
+        for plot in self.image_plot:
+            plot.selectPoint(pti)
 
     def setLayout(self):
         self.central_win.setLayout(self.layout)
@@ -181,10 +307,17 @@ class Window(QMainWindow):
             select = self.file_dialog.selectedFiles()[0]
             self.file_dialog.setDirectory(str(Path(select).parent))
 
-            paths.RAW_PATH = select
-            image_plot[1].setImage(paths.RAW_PATH)
-            paths.PTS_CSV_SAVE = None
-            paths.RAW_PATH_SAVE = None
+            self.io.submit(f'Loading {Path(select).name}', image_cache.read, select,
+                           with_progress=True, finished=partial(self.rawLoaded, select))
+
+    def rawLoaded(self, fname, image):
+        paths.RAW_PATH = fname
+        self.image_plot[1].setImage(image)
+        self.transform = None
+        self.transform_points = None
+        self.clearAligned()
+        paths.PTS_CSV_SAVE = None
+        paths.RAW_PATH_SAVE = None
 
     def openReference(self):
         self.file_dialog.setAcceptMode(QFileDialog.AcceptOpen)
@@ -193,9 +326,14 @@ class Window(QMainWindow):
             select = self.file_dialog.selectedFiles()[0]
             self.file_dialog.setDirectory(str(Path(select).parent))
 
-            paths.REFERENCE_PATH = select
-            image_plot[0].setImage(paths.REFERENCE_PATH)
-            paths.REFERENCE_PATH_SAVE = None
+            self.io.submit(f'Loading {Path(select).name}', image_cache.read, select,
+                           with_progress=True, finished=partial(self.referenceLoaded, select))
+
+    def referenceLoaded(self, fname, image):
+        paths.REFERENCE_PATH = fname
+        self.image_plot[0].setImage(image)
+        self.clearAligned()
+        paths.REFERENCE_PATH_SAVE = None
 
     def openPoints(self):
         self.file_dialog.setAcceptMode(QFileDialog.AcceptOpen)
@@ -203,15 +341,118 @@ class Window(QMainWindow):
         if self.file_dialog.exec_():
             select = self.file_dialog.selectedFiles()[0]
 
-            paths.PTS_CSV_READ = select
-            [pts, c_pos, c_size] = read_csv(paths.PTS_CSV_READ)
-            for i in [0, 1]:
-                image_plot[i].points = pts[i, :, :]
-                image_plot[i].setPoints()
-            image_plot[2].roi.setPos(c_pos[0], c_pos[1], update=False)
-            image_plot[2].roi.setSize(c_size)
+            self.io.submit(f'Loading {Path(select).name}', read_csv, select,
+                           finished=partial(self.pointsLoaded, select))
+
+    def openSequence(self):
+        # Images are aligned one after another against the open reference
+        self.file_dialog.setAcceptMode(QFileDialog.AcceptOpen)
+        self.file_dialog.setNameFilter("Images (*.png *.xpm *.jpg *.tif)")
+        self.file_dialog.setFileMode(QFileDialog.ExistingFiles)
+        if self.file_dialog.exec_():
+            select = sorted(self.file_dialog.selectedFiles())
+            self.file_dialog.setDirectory(str(Path(select[0]).parent))
+
+            if self.sequence is not None:
+                self.sequence.close()
+            self.sequence = ImageSequence(select, paths.REFERENCE_PATH)
+            self.showSequence(0)
+        self.file_dialog.setFileMode(QFileDialog.AnyFile)
+
+    def stepSequence(self, step):
+        if self.sequence is not None:
+            self.showSequence(min(max(self.sequence.index + step, 0), len(self.sequence) - 1))
+
+    def showSequence(self, i):
+        # Prefetched pairs come straight out of the sequence's cache
+        self.io.submit(f'Loading {Path(self.sequence.images[i]).name}',
+                       self.sequence.get, i, finished=self.pairLoaded)
+
+    def pairLoaded(self, pair):
+        if pair.reference is not None and pair.reference_path != paths.REFERENCE_PATH:
+            self.referenceLoaded(pair.reference_path, pair.reference)
+        self.rawLoaded(pair.image_path, pair.image)
+        if pair.points is not None:
+            self.pointsLoaded(pair.points_path, pair.points)
+        # Points saved in the project win over the csvs
+        i = self.project.find(pair.image_path) if self.project is not None else None
+        if i is not None and len(self.project.points(i)):
+            self.pointsLoaded(paths.PROJECT_PATH, self.project.points_and_crop(i))
+        self.setWindowTitle(f"Manual Align - {Path(pair.image_path).name} "
+                            f"({pair.index + 1}/{len(self.sequence)})")
+
+    def pointsLoaded(self, fname, result):
+        paths.PTS_CSV_READ = fname
+        [pts, c_pos, c_size] = result
+        for i in [0, 1]:
+            self.image_plot[i].points = pts[i, :, :]
+            self.image_plot[i].setPoints()
+        if c_pos is not None:
+            self.image_plot[2].roi.setPos(c_pos[0], c_pos[1], update=False)
+            self.image_plot[2].roi.setSize(c_size)
+
+    def openProject(self):
+        # The project's pairs are opened as a sequence
+        self.file_dialog.setAcceptMode(QFileDialog.AcceptOpen)
+        self.file_dialog.setNameFilter("Project (*.npz)")
+        if self.file_dialog.exec_():
+            select = self.file_dialog.selectedFiles()[0]
+
+            self.io.submit(f'Loading {Path(select).name}', Project.load, select,
+                           finished=partial(self.projectLoaded, select))
+
+    def projectLoaded(self, fname, project):
+        paths.PROJECT_PATH = fname
+        self.project = project
+        if len(project) == 0:
+            return
+        if self.sequence is not None:
+            self.sequence.close()
+        # Pairs saved without a reference (by older versions) keep the open one
+        self.sequence = ImageSequence(project.image_paths,
+                                      [f or None for f in project.reference_paths])
+        self.showSequence(0)
+
+    def saveProject(self):
+        # Adds (or updates) the open pair in the project
+        if paths.RAW_PATH is None:
+            logging.error('No image open, cannot save to project')
+            return 0
+        if paths.REFERENCE_PATH is None:
+            logging.error('No reference open, cannot save to project')
+            return 0
+        if paths.PROJECT_PATH is None:
+            self.file_dialog.setAcceptMode(QFileDialog.AcceptSave)
+            self.file_dialog.setNameFilter("Project (*.npz)")
+            if self.file_dialog.exec_():
+                paths.PROJECT_PATH = self.file_dialog.selectedFiles()[0]
+        if paths.PROJECT_PATH is None:
+            logging.error('Project save path not defined')
+            return 0
+
+        if self.project is None:
+            self.project = Project()
+        i = self.project.find(paths.RAW_PATH)
+        if i is None:
+            i = self.project.add_pair(paths.REFERENCE_PATH, paths.RAW_PATH, hash_files=False)
+        [c_pos, c_size] = self.image_plot[2].getCrop()
+        pts = self.getPoints()
+        self.project.update_pair(i, pair_points(pts), np.concatenate([c_pos, c_size]),
+                                 self.matrixFor(*overlapping_pts(pts)), self.currentMetrics())
+
+        # Hashing reads both images, so it runs on the io pool with the save,
+        # on a copy the gui can't change in the meantime
+        def save(project, fname):
+            project.hash_files(i)
+            project.save(fname)
+        self.io.submit(f'Saving {Path(paths.PROJECT_PATH).name}', save,
+                       self.project.copy(), paths.PROJECT_PATH)
 
     def saveAlignedImage(self, crop: bool):
+        if self.transform is None:
+            logging.error('Images not aligned, cannot save')
+            return 0
+
         if paths.RAW_PATH_SAVE is None:
             self.file_dialog.setAcceptMode(QFileDialog.AcceptSave)
             self.file_dialog.setNameFilter("Images (*.png *.xpm *.jpg *.tif)")
@@ -222,26 +463,52 @@ class Window(QMainWindow):
                 paths.RAW_PATH_SAVE = select
                 if paths.PTS_CSV_SAVE is None:
                     paths.PTS_CSV_SAVE = f'{select[:-4]}.csv'
+        if paths.RAW_PATH_SAVE is None:
+            logging.error('Image name not defined, cannot save')
+            return 0
 
-        [c_pos, c_size] = [None, None]
-        if crop:
-            [c_pos, c_size] = image_plot[2].getCrop()
-
-        try:
-            image_plot[2].saveImage(paths.RAW_PATH_SAVE, c_pos=c_pos, \
-                                    c_size=c_size)
-            if self.autoSavePointsAction.isChecked():
-                self.savePoints()
-        except Exception as e:
-            paths.RAW_PATH_SAVE = None
-            paths.PTS_CSV_SAVE = None
-            raise e
+        # The warp runs on the io pool too, with the arrays as they are now
+        fname = paths.RAW_PATH_SAVE
+        raw = self.image_plot[1].image
+        A = self.transform
+        ref_pts, trans_pts = self.transform_points
+        model = self.warpModel(ref_pts, trans_pts)
+        out_size = self.image_plot[0].image.shape[1::-1]
+        # Points are autosaved as they are now, once the image is saved
+        saved = None
+        if self.autoSavePointsAction.isChecked():
+            points = self.pointsToSave()
+            saved = lambda result: self.writePoints(points)
+        spec = self.serverJob(fname, *(self.image_plot[2].getCrop() if crop else (None, None)))
+        if spec is not None:
+            self.io.submit(f'Saving {Path(fname).name} on the server', self.runOnServer, spec,
+                           with_progress=True, finished=saved, error=self.saveFailed)
+        elif crop:
+            # Only the cropped region is warped, straight from the raw image
+            # (or cut out of the cached full warp)
+            [c_pos, c_size] = self.image_plot[2].getCrop()
+            job = lambda: write_image(fname, image_cache.warp(raw, model, A, (ref_pts, trans_pts),
+                                                              out_size, c_pos, c_size))
+        elif self.aligned_transform is A and self.aligned_model == model:
+            aligned = self.image_plot[2].image
+            job = lambda: write_image(fname, aligned)
+        else:
+            # Only the preview is aligned with the current points
+            job = lambda: write_image(fname, image_cache.warp(raw, model, A, (ref_pts, trans_pts),
+                                                              out_size))
+        if spec is None:
+            self.io.submit(f'Saving {Path(fname).name}', job, finished=saved,
+                           error=self.saveFailed)
+
+    def saveFailed(self, message):
+        paths.RAW_PATH_SAVE = None
+        paths.PTS_CSV_SAVE = None
 
     saveFullImage = partialmethod(saveAlignedImage, False)
     saveCropImage = partialmethod(saveAlignedImage, True)
 
     def saveReference(self):
-        [c_pos, c_size] = image_plot[2].getCrop()
+        [c_pos, c_size] = self.image_plot[2].getCrop()
         if paths.REFERENCE_PATH_SAVE is None:
             self.file_dialog.setAcceptMode(QFileDialog.AcceptSave)
             self.file_dialog.setNameFilter("Images (*.png *.xpm *.jpg *.tif)")
@@ -250,10 +517,21 @@ class Window(QMainWindow):
                 self.file_dialog.setDirectory(str(Path(select).parent))
 
                 paths.REFERENCE_PATH_SAVE = select
-            
-        image_plot[0].saveImage(paths.REFERENCE_PATH_SAVE, c_pos, c_size)
+        if paths.REFERENCE_PATH_SAVE is None:
+            logging.error('Image name not defined, cannot save')
+            return 0
+
+        self.io.submit(f'Saving {Path(paths.REFERENCE_PATH_SAVE).name}',
+                       self.image_plot[0].saveImage, paths.REFERENCE_PATH_SAVE, c_pos, c_size)
+
+    def pointsToSave(self):
+        # (points, crop position, crop size, metrics) as they are now
+        return (self.getPoints(), *self.image_plot[2].getCrop(), self.currentMetrics())
 
     def savePoints(self):
+        self.writePoints(self.pointsToSave())
+
+    def writePoints(self, points):
         if paths.PTS_CSV_SAVE is None:
             self.file_dialog.setAcceptMode(QFileDialog.AcceptSave)
             self.file_dialog.setNameFilter("CSV File (*.csv)")
@@ -261,67 +539,325 @@ class Window(QMainWindow):
                 select = self.file_dialog.selectedFiles()[0]
 
                 paths.PTS_CSV_SAVE = select
-        
-        save_csv(paths.PTS_CSV_SAVE)
+        if paths.PTS_CSV_SAVE is None:
+            logging.error('CSV Points save path not defined')
+            return 0
 
-    def align(self):
-        pts = np.zeros((2, 5, 2))
+        self.io.submit(f'Saving {Path(paths.PTS_CSV_SAVE).name}', write_csv,
+                       paths.PTS_CSV_SAVE, *points)
+
+    def setEncoder(self, name):
+        image_io.encoder = name
+
+    def setUseServer(self, enabled):
+        # Align and save on a running server.py instead of in this process
+        self.server = None
+        if enabled:
+            client = Client(self.server_address)
+            try:
+                client.status()
+                self.server = client
+            except OSError:
+                self.statusBar().showMessage(f'No alignment server at {client.address}', 10000)
+            except RuntimeError as e:
+                self.statusBar().showMessage(f'Alignment server: {e}', 10000)
+            self.useServerAction.setChecked(self.server is not None)
+
+    def setServerAddress(self):
+        # A unix socket path or host:port, shared servers are set up by
+        # whoever runs server.py
+        address, ok = QInputDialog.getText(self, "Alignment Server", "Address:",
+                                           text=self.server_address)
+        if ok and address:
+            self.server_address = address
+            if self.server is not None:
+                self.setUseServer(True)
+
+    def serverJob(self, output, c_pos=None, c_size=None):
+        # server.job_spec of the open pair, with the points it was last
+        # aligned with. None if there is no server, or the images weren't
+        # opened from files (the server reads them itself)
+        if (self.server is None or self.transform_points is None
+                or paths.REFERENCE_PATH is None or paths.RAW_PATH is None):
+            return None
+        ref_pts, trans_pts = self.transform_points
+        return job_spec(paths.REFERENCE_PATH, paths.RAW_PATH, np.stack([ref_pts, trans_pts]),
+                        output, c_pos, c_size, self.warpModel(ref_pts, trans_pts),
+                        image_cache.enabled)
+
+    def runOnServer(self, spec, progress=None):
+        result = self.server.submit(spec, self.server_priority, progress)
+        if result['event'] == 'cancelled':
+            raise Cancelled()
+        if result['error'] is not None:
+            raise RuntimeError(result['error'])
+        return result['output']
+
+    def setDiskCache(self, enabled):
+        image_cache.enabled = enabled
+
+    def clearDiskCache(self):
+        self.io.submit('Clearing disk cache', image_cache.clear)
+
+    def ioBusy(self, label):
+        self.busy_message = label
+        self.statusBar().showMessage(label)
+        # Busy indicator until the task reports progress
+        self.progressBar.setRange(0, 0)
+        self.progressBar.show()
+        self.cancelButton.show()
+
+    def ioProgress(self, fraction):
+        self.progressBar.setRange(0, 100)
+        self.progressBar.setValue(int(100 * fraction))
+
+    def ioIdle(self):
+        # Errors stay up until they time out
+        if self.statusBar().currentMessage() == getattr(self, 'busy_message', None):
+            self.statusBar().clearMessage()
+        self.progressBar.hide()
+        self.cancelButton.hide()
+
+    def showTiming(self):
+        # p50/p95 of every stage timed so far this session
+        report = QMessageBox(QMessageBox.Information, "Timing Report", "Stage timings this session", parent=self)
+        report.setInformativeText("<pre>" + timing.format_summary() + "</pre>")
+        report.exec_()
+
+    def closeEvent(self, event):
+        if self.sequence is not None:
+            self.sequence.close()
+        self.io.cancelAll()
+        self.io.wait()
+        timing.log_summary()
+        super(Window, self).closeEvent(event)
+
+    def getPoints(self):
+        # (2, n, 2) reference and image points, NaN where unset
+        n = max(len(self.image_plot[i].points) for i in range(2))
+        pts = np.full((2, n, 2), np.nan)
         for i in range(2):
-            pts[i, :, :] = self.image_plot[i].points
-        [c_pos, c_size] = self.image_plot[2].getCrop()
-
-        non0_pts = (pts != 0)
-        selected_pts = np.logical_or(non0_pts[:,:,0], non0_pts[:,:,1])
-        overlapping = np.logical_and(selected_pts[0], selected_pts[1])
-        
-        ref_pts = pts[0, overlapping]
-        trans_pts = pts[1, overlapping]
-
-        if np.sum(overlapping) > 2:
-            logging.info(f"Using {np.sum(overlapping)} point alignment...")
-            align = transform_5pt(self.image_plot[1].image, ref_pts, trans_pts,
-                                  self.image_plot[0].image.shape[::-1])
-        elif np.sum(overlapping) == 2:
-            logging.warning("Warning: Using 2 point alignment (suboptimal)...")
-            align = transform_2pt(self.image_plot[1].image, ref_pts, trans_pts,
-                                  self.image_plot[0].image.shape[::-1])
-        elif np.sum(overlapping) < 2:
-            logging.error("Not enough valid points selected")
-            return 0
+            points = self.image_plot[i].points
+            pts[i, :len(points), :] = points
+        # Leaving out the unset points at the end
+        set_pts = np.flatnonzero(~np.isnan(pts).any(axis=2).all(axis=0))
+        return pts[:, :set_pts[-1] + 1 if len(set_pts) else 0]
 
+    def align(self):
+        with span('align', **timing.image_fields(self.image_plot[1].image)):
+            [c_pos, c_size] = self.image_plot[2].getCrop()
+
+            ref_pts, trans_pts = overlapping_pts(self.getPoints())
+
+            if len(ref_pts) > 2:
+                logging.info(f"Using {len(ref_pts)} point alignment...")
+            elif len(ref_pts) == 2:
+                logging.warning("Warning: Using 2 point alignment (suboptimal)...")
+            elif len(ref_pts) < 2:
+                logging.error("Not enough valid points selected")
+                return 0
+            residuals = self.solve(ref_pts, trans_pts)
+            if residuals is None:
+                return 0
+            model = self.warpModel(ref_pts, trans_pts)
+            show = partial(self.showAligned, self.transform, self.getPoints(), residuals, model,
+                           c_size)
+
+            spec = self.serverJob(None)
+            if spec is not None:
+                # Warped to a temporary file and shown once the server is done
+                fd, spec['output'] = tempfile.mkstemp(suffix='.tif')
+                os.close(fd)
+                self.clearAligned()
+                self.io.submit('Aligning on the server', self.alignOnServer, spec,
+                               with_progress=True,
+                               finished=show)
+                return
+
+            raw = self.image_plot[1].image
+            out_size = self.image_plot[0].image.shape[1::-1]
+            # Reuses a cached warp, but doesn't write one from the gui thread
+            # for every point set tried
+            align = image_cache.warp(raw, model, self.transform, (ref_pts, trans_pts), out_size,
+                                     store=False)
+            show(align)
+
+    def solve(self, ref_pts, trans_pts):
+        # Sets transform from the points, returns the residuals, or None (and
+        # no transform) if they can't be fit, like points all on one line
+        try:
+            self.transform, residuals = estimate_transform(ref_pts, trans_pts)
+        except ValueError as e:
+            logging.error(f'Cannot align: {e}')
+            self.statusBar().showMessage(f'Cannot align: {e}', 10000)
+            self.metricsLabel.clear()
+            self.transform, self.transform_points = None, None
+            return None
+        self.transform_points = (ref_pts, trans_pts)
+        return residuals
+
+    def alignOnServer(self, spec, progress=None):
+        try:
+            return read_image(self.runOnServer(spec, progress))
+        finally:
+            os.remove(spec['output'])
+
+    def showAligned(self, A, pts, residuals, model, c_size, align):
+        self.aligned_transform = A
+        self.aligned_model = model
+        self.metrics = metrics.measure(residuals, self.image_plot[0].image, align)
+        self.metrics_points = overlapping_pts(pts)
+        self.metricsLabel.setText(self.metrics.summary())
+        logging.info(f'Aligned: {self.metrics.summary()}')
         # The fused image on the right:
         self.image_plot[2].setImage(align, disp=False)
-        self.image_plot[2].overlayImage(image_plot[0].image)
+        self.image_plot[2].overlayImage(self.image_plot[0].image)
         self.image_plot[2].roi.setSize(pg.Point(c_size[0], c_size[1]))
 
+    def clearAligned(self):
+        # Forgets the last align, its matrix and metrics, once an image it was
+        # made from is replaced (or it's being redone)
+        self.aligned_transform = None
+        self.aligned_model = None
+        self.metrics = None
+        self.metrics_points = None
+        self.metricsLabel.clear()
+
+    def currentMetrics(self):
+        # Metrics of the last align, None if the points changed since
+        if self.metrics is None or \
+                not same_points(overlapping_pts(self.getPoints()), self.metrics_points):
+            return None
+        return self.metrics
+
+    def matrixFor(self, ref_pts, trans_pts):
+        # transform if it was solved from these points, solved again if the
+        # points were moved since (NaN if they can't be)
+        if self.transform is not None and same_points((ref_pts, trans_pts), self.transform_points):
+            return self.transform
+        try:
+            return estimate_transform(ref_pts, trans_pts)[0]
+        except ValueError:
+            return np.full((3, 3), np.nan)
+
+    def setWarpModel(self, name):
+        self.warp_model = name
+        self.schedulePreview()
+
+    def warpModel(self, ref_pts, trans_pts):
+        # Non-rigid models need more points (that aren't all on one line),
+        # without them it's affine
+        if self.warp_model == 'affine':
+            return 'affine'
+        try:
+            nonrigid.check_points(self.warp_model, ref_pts, trans_pts)
+        except ValueError as e:
+            if len(ref_pts) >= nonrigid.MIN_POINTS[self.warp_model]:
+                self.statusBar().showMessage(f'{e}, using affine', 10000)
+            return 'affine'
+        return self.warp_model
+
+    def schedulePreview(self):
+        # Restarting the timer on every change debounces the preview
+        if self.livePreviewAction.isChecked():
+            self.preview_timer.start()
+
+    def proxy(self, i):
+        image = self.image_plot[i].image
+        if i not in self.proxies or self.proxies[i][0] is not image:
+            self.proxies[i] = (image, *downsample(image, self.preview_size))
+        return self.proxies[i][1:]
+
+    def preview(self):
+        # Aligns the downsampled proxies, the full resolution warp is left to
+        # align and the save actions
+        ref = self.image_plot[0].image
+        if ref.size == 0 or self.image_plot[1].image.size == 0:
+            return
+        ref_pts, trans_pts = overlapping_pts(self.getPoints())
+        if len(ref_pts) < 2:
+            return
+        residuals = self.solve(ref_pts, trans_pts)
+        if residuals is None:
+            return
+
+        ref_proxy, ref_scale = self.proxy(0)
+        raw_proxy, raw_scale = self.proxy(1)
+        model = self.warpModel(ref_pts, trans_pts)
+        if model == 'affine':
+            A = np.diag([ref_scale[0], ref_scale[1], 1]) @ self.transform \
+                    @ np.diag([1 / raw_scale[0], 1 / raw_scale[1], 1])
+            warped = warp_image(raw_proxy, A, ref_proxy.shape[1::-1])
+        else:
+            # Not cached, the proxy maps change whenever a point moves
+            region = (0, 0, ref_proxy.shape[1], ref_proxy.shape[0])
+            warped = remap(raw_proxy, remap_maps(model, ref_pts * ref_scale,
+                                                 trans_pts * raw_scale, region))
+        self.image_plot[2].setPreview(warped, ref)
+        # The proxies are small enough to score on every change
+        preview_metrics = metrics.measure(residuals, ref_proxy, warped)
+        self.metricsLabel.setText(f'Preview: {preview_metrics.summary()}')
+
+    def autoSeed(self):
+        # Feature matching on small copies of both images (taken from their
+        # pyramids when they have them) runs on the io pool
+        ref, raw = self.image_plot[0].image, self.image_plot[1].image
+        if ref.size == 0 or raw.size == 0:
+            return
+        pyramids = [plot.pyramids[0] if plot.pyramids else None for plot in self.image_plot[:2]]
+        self.io.submit('Finding seed points', auto_seed, ref, raw, ref_pyramid=pyramids[0],
+                       img_pyramid=pyramids[1], finished=self.seedsFound)
+
+    def seedsFound(self, result):
+        # Seeds are added after the points already there
+        ref_pts, raw_pts = result
+        if len(ref_pts) == 0:
+            self.statusBar().showMessage("No seed points found", 10000)
+            return
+        pts = self.getPoints()
+        n = pts.shape[1]
+        for i, seeds in enumerate((ref_pts, raw_pts)):
+            self.image_plot[i].points = np.concatenate([pts[i], seeds])
+            self.image_plot[i].setPoints()
+        self.selectPoint(n)
+        self.statusBar().showMessage(f"Added {len(ref_pts)} seed points", 10000)
 
     def clearPoints(self):
-        self.image_plot[0].points = np.zeros((5,2))
-        self.image_plot[0].setPoints()
-        self.image_plot[1].points = np.zeros((5,2))
-        self.image_plot[1].setPoints()
+        self.image_plot[0].clearPoints()
+        self.image_plot[1].clearPoints()
         
     def lockROI(self, e):
         self.image_plot[2].roi.translatable = ( e != True )
 
-QApplication.setAttribute(Qt.AA_EnableHighDpiScaling)
-app = QApplication([])
-win = Window()
+    def setOverlayOpacity(self, value):
+        self.image_plot[2].setOverlayOpacity(value / 100)
+
+    def flickerOverlay(self, e):
+        self.image_plot[2].setFlicker(e)
 
-image_plot = win.image_plot
+def loadStartupFiles(image_plot):
+    image_plot[0].setImage(paths.REFERENCE_PATH)
+    image_plot[1].setImage(paths.RAW_PATH)
 
-image_plot[0].setImage(paths.REFERENCE_PATH)
-image_plot[1].setImage(paths.RAW_PATH)
+    if paths.PTS_CSV_READ is not None:
+        [pts, c_pos, c_size] = read_csv(paths.PTS_CSV_READ)
+        for i in [0, 1]:
+            image_plot[i].points = pts[i, :, :]
+            image_plot[i].setPoints()
 
-if paths.PTS_CSV_READ is not None:
-    [pts, c_pos, c_size] = read_csv(paths.PTS_CSV_READ)
-    for i in [0, 1]:
-        image_plot[i].points = pts[i, :, :]
-        image_plot[i].setPoints()
+if __name__ == "__main__":
+    QApplication.setAttribute(Qt.AA_EnableHighDpiScaling)
+    app = QApplication([])
+    # Every timed stage, as json lines
+    timing.open_log('align_timing.jsonl')
+    win = Window()
 
-# You can access points by accessing image_plot1.points
-win.show()
+    image_plot = win.image_plot
 
-if (sys.flags.interactive != 1) or not hasattr(Qt.QtCore, "PYQT_VERSION"):
-    QApplication.instance().exec_()
+    # You can access points by accessing image_plot1.points
+    win.show()
+    # Show the window before decoding anything
+    QTimer.singleShot(0, lambda: loadStartupFiles(image_plot))
 
+    if (sys.flags.interactive != 1) or not hasattr(Qt.QtCore, "PYQT_VERSION"):
+        QApplication.instance().exec_()
@@ -0,0 +1,112 @@
+# Automatic seed points, so a pair doesn't have to be started by hand
+#
+# Features are detected (ORB or AKAZE) and matched on small copies of both
+# images, a transform is fit to the matches with RANSAC, and a few of the
+# inliers, spread out over the reference, are returned as point pairs in full
+# resolution coordinates, to be touched up by hand.
+
+import logging
+
+import numpy as np
+
+from image_io import to_gray_uint8
+from pyramid import downsample
+from timing import span
+
+DETECTORS = ('orb', 'akaze')
+
+def _detector(name, max_features):
+    import cv2
+    if name == 'orb':
+        return cv2.ORB_create(nfeatures=max_features)
+    if name == 'akaze':
+        return cv2.AKAZE_create()
+    raise ValueError(f'Unknown detector {name}, should be one of {DETECTORS}')
+
+def _detect(detector, image, max_features):
+    keypoints, descriptors = detector.detectAndCompute(image, None)
+    if descriptors is None:
+        return np.empty((0, 2)), None
+    # AKAZE has no feature budget of its own, keep the strongest ones
+    if len(keypoints) > max_features:
+        keep = np.argsort([-k.response for k in keypoints])[:max_features]
+        keypoints = [keypoints[i] for i in keep]
+        descriptors = descriptors[keep]
+    return np.array([k.pt for k in keypoints], dtype=np.float64), descriptors
+
+def _spread(ref_pts, distances, shape, max_points, cells=4):
+    # Indices of the best match in each cell of a cells x cells grid over the
+    # reference, best first, so the points cover the whole image
+    cell = (np.minimum(ref_pts[:, 1] * cells // shape[0], cells - 1) * cells
+            + np.minimum(ref_pts[:, 0] * cells // shape[1], cells - 1)).astype(int)
+    order = np.argsort(distances)
+    _, first = np.unique(cell[order], return_index=True)
+    best = order[np.sort(first)]
+    best = best[np.argsort(distances[best])]
+    return best[:max_points]
+
+def seed_points(ref, img, ref_scale=(1, 1), img_scale=(1, 1), detector='orb',
+                max_features=2000, max_points=16, ratio=0.8, threshold=3.0, snap=True):
+    # ref and img are (downsampled) images, ref_scale and img_scale their
+    # size relative to the full resolution images, as pyramid.downsample
+    # returns them. Returns (ref_pts, img_pts) in full resolution
+    # coordinates, empty if no transform was found. With snap, the reference
+    # points are moved onto the fitted transform
+    import cv2
+    ref, img = to_gray_uint8(ref), to_gray_uint8(img)
+    found = (np.empty((0, 2)), np.empty((0, 2)))
+    det = _detector(detector, max_features)
+    ref_kp, ref_desc = _detect(det, ref, max_features)
+    img_kp, img_desc = _detect(det, img, max_features)
+    if ref_desc is None or img_desc is None or len(ref_kp) < 3 or len(img_kp) < 3:
+        logging.info('Auto-seed: not enough features')
+        return found
+
+    # Lowe's ratio test keeps only distinctive matches
+    matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
+    pairs = [m for m in matcher.knnMatch(ref_desc, img_desc, k=2) if len(m) == 2]
+    good = [m for m, n in pairs if m.distance < ratio * n.distance]
+    if len(good) < 3:
+        logging.info(f'Auto-seed: only {len(good)} matches')
+        return found
+    ref_pts = ref_kp[[m.queryIdx for m in good]]
+    img_pts = img_kp[[m.trainIdx for m in good]]
+    distances = np.array([m.distance for m in good], dtype=np.float64)
+
+    M, inliers = cv2.estimateAffine2D(img_pts, ref_pts, method=cv2.RANSAC,
+                                      ransacReprojThreshold=threshold)
+    if M is None or inliers.sum() < 3:
+        logging.info('Auto-seed: no consistent transform')
+        return found
+    inliers = inliers.ravel().astype(bool)
+    ref_pts, img_pts, distances = ref_pts[inliers], img_pts[inliers], distances[inliers]
+    logging.info(f'Auto-seed: {inliers.sum()} of {len(good)} matches are inliers')
+
+    keep = _spread(ref_pts, distances, ref.shape, max_points)
+    ref_pts, img_pts = ref_pts[keep], img_pts[keep]
+    if snap:
+        # Keypoints found at ORB's coarser octaves are only good to a few
+        # pixels, the fit to all of the inliers is better
+        ref_pts = img_pts @ M[:, :2].T + M[:, 2]
+    return ref_pts / ref_scale, img_pts / img_scale
+
+def _small(image, pyramid, max_size):
+    # image at most max_size large, starting from the pyramid level closest
+    # to that if there is one (shrinking 100 MP images takes a while)
+    level = None
+    if pyramid is not None and pyramid.image is image:
+        level = pyramid.level_at_most(2 * max_size)
+    if level is None:
+        return downsample(image, max_size)
+    small, (sx, sy) = downsample(level, max_size)
+    return small, (sx * level.shape[1] / image.shape[1], sy * level.shape[0] / image.shape[0])
+
+def auto_seed(ref, img, max_size=1024, ref_pyramid=None, img_pyramid=None, **kwargs):
+    # seed_points on full resolution images, matched at most max_size large.
+    # The images' pyramids (pyramid.ImagePyramid) are used if given
+    with span('autoseed', detector=kwargs.get('detector', 'orb')) as fields:
+        ref_small, ref_scale = _small(ref, ref_pyramid, max_size)
+        img_small, img_scale = _small(img, img_pyramid, max_size)
+        ref_pts, img_pts = seed_points(ref_small, img_small, ref_scale, img_scale, **kwargs)
+        fields['points'] = len(ref_pts)
+    return ref_pts, img_pts
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# Headless batch alignment, applies saved points csvs to many image pairs
+#
+# The manifest is a csv with one job per row:
+#   reference, image, points csv, output
+# (relative paths are relative to the manifest). A header row starting with
+# "reference" is skipped.
+#
+# A project file (see project.py) can be given instead of a manifest, with
+# --output-dir for the aligned images.
+
+import argparse
+import csv
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import numpy as np
+
+import image_cache
+from image_io import write_image, channels
+from points import read_csv
+from project import Project
+from transformations import overlapping_pts, estimate_transform, warp_image
+from warp import open_output
+from nonrigid import MIN_POINTS
+from metrics import FIELDS, measure
+
+@dataclass
+class Job:
+    index: int
+    reference: str
+    image: str
+    # Path of a points csv, or (ref_pts, trans_pts, c_pos, c_size) from a project
+    points: object
+    output: str
+    crop: bool = True
+    # 'affine', or one of the nonrigid.MODELS
+    model: str = 'affine'
+    # Go through the disk cache (see image_cache.py)
+    cache: bool = False
+
+@dataclass
+class JobResult:
+    index: int
+    output: str
+    error: str = None
+    timings: dict = field(default_factory=dict)
+    # metrics.Metrics.as_dict() of the alignment
+    metrics: dict = field(default_factory=dict)
+
+    @property
+    def ok(self):
+        return self.error is None
+
+def read_manifest(manifest_fname, crop=True, model='affine'):
+    root = Path(manifest_fname).parent
+    jobs = []
+    with open(manifest_fname, mode='r') as csv_file:
+        csv_reader = csv.reader(csv_file, delimiter=',')
+        for row in csv_reader:
+            if not row or row[0].strip().lower() == 'reference':
+                continue
+            if len(row) < 4:
+                raise ValueError(f'{manifest_fname}: expected 4 columns, got {row}')
+            row = [str(root / col.strip()) for col in row[:4]]
+            jobs.append(Job(len(jobs), *row, crop=crop, model=model))
+    return jobs
+
+def read_project(project_fname, output_dir, crop=True, suffix='.tif', model='affine'):
+    # Outputs are named after the images, pairs without a crop aren't cropped
+    project = Project.load(project_fname)
+    jobs = []
+    for i in range(len(project)):
+        ref_pts, trans_pts = project.matched_points(i)
+        c_pos, c_size = project.crop(i)
+        output = str(Path(output_dir) / (Path(project.image_paths[i]).stem + suffix))
+        jobs.append(Job(i, project.reference_paths[i], project.image_paths[i],
+                        (ref_pts, trans_pts, c_pos, c_size), output,
+                        crop=crop and c_pos is not None, model=model))
+    return jobs
+
+STAGES = ['load', 'solve', 'warp', 'save']
+
+def init_worker():
+    # Worker processes run one per core, so each of them warps on one
+    import cv2
+    cv2.setNumThreads(1)
+
+def run_job(job, progress=None, threads=None):
+    # progress, if given, is called with the name of every stage as it's done
+    result = JobResult(job.index, job.output)
+    t_start = time.perf_counter()
+    # Jobs run in worker processes, which don't share the module settings
+    image_cache.enabled = job.cache
+    try:
+        t = time.perf_counter()
+        reference = image_cache.read(job.reference)
+        image = image_cache.read(job.image)
+        if isinstance(job.points, str):
+            [pts, c_pos, c_size] = read_csv(job.points)
+            ref_pts, trans_pts = overlapping_pts(pts)
+        else:
+            ref_pts, trans_pts, c_pos, c_size = job.points
+        result.timings['load'] = time.perf_counter() - t
+        if progress is not None:
+            progress('load')
+
+        t = time.perf_counter()
+        if len(ref_pts) < MIN_POINTS.get(job.model, 2):
+            raise ValueError('Not enough valid points selected')
+        out_size = reference.shape[1::-1]
+        # Non-rigid models fit the points exactly, their residuals are those
+        # of the affine fit
+        A, residuals = estimate_transform(ref_pts, trans_pts)
+        result.timings['solve'] = time.perf_counter() - t
+        if progress is not None:
+            progress('solve')
+
+        t = time.perf_counter()
+        if not job.crop:
+            c_pos, c_size = None, None
+        Path(job.output).parent.mkdir(parents=True, exist_ok=True)
+        direct = (not job.cache and job.model == 'affine' and c_pos is None
+                  and Path(job.output).suffix.lower() in ('.tif', '.tiff')
+                  and channels(image) in (1, 3, 4))
+        if direct:
+            # Full size TIFFs are warped straight into the output file, so
+            # they don't have to fit in memory
+            out = open_output(job.output, reference.shape[:2] + image.shape[2:], image.dtype)
+            aligned = warp_image(image, A, out_size, out=out, threads=threads)
+        else:
+            # The remap maps of non-rigid models are built (and cached) here
+            aligned = image_cache.warp(image, job.model, A, (ref_pts, trans_pts), out_size,
+                                       c_pos, c_size, threads=threads)
+        result.timings['warp'] = time.perf_counter() - t
+        if progress is not None:
+            progress('warp')
+        result.metrics = measure(residuals, reference, aligned, c_pos, c_size).as_dict()
+
+        t = time.perf_counter()
+        if direct:
+            aligned.flush()
+        else:
+            write_image(job.output, aligned)
+        result.timings['save'] = time.perf_counter() - t
+        if progress is not None:
+            progress('save')
+    except Exception as e:
+        result.error = f'{type(e).__name__}: {e}'
+    result.timings['total'] = time.perf_counter() - t_start
+    return result
+
+def run_batch(jobs, workers=None):
+    # Yields results as they finish
+    if workers == 1:
+        for job in jobs:
+            yield run_job(job)
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as pool:
+        # One strip thread per warp, the processes already use every core
+        futures = [pool.submit(run_job, job, threads=1) for job in jobs]
+        for future in as_completed(futures):
+            yield future.result()
+
+def write_report(report_fname, results):
+    stages = STAGES + ['total']
+    with open(report_fname, mode='w') as csv_file:
+        csv_writer = csv.writer(csv_file, delimiter=',')
+        csv_writer.writerow(['index', 'output', 'ok'] + stages + FIELDS + ['error'])
+        for r in sorted(results, key=lambda r: r.index):
+            csv_writer.writerow([r.index, r.output, int(r.ok)]
+                                + [f'{r.timings.get(s, 0):.4f}' for s in stages]
+                                + [f'{r.metrics.get(f, np.nan):.4f}' for f in FIELDS]
+                                + [r.error or ''])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Align image pairs from saved points csvs')
+    parser.add_argument('manifest', help='csv of reference, image, points csv, output rows, '
+                                         'or a project .npz')
+    parser.add_argument('--output-dir', help='folder for the aligned images of a project')
+    parser.add_argument('--format', default='.tif', help='file format of project outputs')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='number of worker processes (default: all cores)')
+    parser.add_argument('--no-crop', action='store_true',
+                        help='save the full aligned image instead of the csv crop')
+    parser.add_argument('--model', default='affine', choices=['affine', 'tps', 'piecewise'],
+                        help='warp model (default: affine)')
+    parser.add_argument('--report', help='write per job timings and errors to this csv')
+    parser.add_argument('--cache', action='store_true',
+                        help='keep decoded images and aligned outputs in the disk cache, '
+                             'so running again skips them')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    if Path(args.manifest).suffix.lower() == '.npz':
+        if args.output_dir is None:
+            parser.error('--output-dir is needed for a project')
+        jobs = read_project(args.manifest, args.output_dir, not args.no_crop, args.format,
+                            args.model)
+    else:
+        jobs = read_manifest(args.manifest, crop=not args.no_crop, model=args.model)
+    for job in jobs:
+        job.cache = args.cache
+
+    t_start = time.perf_counter()
+    results = []
+    for r in run_batch(jobs, workers=args.jobs):
+        results.append(r)
+        if r.ok:
+            print(f'[{len(results)}/{len(jobs)}] {r.output}: {r.timings["total"]:.2f}s, '
+                  f'RMS {r.metrics["rms"]:.2f} px, NCC {r.metrics["ncc"]:.3f}')
+        else:
+            print(f'[{len(results)}/{len(jobs)}] {r.output}: FAILED {r.error}', file=sys.stderr)
+    elapsed = time.perf_counter() - t_start
+
+    failed = [r for r in results if not r.ok]
+    print(f'Aligned {len(results) - len(failed)}/{len(jobs)} pairs in {elapsed:.2f}s')
+    if args.report is not None:
+        write_report(args.report, results)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
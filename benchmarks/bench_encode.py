@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# Write speed of every image encoder image_io knows about, per format and
+# image size. image_io.write_image runs a small version of this to pick its
+# encoder when image_io.encoder is 'auto'.
+#
+#   python benchmarks/bench_encode.py --megapixels 1 25 --formats .tif .png
+
+import argparse
+import json
+import sys
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import image_io
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark image encoders')
+    parser.add_argument('--megapixels', type=float, nargs='+', default=[1, 25])
+    parser.add_argument('--formats', nargs='+', default=['.tif', '.png', '.jpg', '.bmp'])
+    parser.add_argument('--qt', action='store_true', help='include the Qt encoder')
+    parser.add_argument('--out', help='write results to this json file')
+    args = parser.parse_args(argv)
+
+    if args.qt:
+        import PyQt5.QtGui
+
+    results = []
+    for mp in args.megapixels:
+        side = int(np.sqrt(mp * 1e6))
+        # Smooth with some noise, so compression has something to do
+        rng = np.random.default_rng(0)
+        image = (np.add.outer(np.arange(side), np.arange(side)) // 8
+                 + rng.integers(0, 8, (side, side))).astype(np.uint8)
+        for suffix in args.formats:
+            times = image_io.benchmark_encoders(suffix, image, repeat=2)
+            for name, seconds in sorted(times.items(), key=lambda t: t[1]):
+                results.append({'megapixels': mp, 'format': suffix,
+                                'encoder': name, 'seconds': seconds})
+                print(f'{mp:6.0f} MP {suffix:5s} {name:9s} {seconds:8.3f} s')
+
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
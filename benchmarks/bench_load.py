@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# Peak memory and wall time of image loading, image_io.read_image (as stored,
+# and as 8 bit grayscale) against the old skimage path (imread, rgb2gray, then
+# rescale to uint8)
+#
+# Every measurement runs in a fresh interpreter so peak RSS is not shared
+# between them:
+#
+#   python benchmarks/bench_load.py --megapixels 100 --out load.json
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+
+LOAD_SCRIPT = '''
+import json, resource, sys, time
+import numpy as np
+from skimage import io, color
+import tifffile
+from image_io import read_image
+
+def legacy_read_image(fname):
+    img = io.imread(fname)
+    if len(img.shape) > 2:
+        try:
+            img = color.rgb2gray(img)
+        except ValueError:
+            img = img[:,:,0]
+    if img.dtype != np.uint8:
+        img = np.uint8(255/np.max(img) * img)
+    return img
+
+loader = {'legacy': legacy_read_image, 'read_image': read_image,
+          'read_image_gray': lambda fname: read_image(fname, gray=True)}[sys.argv[1]]
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+t = time.perf_counter()
+img = loader(sys.argv[2])
+seconds = time.perf_counter() - t
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({'seconds': seconds, 'peak_mb': (peak - before) / 1024,
+                  'output_mb': img.nbytes / 2**20}))
+'''
+
+def make_tiff(fname, megapixels, dtype, channels):
+    import tifffile
+    side = int(np.sqrt(megapixels * 1e6))
+    shape = (side, side) if channels == 1 else (side, side, channels)
+    # Write a row band at a time so the benchmark itself stays small
+    out = tifffile.memmap(fname, shape=shape, dtype=dtype)
+    rng = np.random.default_rng(0)
+    hi = np.iinfo(dtype).max
+    for y in range(0, side, 1024):
+        out[y:y + 1024] = rng.integers(0, hi, size=out[y:y + 1024].shape, dtype=dtype)
+    out.flush()
+    del out
+
+def measure(loader, fname):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([str(ROOT), env.get('PYTHONPATH', '')])
+    proc = subprocess.run([sys.executable, '-c', LOAD_SCRIPT, loader, str(fname)],
+                          cwd=ROOT, env=env, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr)
+    return json.loads(proc.stdout.splitlines()[-1])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark image loading')
+    parser.add_argument('--megapixels', type=float, nargs='+', default=[25, 100])
+    parser.add_argument('--out', help='write results to this json file')
+    args = parser.parse_args(argv)
+
+    cases = [('gray uint8', np.uint8, 1), ('gray uint16', np.uint16, 1),
+             ('rgb uint8', np.uint8, 3)]
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for mp in args.megapixels:
+            for name, dtype, channels in cases:
+                fname = Path(tmp) / 'image.tif'
+                make_tiff(fname, mp, dtype, channels)
+                for loader in ['legacy', 'read_image', 'read_image_gray']:
+                    r = measure(loader, fname)
+                    r.update(megapixels=mp, image=name, loader=loader)
+                    results.append(r)
+                    print(f'{mp:6.0f} MP {name:12s} {loader:15s} {r["seconds"]:7.2f} s '
+                          f'{r["peak_mb"]:9.0f} MB peak ({r["output_mb"]:.0f} MB output)')
+                os.remove(fname)
+
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
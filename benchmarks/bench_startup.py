@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# Startup benchmark for align.py
+#
+# Times importing each module in a fresh interpreter (so nothing is already
+# cached) and how long it takes to get the main window on screen, and checks
+# which heavy modules have been loaded by then. Results are written as json,
+# and compared against a baseline if one is given:
+#
+#   python benchmarks/bench_startup.py --out startup.json
+#   python benchmarks/bench_startup.py --baseline startup.json
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+MODULES = ['numpy', 'PyQt5.QtWidgets', 'pyqtgraph', 'cv2', 'skimage.io',
+           'skimage.color', 'tifffile', 'scipy.spatial',
+           'points', 'solver', 'transformations', 'image_io', 'ImagePlot', 'align']
+
+# Should not be imported until they are first used
+LAZY_MODULES = ['cv2', 'skimage', 'scipy', 'tifffile']
+
+WINDOW_SCRIPT = '''
+import json, sys, time
+t = time.perf_counter()
+from PyQt5.QtWidgets import QApplication
+import align
+app = QApplication([])
+win = align.Window()
+win.show()
+app.processEvents()
+shown = time.perf_counter() - t
+lazy = json.loads(sys.argv[1])
+print(json.dumps({'seconds': shown,
+                  'loaded': [m for m in lazy if m in sys.modules]}))
+'''
+
+def run_python(args):
+    env = dict(os.environ)
+    env.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    env['PYTHONPATH'] = os.pathsep.join([str(ROOT), env.get('PYTHONPATH', '')])
+    return subprocess.run([sys.executable] + args, cwd=ROOT, env=env,
+                          capture_output=True, text=True)
+
+def import_time(module):
+    # -X importtime reports cumulative microseconds for every import, the
+    # line for the module itself is the last one matching its name
+    proc = run_python(['-X', 'importtime', '-c', f'import {module}'])
+    if proc.returncode != 0:
+        return None
+    for line in reversed(proc.stderr.splitlines()):
+        fields = [f.strip() for f in line.split('|')]
+        if len(fields) == 3 and fields[2] == module:
+            return int(fields[1]) / 1e6
+    return None
+
+def window_time():
+    proc = run_python(['-c', WINDOW_SCRIPT, json.dumps(LAZY_MODULES)])
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr)
+    return json.loads(proc.stdout.splitlines()[-1])
+
+def best_of(f, repeat):
+    times = [t for t in (f() for _ in range(repeat)) if t is not None]
+    return min(times) if times else None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark align.py startup')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per measurement, the best is kept')
+    parser.add_argument('--out', help='write results to this json file')
+    parser.add_argument('--baseline', help='compare against results in this json file')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed slowdown relative to the baseline (default: 0.25)')
+    args = parser.parse_args(argv)
+
+    results = {'imports': {}}
+    for module in MODULES:
+        t = best_of(lambda: import_time(module), args.repeat)
+        results['imports'][module] = t
+        print(f'{module:20s} {"not installed" if t is None else f"{1000 * t:8.1f} ms"}')
+
+    windows = [window_time() for _ in range(args.repeat)]
+    results['window'] = min(w['seconds'] for w in windows)
+    results['loaded_at_show'] = windows[0]['loaded']
+    print(f'{"window shown":20s} {1000 * results["window"]:8.1f} ms')
+    if results['loaded_at_show']:
+        print(f'Loaded before the window was shown: {", ".join(results["loaded_at_show"])}')
+
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    failed = bool(results['loaded_at_show'])
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        checks = [('window shown', baseline.get('window'), results['window'])]
+        checks += [(m, baseline['imports'].get(m), t) for m, t in results['imports'].items()]
+        for name, old, new in checks:
+            if old is not None and new is not None and new > old * (1 + args.tolerance):
+                print(f'REGRESSION {name}: {1000 * old:.1f} ms -> {1000 * new:.1f} ms')
+                failed = True
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
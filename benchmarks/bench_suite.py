@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# Benchmarks for the load -> align -> overlay -> save hot path
+#
+# Builds synthetic reference/image pairs related by a known transform, for
+# every size, dtype and channel count asked for, and times (and records the
+# peak Python memory of) each stage:
+#
+#   load          ImagePlot.setImage from an uncompressed TIFF
+#   transform_5pt / transform_2pt
+#   overlay       ImagePlot.overlayImage
+#   save_full, save_crop, save_negative_roi, save_oversized
+#                 the ImagePlot.saveImage branches
+#
+# Peak memory is what tracemalloc sees, numpy arrays and Python objects, but
+# not buffers cv2 allocates itself (bench_load.py measures RSS). The solved
+# transforms are checked against the known one, exiting with 1 if they are
+# off by more than --max-error-px anywhere on the image.
+#
+# Runs headless (Qt offscreen). Results are written as json, and compared
+# against a baseline if one is given, exiting with 1 on any regression:
+#
+#   python benchmarks/bench_suite.py --sizes 1 25 --out baseline.json
+#   python benchmarks/bench_suite.py --sizes 1 25 --baseline baseline.json
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# Known transform taking the image onto the reference
+THETA = np.deg2rad(3)
+TRUE_TRANSFORM = np.array([[1.02 * np.cos(THETA), -1.02 * np.sin(THETA), 12.5],
+                           [1.02 * np.sin(THETA), 1.02 * np.cos(THETA), -7.25],
+                           [0, 0, 1]])
+
+def make_pair(megapixels, dtype, channels, seed=0):
+    # Smooth random texture, made at 1/8 size and scaled up to save time
+    import cv2
+    side = int(np.sqrt(megapixels * 1e6))
+    rng = np.random.default_rng(seed)
+    small = rng.random((max(side // 8, 2), max(side // 8, 2)) + ((channels,) if channels > 1 else ()))
+    reference = cv2.resize(small.astype(np.float32), (side, side), interpolation=cv2.INTER_CUBIC)
+    reference = np.clip(reference, 0, 1) * np.iinfo(dtype).max
+    reference = reference.astype(dtype)
+    image = cv2.warpAffine(reference, np.linalg.inv(TRUE_TRANSFORM)[:2], (side, side))
+
+    ref_pts = rng.uniform(0.2 * side, 0.8 * side, (5, 2))
+    ones = np.ones((5, 1))
+    trans_pts = (np.hstack([ref_pts, ones]) @ np.linalg.inv(TRUE_TRANSFORM).T)[:, :2]
+    return reference, image, ref_pts, trans_pts
+
+def measure(f):
+    # Returns f's result, the time it took and the peak memory it allocated
+    # through Python (numpy included, cv2's own buffers not)
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    t = time.perf_counter()
+    result = f()
+    seconds = time.perf_counter() - t
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak / 2**20
+
+def transform_error(A, side):
+    # Largest distance (in reference pixels) between where A and the known
+    # transform put the image's corners and center
+    pts = np.array([[0, 0], [side, 0], [0, side], [side, side], [side / 2, side / 2]])
+    ones = np.ones((len(pts), 1))
+    a = np.hstack([pts, ones]) @ np.asarray(A).T
+    b = np.hstack([pts, ones]) @ TRUE_TRANSFORM.T
+    return float(np.max(np.linalg.norm(a[:, :2] / a[:, 2:] - b[:, :2] / b[:, 2:], axis=1)))
+
+def wait_for_pyramids(plots):
+    # Pyramids build in the background, don't let them bleed into the next
+    # measurement
+    for plot in plots:
+        for pyramid in plot.pyramids:
+            while not pyramid.done:
+                time.sleep(0.01)
+
+def run_case(app, tmp, megapixels, dtype, channels):
+    import tifffile
+    from ImagePlot import ImagePlot
+    from transformations import transform_5pt, transform_2pt, estimate_transform
+
+    reference, image, ref_pts, trans_pts = make_pair(megapixels, dtype, channels)
+    ref_fname = str(Path(tmp) / 'reference.tif')
+    image_fname = str(Path(tmp) / 'image.tif')
+    tifffile.imwrite(ref_fname, reference)
+    tifffile.imwrite(image_fname, image)
+    del reference, image
+
+    ref_plot, image_plot, aligned_plot = ImagePlot(), ImagePlot(), ImagePlot(use_roi=True)
+    results = {}
+
+    def record(stage, f):
+        result, seconds, peak_mb = measure(f)
+        app.processEvents()
+        results[stage] = {'seconds': seconds, 'peak_py_mb': peak_mb}
+        return result
+
+    record('load', lambda: image_plot.setImage(image_fname))
+    ref_plot.setImage(ref_fname)
+    wait_for_pyramids([ref_plot, image_plot])
+
+    ref, img = ref_plot.image, image_plot.image
+    out_size = ref.shape[1::-1]
+    aligned = record('transform_5pt', lambda: transform_5pt(img, ref_pts, trans_pts, out_size))
+    record('transform_2pt', lambda: transform_2pt(img, ref_pts[:2], trans_pts[:2], out_size))
+    # The solves are exact for the known (similarity) transform
+    side = ref.shape[0]
+    results['transform_5pt']['error_px'] = transform_error(
+        estimate_transform(ref_pts, trans_pts)[0], side)
+    results['transform_2pt']['error_px'] = transform_error(
+        estimate_transform(ref_pts[:2], trans_pts[:2])[0], side)
+    # and the aligned image should land back on the reference (in intensity
+    # units, for reference)
+    error = np.abs(aligned[100:-100, 100:-100].astype(float) - ref[100:-100, 100:-100]).mean()
+    results['transform_5pt']['mean_abs_intensity_error'] = error
+
+    aligned_plot.setImage(aligned, disp=False)
+    record('overlay', lambda: aligned_plot.overlayImage(ref))
+    wait_for_pyramids([aligned_plot])
+
+    out = str(Path(tmp) / 'aligned.tif')
+    crops = {'save_full': (None, None),
+             'save_crop': (np.array([side / 4, side / 4]), np.array([side / 2, side / 2])),
+             'save_negative_roi': (np.array([-side / 8, -side / 8]), np.array([side / 2, side / 2])),
+             'save_oversized': (np.array([side / 2, side / 2]), np.array([side, side]))}
+    for stage, (c_pos, c_size) in crops.items():
+        record(stage, lambda: aligned_plot.saveImage(out, c_pos, c_size))
+
+    for plot in (ref_plot, image_plot, aligned_plot):
+        plot.clearItems()
+        plot.deleteLater()
+    app.processEvents()
+    return results
+
+def compare(results, baseline, tolerance, min_seconds, min_mb):
+    # Regressions beyond a relative tolerance, ignoring tiny absolute changes
+    base = {(r['stage'], r['megapixels'], r['dtype'], r['channels']): r for r in baseline}
+    regressions = []
+    for r in results:
+        old = base.get((r['stage'], r['megapixels'], r['dtype'], r['channels']))
+        if old is None:
+            continue
+        if r['seconds'] > old['seconds'] * (1 + tolerance) and r['seconds'] - old['seconds'] > min_seconds:
+            regressions.append(f"{r['case']} {r['stage']}: {old['seconds']:.3f} s -> {r['seconds']:.3f} s")
+        if 'peak_py_mb' not in old:
+            # Baselines from before the memory was labeled
+            continue
+        if r['peak_py_mb'] > old['peak_py_mb'] * (1 + tolerance) \
+                and r['peak_py_mb'] - old['peak_py_mb'] > min_mb:
+            regressions.append(f"{r['case']} {r['stage']}: {old['peak_py_mb']:.0f} MB -> "
+                               f"{r['peak_py_mb']:.0f} MB")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark load, align, overlay and save')
+    parser.add_argument('--sizes', type=float, nargs='+', default=[1, 25, 100],
+                        help='image sizes in megapixels (up to 400)')
+    parser.add_argument('--dtypes', nargs='+', default=['uint8', 'uint16'])
+    parser.add_argument('--channels', type=int, nargs='+', default=[1, 3])
+    parser.add_argument('--out', help='write results to this json file')
+    parser.add_argument('--baseline', help='compare against results in this json file')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed relative slowdown / memory growth (default: 0.25)')
+    parser.add_argument('--min-seconds', type=float, default=0.005,
+                        help='ignore slowdowns smaller than this (default: 0.005)')
+    parser.add_argument('--min-mb', type=float, default=1,
+                        help='ignore memory growth smaller than this (default: 1)')
+    parser.add_argument('--max-error-px', type=float, default=0.5,
+                        help='fail if a solved transform is off by more than this (default: 0.5)')
+    args = parser.parse_args(argv)
+
+    from PyQt5.QtWidgets import QApplication
+    import image_io
+    app = QApplication.instance() or QApplication([])
+    # Pick the tif encoder up front, so its one off benchmark isn't timed
+    image_io.fastest_encoder('.tif')
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for mp in args.sizes:
+            for dtype in args.dtypes:
+                for channels in args.channels:
+                    case = f'{mp:g}MP {dtype} {"gray" if channels == 1 else f"{channels}ch"}'
+                    for stage, r in run_case(app, tmp, mp, np.dtype(dtype).type, channels).items():
+                        r.update(case=case, stage=stage, megapixels=mp, dtype=dtype, channels=channels)
+                        results.append(r)
+                        print(f'{case:22s} {stage:18s} {r["seconds"]:8.3f} s '
+                              f'{r["peak_py_mb"]:9.1f} MB (python)')
+
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    failed = [r for r in results if 'error_px' in r and r['error_px'] > args.max_error_px]
+    for r in failed:
+        print(f"WRONG {r['case']} {r['stage']}: off by {r['error_px']:.3f} px")
+    if failed:
+        print(f'{len(failed)} solves off by more than {args.max_error_px} px')
+        return 1
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance, args.min_seconds, args.min_mb)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            print(f'{len(regressions)} regressions against {args.baseline}')
+            return 1
+        print(f'No regressions against {args.baseline}')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
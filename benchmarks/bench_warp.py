@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# Thread scaling of the strip tiled warp engine (warp.warp)
+#
+#   python benchmarks/bench_warp.py --megapixels 100 --threads 1 2 4 8
+#
+# OpenCV's own threading is turned off while timing unless --cv2-threads is
+# given, so the numbers show the strip pool alone.
+
+import argparse
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from warp import warp
+
+def best_time(f, repeat):
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - t)
+    return min(times)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark warp thread scaling')
+    parser.add_argument('--megapixels', type=float, nargs='+', default=[25, 100])
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--cv2-threads', type=int, default=1,
+                        help='cv2.setNumThreads while timing (default: 1)')
+    parser.add_argument('--out', help='write results to this json file')
+    args = parser.parse_args(argv)
+
+    import cv2
+    cv2.setNumThreads(args.cv2_threads)
+    print(f'{os.cpu_count()} cpus, cv2 threads {cv2.getNumThreads()}')
+
+    A = np.array([[0.98, 0.05, 30], [-0.04, 1.01, -20], [0, 0, 1]])
+    results = []
+    for mp in args.megapixels:
+        side = int(np.sqrt(mp * 1e6))
+        img = np.random.default_rng(0).integers(0, 255, (side, side), dtype=np.uint8)
+        out = np.empty_like(img)
+        single = best_time(lambda: cv2.warpPerspective(img, A, (side, side)), args.repeat)
+        print(f'{mp:6.0f} MP  cv2.warpPerspective          {single:7.3f} s')
+        base = None
+        for threads in args.threads:
+            t = best_time(lambda: warp(img, A, (side, side), out=out, threads=threads), args.repeat)
+            base = base or t
+            results.append({'megapixels': mp, 'threads': threads, 'seconds': t,
+                            'speedup': base / t, 'warpPerspective': single})
+            print(f'{mp:6.0f} MP  warp, {threads} threads {"":10s} {t:7.3f} s  x{base / t:.2f}')
+
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+# On-disk cache of decoded images and warped outputs
+#
+# Entries are .npy files named after a key, a hash of the source file's
+# fingerprint (its path, size, modification time and first and last
+# FINGERPRINT_BYTES, so multi GB files aren't read just to look them up) and
+# of whatever else went into the array (load options, or the transform,
+# output size and crop of a warp). Hits are memory mapped, so
+# they load without decoding or copying. The cache is kept under max_bytes by
+# deleting the least recently used entries (a hit touches its file's mtime),
+# and can be shared by any number of processes.
+#
+#   image = image_cache.read(fname)      # decoded once, mapped after that
+#   aligned = image_cache.warp(image, 'affine', A, None, out_size)
+#
+# Off until enabled (File > Disk Cache in the gui, batch.py with --cache).
+
+import hashlib
+import logging
+import os
+import threading
+import uuid
+import weakref
+from pathlib import Path
+
+import numpy as np
+
+from timing import span
+
+# Bumped whenever the meaning of cached arrays changes
+CACHE_VERSION = 1
+
+enabled = False
+directory = Path(os.environ.get('MANUALALIGN_CACHE_DIR',
+                                Path.home() / '.cache' / 'ManualAlign'))
+max_bytes = 8 << 30
+FINGERPRINT_BYTES = 1 << 20
+
+_lock = threading.Lock()
+# (path, size, mtime) -> fingerprint, so files are only read once per session
+_file_hashes = {}
+# id(array) -> (weak reference to array, key) of the arrays read() returned,
+# for warp_key
+_sources = {}
+
+def make_key(*parts):
+    # Hash of parts, arrays by their dtype, shape and contents
+    h = hashlib.blake2b(str(CACHE_VERSION).encode(), digest_size=20)
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            part = np.ascontiguousarray(part)
+            h.update(f'{part.dtype}{part.shape}'.encode())
+            h.update(part.tobytes())
+        else:
+            h.update(repr(part).encode())
+        h.update(b'\0')
+    return h.hexdigest()
+
+def source_hash(fname):
+    stat = os.stat(fname)
+    memo = (str(Path(fname).resolve()), stat.st_size, stat.st_mtime_ns)
+    if memo not in _file_hashes:
+        h = hashlib.blake2b(repr(memo).encode(), digest_size=20)
+        with open(fname, 'rb') as f:
+            h.update(f.read(FINGERPRINT_BYTES))
+            if stat.st_size > FINGERPRINT_BYTES:
+                f.seek(max(FINGERPRINT_BYTES, stat.st_size - FINGERPRINT_BYTES))
+                h.update(f.read())
+        _file_hashes[memo] = h.hexdigest()
+    return _file_hashes[memo]
+
+def _path(key):
+    return directory / f'{key}.npy'
+
+def get(key):
+    # Memory mapped (read only) array, or None
+    if not enabled or key is None:
+        return None
+    path = _path(key)
+    try:
+        with span('cache_get', key=key):
+            array = np.load(path, mmap_mode='r', allow_pickle=False)
+        os.utime(path)
+    except (OSError, ValueError):
+        return None
+    return array
+
+def put(key, array):
+    # Stores array, returns its cached copy (or array if the cache is off)
+    if not enabled or key is None:
+        return array
+    directory.mkdir(parents=True, exist_ok=True)
+    path = _path(key)
+    # Written under a temporary name so other processes never see a partial
+    # entry
+    tmp = directory / f'{key}.{uuid.uuid4().hex}.tmp'
+    try:
+        with span('cache_put', key=key, bytes=int(array.nbytes)):
+            # Through a file object, so np.save doesn't add .npy
+            with open(tmp, 'wb') as f:
+                np.save(f, np.ascontiguousarray(array), allow_pickle=False)
+            os.replace(tmp, path)
+    except OSError as e:
+        logging.warning(f'Could not cache {key}: {e}')
+        tmp.unlink(missing_ok=True)
+        return array
+    evict()
+    cached = get(key)
+    return array if cached is None else cached
+
+def cached(key, compute, store=True):
+    # get(key), or compute(), stored under key unless store is False
+    array = get(key)
+    if array is None:
+        array = compute()
+        if store:
+            array = put(key, array)
+    return array
+
+def evict(keep_bytes=None):
+    # Deletes least recently used entries until the cache is at most
+    # keep_bytes (max_bytes by default) large
+    keep_bytes = max_bytes if keep_bytes is None else keep_bytes
+    with _lock:
+        try:
+            entries = [(e.stat().st_mtime, e.stat().st_size, e.path)
+                       for e in os.scandir(directory) if e.name.endswith('.npy')]
+        except OSError:
+            return
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= keep_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                # Still in use (on Windows), or removed by another process
+                pass
+
+def clear():
+    evict(0)
+
+def size():
+    # Bytes used by the cache
+    try:
+        return sum(e.stat().st_size for e in os.scandir(directory) if e.name.endswith('.npy'))
+    except OSError:
+        return 0
+
+def remember(array, key):
+    # Marks array as the contents of key, so warps of it can be cached
+    with _lock:
+        # Arrays that are gone are forgotten, their ids get reused
+        for i in [i for i, (ref, _) in _sources.items() if ref() is None]:
+            del _sources[i]
+        _sources[id(array)] = (weakref.ref(array), key)
+
+def source_key(array):
+    # Key of an array read() returned, None for any other array
+    with _lock:
+        entry = _sources.get(id(array))
+    return entry[1] if entry is not None and entry[0]() is array else None
+
+def read(fname, progress=None, gray=False):
+    # image_io.read_image, through the cache
+    from image_io import read_image
+    if not enabled:
+        return read_image(fname, progress, gray)
+    key = make_key('image', source_hash(fname), gray)
+    image = get(key)
+    if image is None:
+        image = put(key, read_image(fname, progress, gray))
+    remember(image, key)
+    return image
+
+def warp_key(image, model, params, out_size, c_pos=None, c_size=None):
+    # Key of image warped with model, params being the matrix for 'affine'
+    # and (ref_pts, trans_pts) for the non-rigid models. None if image didn't
+    # come from read()
+    source = source_key(image)
+    if source is None:
+        return None
+    params = [np.asarray(p, dtype=np.float64) for p in
+              ((params,) if model == 'affine' else params)]
+    crop = None if c_pos is None or c_size is None else \
+        tuple(int(v) for v in (*c_pos, *c_size))
+    return make_key('warp', source, model, *params, tuple(int(v) for v in out_size), crop)
+
+def warp(image, model, A, points, out_size, c_pos=None, c_size=None, store=True, threads=None):
+    # image aligned onto an out_size (width, height) reference with model, A
+    # being the matrix for 'affine' and points (ref_pts, trans_pts) otherwise,
+    # and cropped if c_pos and c_size are given. Crops are cut out of the full
+    # warp if that is cached, so moving the roi doesn't warp again. With
+    # store False a warp is only looked up, not written. threads is passed on
+    # to the affine warps
+    from transformations import warp_image, warp_crop, crop_image
+    from nonrigid import warp_nonrigid
+    params = A if model == 'affine' else points
+    key = warp_key(image, model, params, out_size)
+    crop = c_pos is not None and c_size is not None
+    if crop:
+        full = get(key)
+        if full is not None:
+            return crop_image(full, c_pos, c_size)
+        key = warp_key(image, model, params, out_size, c_pos, c_size)
+    if model != 'affine':
+        return cached(key, lambda: warp_nonrigid(image, *points, out_size, model, c_pos, c_size),
+                      store)
+    if crop:
+        return cached(key, lambda: warp_crop(image, A, out_size, c_pos, c_size, threads=threads),
+                      store)
+    return cached(key, lambda: warp_image(image, A, out_size, threads=threads), store)
@@ -0,0 +1,288 @@
+# Image loading and saving shared by the gui and the headless tools
+# (skimage, tifffile, cv2 and the encoders are slow to import, so they are
+# only imported when used)
+
+import numpy as np
+import logging
+import math
+import sys
+from pathlib import Path
+from timing import span, image_fields, file_bytes
+
+IMAGE_SUFFIXES = {'.png', '.xpm', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp'}
+# Every encoder writes with these, so which one 'auto' picks doesn't change
+# the output. TIFFs are uncompressed
+JPEG_QUALITY = 95
+PNG_COMPRESSION = 1
+
+# Same weights as skimage.color.rgb2gray
+GRAY_WEIGHTS = np.array([0.2125, 0.7154, 0.0721])
+# Pixels converted at a time, the working set is a few float64 copies of this
+CHUNK_PIXELS = 1 << 20
+
+def _chunks(n_rows, n_cols):
+    step = max(1, CHUNK_PIXELS // max(n_cols, 1))
+    for y in range(0, n_rows, step):
+        yield slice(y, min(y + step, n_rows))
+
+def _gray_chunk(img, rows):
+    if img.ndim == 2:
+        return img[rows].astype(np.float64)
+    return img[rows, :, :3] @ GRAY_WEIGHTS
+
+def to_gray_uint8(img, progress=None):
+    # 8 bit grayscale copy of img, for feature matching and for read_image's
+    # gray option. RGB(A) is converted with the rgb2gray weights and anything
+    # that isn't already uint8 is scaled so its maximum is 255. This is done a
+    # chunk of rows at a time, straight into the output buffer, so img can be a
+    # memory map of the file.
+    # progress, if given, is called with the fraction done after every chunk
+    if img.ndim > 2 and img.shape[2] not in (3, 4):
+        # Not RGB, keep the first channel
+        img = img[:, :, 0]
+
+    if img.ndim == 2 and img.dtype == np.uint8:
+        return np.array(img) if isinstance(img, np.memmap) else img
+
+    out = np.empty(img.shape[:2], dtype=np.uint8)
+    img_max = max(float(np.max(_gray_chunk(img, rows))) for rows in _chunks(*out.shape))
+    scale = 255 / img_max if img_max > 0 else 0
+    for rows in _chunks(*out.shape):
+        chunk = _gray_chunk(img, rows)
+        chunk *= scale
+        out[rows] = chunk
+        if progress is not None:
+            progress(rows.stop / out.shape[0])
+    return out
+
+def _memmap_tiff(fname):
+    # Returns None if the file can't be memory mapped (compressed, tiled,
+    # planar RGB, ...)
+    import tifffile
+    try:
+        img = tifffile.memmap(fname, page=0, mode='r')
+    except ValueError:
+        return None
+    if img.ndim == 3 and img.shape[0] in (3, 4) and img.shape[2] not in (3, 4):
+        return None
+    return img
+
+def _read_cv2(fname):
+    # skimage reads 16 bit RGB(A) pngs as 8 bit, cv2 doesn't. None if cv2
+    # can't read the file
+    try:
+        import cv2
+    except ImportError:
+        return None
+    if not Path(fname).is_file():
+        return None
+    img = cv2.imread(str(fname), cv2.IMREAD_UNCHANGED)
+    if img is not None and img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB if img.shape[2] == 3 else cv2.COLOR_BGRA2RGBA)
+    return img
+
+def _to_array(img, progress=None):
+    # Images are kept as they were stored, just in memory and (height, width)
+    # or (height, width, channels)
+    if img.ndim == 3 and img.shape[2] == 1:
+        img = img[:, :, 0]
+    elif img.ndim == 3 and img.shape[0] in (3, 4) and img.shape[2] not in (3, 4):
+        # Planar RGB
+        img = img.transpose(1, 2, 0)
+    if not isinstance(img, np.memmap) and img.flags.c_contiguous:
+        return img
+    out = np.empty(img.shape, dtype=img.dtype)
+    for rows in _chunks(img.shape[0], img.shape[1]):
+        out[rows] = img[rows]
+        if progress is not None:
+            progress(rows.stop / out.shape[0])
+    return out
+
+def read_image(fname, progress=None, gray=False):
+    # Returns the image with its own dtype and channels, or as 8 bit
+    # grayscale with gray (see to_gray_uint8)
+    with span('load', path=str(fname), file_bytes=file_bytes(fname)) as fields:
+        img = None
+        suffix = Path(fname).suffix.lower()
+        if suffix in ('.tif', '.tiff'):
+            img = _memmap_tiff(fname)
+        elif suffix == '.png':
+            img = _read_cv2(fname)
+        if img is None:
+            from skimage import io
+            img = io.imread(fname)
+        elif isinstance(img, np.memmap):
+            logging.info(f'Memory mapped {fname}')
+        fields.update(image_fields(img, 'decoded_'))
+        img = to_gray_uint8(img, progress) if gray else _to_array(img, progress)
+        fields.update(image_fields(img))
+    return img
+
+def _write_tifffile(fname, image):
+    import tifffile
+    if channels(image) in (1, 3, 4):
+        tifffile.imwrite(fname, image, compression=None)
+    else:
+        # Otherwise the last axis would be taken for the image width
+        tifffile.imwrite(fname, image, photometric='minisblack', planarconfig='contig',
+                         compression=None)
+
+def _write_cv2(fname, image):
+    import cv2
+    # cv2 writes BGR(A)
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR if image.shape[2] == 3
+                             else cv2.COLOR_RGBA2BGRA)
+    params = {'.jpg': [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY],
+              '.jpeg': [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY],
+              '.png': [cv2.IMWRITE_PNG_COMPRESSION, PNG_COMPRESSION],
+              # cv2 would use LZW
+              '.tif': [cv2.IMWRITE_TIFF_COMPRESSION, 1],
+              '.tiff': [cv2.IMWRITE_TIFF_COMPRESSION, 1]}
+    if not cv2.imwrite(fname, image, params.get(Path(fname).suffix.lower(), [])):
+        raise IOError(f'cv2 could not write {fname}')
+
+def _write_pillow(fname, image):
+    from PIL import Image
+    # Pillow's defaults are quality 75 and compression 6
+    Image.fromarray(image).save(fname, quality=JPEG_QUALITY, compress_level=PNG_COMPRESSION)
+
+def _write_qt(fname, image):
+    # QImage is reentrant, so unlike QPixmap this is fine off the gui thread
+    from PyQt5.QtGui import QImage
+    formats = {('uint8', 1): QImage.Format_Grayscale8, ('uint8', 3): QImage.Format_RGB888,
+               ('uint8', 4): QImage.Format_RGBA8888, ('uint16', 1): QImage.Format_Grayscale16}
+    image = np.ascontiguousarray(image)
+    qimage = QImage(image.data, image.shape[1], image.shape[0], image.strides[0],
+                    formats[(image.dtype.name, channels(image))])
+    if Path(fname).suffix.lower() == '.png':
+        # Qt takes the zlib level as a quality, level = (100 - quality) * 9 // 91
+        quality = 100 - math.ceil(PNG_COMPRESSION * 91 / 9)
+    else:
+        quality = JPEG_QUALITY
+    if not qimage.save(fname, None, quality):
+        raise IOError(f'Qt could not write {fname}')
+
+ENCODERS = {'tifffile': _write_tifffile, 'cv2': _write_cv2,
+            'pillow': _write_pillow, 'qt': _write_qt}
+ENCODER_SUFFIXES = {
+    'tifffile': {'.tif', '.tiff'},
+    'cv2': {'.tif', '.tiff', '.png', '.jpg', '.jpeg', '.bmp'},
+    'pillow': {'.tif', '.tiff', '.png', '.jpg', '.jpeg', '.bmp'},
+    'qt': {'.tif', '.tiff', '.png', '.jpg', '.jpeg', '.bmp', '.xpm'},
+}
+ENCODER_MODULES = {'tifffile': 'tifffile', 'cv2': 'cv2', 'pillow': 'PIL', 'qt': 'PyQt5.QtGui'}
+# Encoder used by write_image, 'auto' picks the fastest one for the format
+encoder = 'auto'
+# Encoders for each suffix, fastest first
+_encoder_ranking = {}
+
+def channels(image):
+    return 1 if image.ndim == 2 else image.shape[2]
+
+def supports(name, suffix, image):
+    # Whether encoder name writes image to a suffix file as it is (dtype and
+    # channels). tifffile writes anything
+    suffix = suffix.lower()
+    n = channels(image)
+    if suffix not in ENCODER_SUFFIXES[name]:
+        return False
+    if name == 'tifffile':
+        return True
+    if image.dtype == np.uint8:
+        return n in (1, 3) or (n == 4 and suffix not in ('.jpg', '.jpeg', '.bmp'))
+    if image.dtype == np.uint16 and suffix in ('.tif', '.tiff', '.png'):
+        return n in (1, 3, 4) if name == 'cv2' else n == 1
+    if image.dtype == np.float32 and suffix in ('.tif', '.tiff'):
+        return name == 'cv2' and n == 1
+    return False
+
+def available_encoders(suffix):
+    import importlib
+    names = []
+    for name, suffixes in ENCODER_SUFFIXES.items():
+        # Qt is only considered once it's loaded, headless tools never use it
+        if suffix.lower() not in suffixes or (name == 'qt' and 'PyQt5' not in sys.modules):
+            continue
+        try:
+            importlib.import_module(ENCODER_MODULES[name])
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+def benchmark_encoders(suffix, image=None, repeat=3):
+    # Seconds to write image (a 1024x1024 gradient by default) with every
+    # available encoder for suffix
+    import tempfile
+    import time
+    if image is None:
+        image = np.add.outer(np.arange(1024), np.arange(1024)).astype(np.uint8)
+    times = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = str(Path(tmp) / f'benchmark{suffix}')
+        for name in available_encoders(suffix):
+            try:
+                best = None
+                for _ in range(repeat):
+                    t = time.perf_counter()
+                    ENCODERS[name](fname, image)
+                    elapsed = time.perf_counter() - t
+                    best = elapsed if best is None else min(best, elapsed)
+                times[name] = best
+            except Exception as e:
+                logging.warning(f'{name} can not write {suffix} files: {e}')
+    return times
+
+def fastest_encoder(suffix, image=None):
+    # Fastest encoder for suffix files, that can write image if one is given
+    suffix = suffix.lower()
+    if suffix not in _encoder_ranking:
+        times = benchmark_encoders(suffix)
+        if not times:
+            raise IOError(f'No encoder available for {suffix} files')
+        _encoder_ranking[suffix] = sorted(times, key=times.get)
+        logging.info(f'Using {_encoder_ranking[suffix][0]} to write {suffix} files ({times})')
+    for name in _encoder_ranking[suffix]:
+        if image is None or supports(name, suffix, image):
+            return name
+    raise IOError(f'No encoder can write {image.dtype} images with {channels(image)} '
+                  f'channels to {suffix} files')
+
+def to_writable(image, suffix):
+    # 8 bit copy of image with 1, 3 or 4 channels (3 for jpg and bmp), for
+    # formats that can't store it as it is. Unsigned integers keep their top
+    # 8 bits, anything else is scaled so its maximum is 255
+    n = channels(image)
+    if n not in (1, 3, 4) or (n == 4 and suffix.lower() in ('.jpg', '.jpeg', '.bmp')):
+        image = image[:, :, :3] if n >= 3 else image[:, :, 0]
+    if image.dtype == np.uint8:
+        return image
+    if image.dtype.kind == 'u':
+        return (image >> (8 * image.dtype.itemsize - 8)).astype(np.uint8)
+    image = np.maximum(image.astype(np.float32), 0)
+    image_max = float(image.max())
+    image *= 255 / image_max if image_max > 0 else 0
+    return image.astype(np.uint8)
+
+def write_image(fname, image, backend=None):
+    fname = str(fname)
+    suffix = Path(fname).suffix
+    backend = backend or encoder
+    if not any(supports(name, suffix, image) for name in available_encoders(suffix)):
+        # Like 16 bit RGB to a jpg
+        converted = to_writable(image, suffix)
+        logging.warning(f'No encoder can write {image.dtype} images with {channels(image)} '
+                        f'channels to {suffix} files, saving {fname} as {converted.dtype} '
+                        f'with {channels(converted)} channels')
+        image = converted
+    if backend != 'auto' and not supports(backend, suffix, image):
+        logging.warning(f'{backend} can not write {image.dtype} images with {channels(image)} '
+                        f'channels to {suffix} files, using another encoder')
+        backend = 'auto'
+    if backend == 'auto':
+        backend = fastest_encoder(suffix, image)
+    with span('save', path=fname, encoder=backend, **image_fields(image)) as fields:
+        ENCODERS[backend](fname, image)
+        fields['file_bytes'] = file_bytes(fname)
+    logging.info(f'Saved image to {fname} ({backend})')
@@ -0,0 +1,91 @@
+# Alignment quality, to check pairs (or thousands of batch results) by number
+# instead of by eye
+#
+#   residuals   per matched point, how far the fitted matrix puts the image
+#               point from its reference point, in reference pixels
+#   rms         root mean square of the residuals, max_error their maximum
+#   ncc         normalized cross correlation of the aligned image and the
+#               reference, from -1 to 1
+#   mi          their mutual information, in bits
+#
+# The image scores are computed on a strided sample of at most max_size
+# pixels a side (of the crop, if there is one), so they take milliseconds even
+# on full resolution images. Pixels that are zero in the aligned image are
+# left out, they are mostly outside of the warped image.
+
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from timing import span
+
+FIELDS = ['rms', 'max_error', 'ncc', 'mi']
+MI_BINS = 32
+
+@dataclass
+class Metrics:
+    residuals: np.ndarray = field(default_factory=lambda: np.empty(0))
+    rms: float = np.nan
+    max_error: float = np.nan
+    ncc: float = np.nan
+    mi: float = np.nan
+
+    def values(self):
+        # FIELDS, in order
+        return [self.rms, self.max_error, self.ncc, self.mi]
+
+    def as_dict(self):
+        return dict(zip(FIELDS, (float(v) for v in self.values())))
+
+    def summary(self):
+        return (f'RMS {self.rms:.2f} px, max {self.max_error:.2f} px, '
+                f'NCC {self.ncc:.3f}, MI {self.mi:.2f} bits')
+
+def _sample(image, max_size):
+    # Strided float32 gray view of image, RGB(A) by its mean
+    step = max(1, int(np.ceil(max(image.shape[:2]) / max_size)))
+    sample = image[::step, ::step]
+    if sample.ndim == 3:
+        sample = sample[:, :, :3].mean(axis=2) if sample.shape[2] in (3, 4) else sample[:, :, 0]
+    return sample.astype(np.float32)
+
+def ncc(a, b):
+    a = a - a.mean()
+    b = b - b.mean()
+    denom = np.sqrt(np.dot(a, a) * np.dot(b, b))
+    return float(np.dot(a, b) / denom) if denom > 0 else np.nan
+
+def mutual_information(a, b, bins=MI_BINS):
+    joint, _, _ = np.histogram2d(a, b, bins=bins)
+    p = joint / joint.sum()
+    px, py = p.sum(axis=1), p.sum(axis=0)
+    nz = p > 0
+    return float(np.sum(p[nz] * np.log2(p[nz] / np.outer(px, py)[nz])))
+
+def similarity(reference, aligned, c_pos=None, c_size=None, max_size=256):
+    # (ncc, mi) of aligned against reference. aligned is either the full
+    # aligned image or, with c_pos and c_size, its crop
+    from transformations import crop_image
+    if c_pos is not None and c_size is not None:
+        reference = crop_image(reference, c_pos, c_size)
+    ref, img = _sample(reference, max_size), _sample(aligned, max_size)
+    if ref.shape != img.shape:
+        raise ValueError(f'Aligned image {aligned.shape} does not match the reference '
+                         f'{reference.shape}')
+    valid = img != 0
+    if valid.sum() < 2:
+        return np.nan, np.nan
+    ref, img = ref[valid], img[valid]
+    return ncc(ref, img), mutual_information(ref, img)
+
+def measure(residuals, reference=None, aligned=None, c_pos=None, c_size=None, max_size=256):
+    # Metrics from the residuals of a solve and, if given, the aligned image
+    with span('metrics', points=len(residuals)):
+        residuals = np.asarray(residuals, dtype=np.float64)
+        m = Metrics(residuals)
+        if len(residuals):
+            m.rms = float(np.sqrt(np.mean(residuals ** 2)))
+            m.max_error = float(residuals.max())
+        if reference is not None and aligned is not None:
+            m.ncc, m.mi = similarity(reference, aligned, c_pos, c_size, max_size)
+    return m
@@ -0,0 +1,216 @@
+# Non-rigid warps, for local distortion an affine transform can't correct
+#
+#   tps         thin-plate spline through the points
+#   piecewise   affine per triangle of a Delaunay triangulation of the points,
+#               and the affine fit to all of them outside of it
+#
+# Both are applied with cv2.remap. The maps give, for every output (reference)
+# pixel, where to sample the image. They are evaluated on a coarse grid every
+# grid_step pixels and upsampled (grid_step=1 evaluates every pixel), then
+# kept in an LRU cache keyed by model, points, output region and grid step,
+# so saving again or warping more images (or frames of a stack) with the
+# same points reuses them.
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from timing import span, image_fields
+
+MODELS = ('tps', 'piecewise')
+MIN_POINTS = {'tps': 3, 'piecewise': 3}
+# Points x grid points evaluated at once
+CHUNK_ELEMENTS = 1 << 22
+# Maps kept in the cache, in bytes (the newest maps are always kept)
+CACHE_BYTES = 1 << 30
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_build_lock = threading.Lock()
+
+def _tps_kernel(r2):
+    # r^2 log r^2 (0 at r = 0), in place
+    np.maximum(r2, np.finfo(r2.dtype).tiny, out=r2)
+    log = np.log(r2)
+    r2 *= log
+    return r2
+
+def _sq_distances(a, b):
+    # Squared distances between every point of a and of b
+    return (a ** 2).sum(axis=1)[:, None] + (b ** 2).sum(axis=1)[None] - 2 * a @ b.T
+
+class ThinPlateSpline:
+    # Maps dst points onto src points, smoothly in between
+    def __init__(self, dst, src, regularization=0):
+        dst = np.asarray(dst, dtype=np.float64)
+        src = np.asarray(src, dtype=np.float64)
+        # Normalized coordinates keep the system well conditioned
+        self.center = dst.mean(axis=0)
+        self.scale = max(dst.std(), 1e-12)
+        self.ctrl = (dst - self.center) / self.scale
+        n = len(dst)
+
+        L = np.zeros((n + 3, n + 3))
+        d2 = ((self.ctrl[:, None] - self.ctrl[None]) ** 2).sum(axis=2)
+        L[:n, :n] = _tps_kernel(d2) + regularization * np.eye(n)
+        L[:n, n] = 1
+        L[:n, n + 1:] = self.ctrl
+        L[n, :n] = 1
+        L[n + 1:, :n] = self.ctrl.T
+        rhs = np.zeros((n + 3, 2))
+        rhs[:n] = src
+        try:
+            self.coef = np.linalg.solve(L, rhs)
+        except np.linalg.LinAlgError:
+            self.coef = np.linalg.lstsq(L, rhs, rcond=None)[0]
+
+    def __call__(self, pts):
+        pts = (np.asarray(pts, dtype=np.float64) - self.center) / self.scale
+        n = len(self.ctrl)
+        out = np.empty((len(pts), 2))
+        chunk = max(1, CHUNK_ELEMENTS // n)
+        for i in range(0, len(pts), chunk):
+            p = pts[i:i + chunk]
+            d2 = _sq_distances(p, self.ctrl)
+            out[i:i + chunk] = _tps_kernel(d2) @ self.coef[:n] + self.coef[n] + p @ self.coef[n + 1:]
+        return out
+
+class PiecewiseAffine:
+    # Maps dst points onto src points with one affine transform per triangle
+    def __init__(self, dst, src):
+        from scipy.spatial import Delaunay
+        from solver import solve_transform
+        self.dst = np.asarray(dst, dtype=np.float64)
+        self.src = np.asarray(src, dtype=np.float64)
+        try:
+            self.tri = Delaunay(self.dst)
+        except RuntimeError as e:
+            # QhullError, for points check_points lets through
+            raise ValueError(f'Cannot triangulate the reference points: {e}') from None
+        # Outside of the triangulation
+        self.outside, _ = solve_transform(self.dst, self.src, model='affine')
+
+    def __call__(self, pts):
+        pts = np.asarray(pts, dtype=np.float64)
+        out = np.empty((len(pts), 2))
+        chunk = max(1, CHUNK_ELEMENTS // 8)
+        for i in range(0, len(pts), chunk):
+            p = pts[i:i + chunk]
+            simplex = self.tri.find_simplex(p)
+            inside = simplex >= 0
+            T = self.tri.transform[simplex[inside]]
+            b = np.einsum('ijk,ik->ij', T[:, :2], p[inside] - T[:, 2])
+            bary = np.column_stack([b, 1 - b.sum(axis=1)])
+            corners = self.src[self.tri.simplices[simplex[inside]]]
+            o = out[i:i + chunk]
+            o[inside] = np.einsum('ij,ijk->ik', bary, corners)
+            o[~inside] = p[~inside] @ self.outside[:2, :2].T + self.outside[:2, 2]
+        return out
+
+def check_points(model, ref_pts, trans_pts):
+    # Raises ValueError if model can't be fit to the points
+    from solver import point_rank
+    if model not in MODELS:
+        raise ValueError(f'Unknown model {model}, should be one of {MODELS}')
+    if len(ref_pts) < MIN_POINTS[model]:
+        raise ValueError(f'{model} needs at least {MIN_POINTS[model]} points, '
+                         f'got {len(ref_pts)}')
+    # Points on one line have no triangles (and the spline no affine part)
+    for pts in (ref_pts, trans_pts):
+        if point_rank(np.asarray(pts, dtype=np.float64)[None])[0] < 2:
+            raise ValueError(f'All points are on one line, {model} can\'t be fit to them')
+
+def make_mapping(model, ref_pts, trans_pts):
+    # Function taking reference coordinates to image coordinates
+    check_points(model, ref_pts, trans_pts)
+    if model == 'tps':
+        return ThinPlateSpline(ref_pts, trans_pts)
+    return PiecewiseAffine(ref_pts, trans_pts)
+
+def remap_maps(model, ref_pts, trans_pts, region, grid_step=8):
+    # cv2.remap maps (converted to the compact fixed point format) for the
+    # output region (x, y, width, height), uncached
+    x0, y0, w, h = (int(v) for v in region)
+    step = max(int(grid_step), 1)
+    with span('maps', model=model, points=len(ref_pts), shape=[h, w], grid_step=step):
+        return _remap_maps(model, ref_pts, trans_pts, x0, y0, w, h, step)
+
+def _remap_maps(model, ref_pts, trans_pts, x0, y0, w, h, step):
+    import cv2
+    mapping = make_mapping(model, ref_pts, trans_pts)
+    if step == 1:
+        gx, gy = np.arange(x0, x0 + w), np.arange(y0, y0 + h)
+    else:
+        # Grid nodes sit where cv2.resize puts the source pixel centers, with
+        # one more node on every side so the edges are interpolated too
+        nx, ny = -(-w // step) + 2, -(-h // step) + 2
+        gx = x0 + (np.arange(nx) - 1) * step + (step - 1) / 2
+        gy = y0 + (np.arange(ny) - 1) * step + (step - 1) / 2
+    grid = np.stack(np.meshgrid(gx, gy), axis=-1).reshape(-1, 2)
+    coords = mapping(grid).astype(np.float32).reshape(len(gy), len(gx), 2)
+    if step > 1:
+        coords = cv2.resize(coords, (nx * step, ny * step), interpolation=cv2.INTER_LINEAR)
+        coords = coords[step:step + h, step:step + w]
+    coords = np.ascontiguousarray(coords)
+    return cv2.convertMaps(coords, None, cv2.CV_16SC2)
+
+def cached_maps(model, ref_pts, trans_pts, region, grid_step=8):
+    key = (model, np.ascontiguousarray(ref_pts, dtype=np.float64).tobytes(),
+           np.ascontiguousarray(trans_pts, dtype=np.float64).tobytes(),
+           tuple(int(v) for v in region), int(grid_step))
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    # Threads warping with the same points (stack frames) wait for the first
+    # one to build the maps
+    with _build_lock:
+        with _cache_lock:
+            if key in _cache:
+                return _cache[key]
+        maps = remap_maps(model, ref_pts, trans_pts, region, grid_step)
+    with _cache_lock:
+        _cache[key] = maps
+        while len(_cache) > 1 and sum(m[0].nbytes + m[1].nbytes for m in _cache.values()) > CACHE_BYTES:
+            _cache.popitem(last=False)
+    return maps
+
+def clear_cache():
+    with _cache_lock:
+        _cache.clear()
+
+def remap(img, maps, border_value=0):
+    import cv2
+    from warp import channel_groups
+    with span('warp', out_size=list(maps[0].shape[1::-1]), **image_fields(img)):
+        groups = channel_groups(img)
+        if len(groups) == 1:
+            return cv2.remap(img, maps[0], maps[1], cv2.INTER_LINEAR,
+                             borderMode=cv2.BORDER_CONSTANT, borderValue=border_value)
+        out = np.empty(maps[0].shape[:2] + img.shape[2:], dtype=img.dtype)
+        for c in groups:
+            part = cv2.remap(np.ascontiguousarray(img[:, :, c]), maps[0], maps[1],
+                             cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT,
+                             borderValue=border_value)
+            out[:, :, c] = part.reshape(out[:, :, c].shape)
+        return out
+
+def warp_nonrigid(img, ref_pts, trans_pts, out_size, model='tps', c_pos=None, c_size=None,
+                  border_value=0, grid_step=8):
+    # Like warp_image (or warp_crop, given c_pos and c_size), out_size being
+    # (width, height). Parts of the crop outside of out_size are border_value
+    if c_pos is None or c_size is None:
+        region = (0, 0, out_size[0], out_size[1])
+        return remap(img, cached_maps(model, ref_pts, trans_pts, region, grid_step), border_value)
+
+    x0, y0 = int(c_pos[0]), int(c_pos[1])
+    w, h = int(c_size[0]), int(c_size[1])
+    out = np.full((h, w) + img.shape[2:], border_value, dtype=img.dtype)
+    src_x, src_y = max(x0, 0), max(y0, 0)
+    end_x, end_y = min(x0 + w, out_size[0]), min(y0 + h, out_size[1])
+    if end_x > src_x and end_y > src_y:
+        region = (src_x, src_y, end_x - src_x, end_y - src_y)
+        out[src_y - y0:end_y - y0, src_x - x0:end_x - x0] = \
+                remap(img, cached_maps(model, ref_pts, trans_pts, region, grid_step), border_value)
+    return out
@@ -0,0 +1,42 @@
+# Reading and writing of the points csv files
+
+import numpy as np
+import csv
+import logging
+from timing import span, file_bytes
+
+def read_csv(csv_fname):
+    # Returns [pts, c_pos, c_size], pts being the (2, n, 2) reference and image
+    # points with NaN for unset points (stored as (0, 0) in the csv)
+    logging.info(f'Loading points from {csv_fname}')
+    with span('load_csv', path=str(csv_fname), bytes=file_bytes(csv_fname)), \
+            open(csv_fname, mode='r') as csv_file:
+        rows = [row for row in csv.reader(csv_file, delimiter=',') if row]
+    c_pos = np.array(rows[0][:2], dtype=np.float64)
+    c_size = np.array(rows[0][2:4], dtype=np.float64)
+    values = np.array([row[:4] for row in rows[1:]], dtype=np.float64).reshape(-1, 4)
+    pts = np.stack([values[:, :2], values[:, 2:]])
+    pts[np.all(pts == 0, axis=2)] = np.nan
+    return [pts, c_pos, c_size]
+
+def write_csv(csv_fname, pts, c_pos, c_size, metrics=None):
+    # metrics (a metrics.Metrics of pts) adds its values after the crop and
+    # every matched point's residual after the point, read_csv ignores both
+    logging.info(f'Saving points to {csv_fname}')
+    matched = ~np.isnan(pts).any(axis=2).any(axis=0)
+    residuals = np.full(pts.shape[1], np.nan)
+    if metrics is not None and matched.sum() == len(metrics.residuals):
+        residuals[matched] = metrics.residuals
+    else:
+        metrics = None
+    # Unset points are written as (0, 0), like older versions did
+    pts = np.nan_to_num(pts, nan=0)
+    with span('save_csv', path=str(csv_fname)) as fields:
+        with open(csv_fname, mode='w') as csv_file:
+            csv_writer = csv.writer(csv_file, delimiter=',')
+            csv_writer.writerow([c_pos[0], c_pos[1], c_size[0], c_size[1]]
+                                + ([] if metrics is None else metrics.values()))
+            for pt in range(pts.shape[1]):
+                csv_writer.writerow([pts[0, pt, 0], pts[0, pt, 1], pts[1, pt, 0], pts[1, pt, 1]]
+                                    + ([] if metrics is None else [residuals[pt]]))
+        fields['bytes'] = file_bytes(csv_fname)
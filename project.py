@@ -0,0 +1,227 @@
+# Project files, holding the points, crop and solved matrix of many image pairs
+#
+# A project is a numpy .npz of flat columns, so that even large projects load
+# with a handful of array reads:
+#
+#   version           format version, FORMAT_VERSION
+#   reference_paths   (P,) str
+#   image_paths       (P,) str
+#   reference_hashes  (P,) str, file content hashes ('' if unknown)
+#   image_hashes      (P,) str
+#   offsets           (P + 1,) int64, pair i's points are points[offsets[i]:offsets[i + 1]]
+#   points            (N, 2, 2) float64, (point, reference/image, x/y)
+#   crops             (P, 4) float64, x, y, width, height
+#   matrices          (P, 3, 3) float64, taking the image onto the reference
+#   metrics           (P, 4) float64, metrics.FIELDS of the last alignment
+#   residuals         (N,) float64, of every point set in both images
+#
+# Any number of points per pair. Unset points, crops, matrices and metrics are
+# NaN, so a point at (0, 0) is a real point (unlike in the legacy points csvs,
+# which from_csv still imports). Version 1 projects have no metrics.
+
+import hashlib
+import logging
+from pathlib import Path
+
+import numpy as np
+
+from points import read_csv
+from metrics import FIELDS
+from transformations import overlapping_pts
+from timing import span, file_bytes
+
+FORMAT_VERSION = 2
+HASH_CHUNK = 1 << 22
+
+def file_hash(fname):
+    # Content hash, to notice images that changed after they were aligned
+    h = hashlib.blake2b(digest_size=20)
+    with open(fname, 'rb') as f:
+        while chunk := f.read(HASH_CHUNK):
+            h.update(chunk)
+    return h.hexdigest()
+
+def pair_points(pts):
+    # (2, N, 2) reference and image points (as read_csv returns them) ->
+    # (N, 2, 2) pairs, leaving out points set in neither image
+    points = np.array(pts, dtype=np.float64).transpose(1, 0, 2)
+    return points[~np.isnan(points).any(axis=2).all(axis=1)]
+
+class Project:
+    def __init__(self):
+        self.reference_paths = []
+        self.image_paths = []
+        self.reference_hashes = []
+        self.image_hashes = []
+        # Per pair points, None until first used for pairs read from a file,
+        # which are sliced out of _flat_points when needed
+        self._points = []
+        self._flat_points = None
+        self._offsets = None
+        # Same as _points, one residual per point
+        self._residuals = []
+        self._flat_residuals = None
+        self.crops = []
+        self.matrices = []
+        self.metrics = []
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def add_pair(self, reference_path, image_path, points=None, crop=None, matrix=None,
+                 metrics=None, hash_files=True):
+        # Returns the index of the new pair
+        self.reference_paths.append(str(reference_path))
+        self.image_paths.append(str(image_path))
+        self.reference_hashes.append('')
+        self.image_hashes.append('')
+        self._points.append(np.empty((0, 2, 2)))
+        self._residuals.append(np.empty(0))
+        self.crops.append(np.full(4, np.nan))
+        self.matrices.append(np.full((3, 3), np.nan))
+        self.metrics.append(np.full(len(FIELDS), np.nan))
+        i = len(self) - 1
+        self.update_pair(i, points, crop, matrix, metrics)
+        if hash_files:
+            self.hash_files(i)
+        return i
+
+    def update_pair(self, i, points=None, crop=None, matrix=None, metrics=None):
+        # Only the values given are changed, except that new points clear the
+        # metrics of the old ones. metrics is a metrics.Metrics of the pair's
+        # points set in both images, in order
+        if points is not None:
+            self._points[i] = np.array(points, dtype=np.float64).reshape(-1, 2, 2)
+            self._residuals[i] = np.full(len(self._points[i]), np.nan)
+            self.metrics[i] = np.full(len(FIELDS), np.nan)
+        if crop is not None:
+            self.crops[i] = np.array(crop, dtype=np.float64).reshape(4)
+        if matrix is not None:
+            self.matrices[i] = np.array(matrix, dtype=np.float64).reshape(3, 3)
+        if metrics is not None:
+            self.metrics[i] = np.array(metrics.values(), dtype=np.float64)
+            matched = ~np.isnan(self.points(i)).any(axis=(1, 2))
+            residuals = np.full(len(matched), np.nan)
+            if matched.sum() == len(metrics.residuals):
+                residuals[matched] = metrics.residuals
+            self._residuals[i] = residuals
+
+    def copy(self):
+        # Copy that update_pair and add_pair on this project don't change, for
+        # saving in the background
+        project = type(self)()
+        project.__dict__.update({name: list(value) if isinstance(value, list) else value
+                                 for name, value in self.__dict__.items()})
+        return project
+
+    def find(self, image_path):
+        # Index of the (last) pair for image_path, or None
+        image_path = str(image_path)
+        for i in reversed(range(len(self))):
+            if self.image_paths[i] == image_path:
+                return i
+        return None
+
+    def hash_files(self, i):
+        for paths, hashes in ((self.reference_paths, self.reference_hashes),
+                              (self.image_paths, self.image_hashes)):
+            hashes[i] = file_hash(paths[i]) if paths[i] and Path(paths[i]).is_file() else ''
+
+    def changed(self, i):
+        # Files of pair i whose contents no longer match their hash
+        changed = []
+        for paths, hashes in ((self.reference_paths, self.reference_hashes),
+                              (self.image_paths, self.image_hashes)):
+            if hashes[i] and (not Path(paths[i]).is_file() or file_hash(paths[i]) != hashes[i]):
+                changed.append(paths[i])
+        return changed
+
+    def crop(self, i):
+        # c_pos, c_size, or None, None if pair i has no crop
+        if np.isnan(self.crops[i]).any():
+            return None, None
+        return self.crops[i][:2], self.crops[i][2:]
+
+    def points(self, i):
+        # (N, 2, 2) points of pair i
+        if self._points[i] is None:
+            self._points[i] = self._flat_points[self._offsets[i]:self._offsets[i + 1]]
+        return self._points[i]
+
+    def residuals(self, i):
+        # (N,) residuals of pair i's points, NaN if unknown
+        if self._residuals[i] is None:
+            self._residuals[i] = self._flat_residuals[self._offsets[i]:self._offsets[i + 1]]
+        return self._residuals[i]
+
+    def matched_points(self, i):
+        # Reference and image points of the pairs set in both images
+        return overlapping_pts(self.points(i).transpose(1, 0, 2))
+
+    def points_and_crop(self, i):
+        # [pts, c_pos, c_size] as returned by read_csv
+        c_pos, c_size = self.crop(i)
+        return [self.points(i).transpose(1, 0, 2), c_pos, c_size]
+
+    def save(self, fname):
+        points = [self.points(i) for i in range(len(self))]
+        offsets = np.zeros(len(self) + 1, dtype=np.int64)
+        np.cumsum([len(p) for p in points], out=offsets[1:])
+        columns = {
+            'version': np.array(FORMAT_VERSION),
+            'reference_paths': np.array(self.reference_paths, dtype=str),
+            'image_paths': np.array(self.image_paths, dtype=str),
+            'reference_hashes': np.array(self.reference_hashes, dtype=str),
+            'image_hashes': np.array(self.image_hashes, dtype=str),
+            'offsets': offsets,
+            'points': np.concatenate(points) if points else np.empty((0, 2, 2)),
+            'crops': np.array(self.crops).reshape(-1, 4),
+            'matrices': np.array(self.matrices).reshape(-1, 3, 3),
+            'metrics': np.array(self.metrics).reshape(-1, len(FIELDS)),
+            'residuals': np.concatenate([self.residuals(i) for i in range(len(self))])
+                         if len(self) else np.empty(0),
+        }
+        with span('save_project', path=str(fname), pairs=len(self)) as fields:
+            # Written through a file object, so np.savez doesn't add .npz
+            with open(fname, 'wb') as f:
+                np.savez(f, **columns)
+            fields['bytes'] = file_bytes(fname)
+        logging.info(f'Saved project with {len(self)} pairs to {fname}')
+
+    @classmethod
+    def load(cls, fname):
+        with span('load_project', path=str(fname), bytes=file_bytes(fname)) as fields, \
+                np.load(fname, allow_pickle=False) as data:
+            version = int(data['version'])
+            if version > FORMAT_VERSION:
+                raise ValueError(f'{fname}: project version {version} is newer than '
+                                 f'the supported version {FORMAT_VERSION}')
+            project = cls()
+            project.reference_paths = data['reference_paths'].tolist()
+            project.image_paths = data['image_paths'].tolist()
+            project.reference_hashes = data['reference_hashes'].tolist()
+            project.image_hashes = data['image_hashes'].tolist()
+            project._flat_points = data['points']
+            project._offsets = data['offsets']
+            project._points = [None] * len(project)
+            project.crops = list(data['crops'])
+            project.matrices = list(data['matrices'])
+            if version >= 2:
+                project._flat_residuals = data['residuals']
+                project.metrics = list(data['metrics'])
+            else:
+                project._flat_residuals = np.full(len(project._flat_points), np.nan)
+                project.metrics = list(np.full((len(project), len(FIELDS)), np.nan))
+            project._residuals = [None] * len(project)
+            fields['pairs'] = len(project)
+        return project
+
+    @classmethod
+    def from_csv(cls, csv_fname, reference_path='', image_path='', hash_files=True):
+        # One pair project from a legacy points csv
+        [pts, c_pos, c_size] = read_csv(csv_fname)
+        project = cls()
+        crop = np.concatenate([c_pos, c_size]) if c_size.any() else None
+        project.add_pair(reference_path, image_path, pair_points(pts), crop,
+                         hash_files=hash_files)
+        return project
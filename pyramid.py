@@ -0,0 +1,82 @@
+# Multi-resolution image pyramid, used to display very large images without
+# handing the full resolution array to Qt
+
+import numpy as np
+
+def area_downsample(image, size):
+    # image shrunk to size (w, h), averaging the pixels
+    import cv2
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+def min_downsample(image, size):
+    # image (uint8) shrunk to size (w, h), every pixel the minimum of the
+    # pixels it covers. Thin zero lines, which averaging would fill in, are
+    # kept at every size
+    import cv2
+    h, w = image.shape[:2]
+    kernel = np.ones((int(np.ceil(h / size[1])), int(np.ceil(w / size[0]))), np.uint8)
+    image = cv2.erode(image, kernel, anchor=(0, 0), borderType=cv2.BORDER_REPLICATE)
+    rows = np.arange(size[1]) * h // size[1]
+    cols = np.arange(size[0]) * w // size[0]
+    return image[rows][:, cols]
+
+class ImagePyramid:
+    def __init__(self, image, min_size=256, preview_size=1024, reduce=None):
+        # levels[0] is the image itself, every next level is half the size,
+        # shrunk with reduce(level, (w, h)), by default area_downsample
+        self.image = image
+        self.levels = [image]
+        self.min_size = min_size
+        self.reduce = reduce or area_downsample
+        self.done = False
+        self.cancelled = False
+
+        # Strided view of the image to show while the pyramid is being built
+        # (it would skip over the lines a reduce like min_downsample keeps)
+        step = max(1, int(np.ceil(max(image.shape[:2]) / preview_size)))
+        if reduce is None:
+            self.preview = image[::step, ::step]
+        else:
+            self.preview = reduce(image, (-(-image.shape[1] // step), -(-image.shape[0] // step)))
+
+    def build(self, callback=None):
+        # Safe to run in a background thread, cv2 releases the GIL while
+        # resizing and levels are only ever appended
+        while max(self.levels[-1].shape[:2]) > self.min_size and not self.cancelled:
+            prev = self.levels[-1]
+            size = ((prev.shape[1] + 1) // 2, (prev.shape[0] + 1) // 2)
+            self.levels.append(self.reduce(prev, size))
+            if callback is not None:
+                callback(len(self.levels) - 1)
+        self.done = True
+        return self
+
+    def level_for(self, pixel_size):
+        # Finest level that still has at most one pixel per screen pixel,
+        # pixel_size being the number of image pixels per screen pixel
+        if pixel_size <= 1:
+            return 0
+        return int(np.floor(np.log2(pixel_size)))
+
+    def level_at_most(self, max_size):
+        # Finest level no larger than max_size, None if it isn't built yet
+        for level in self.levels:
+            if max(level.shape[:2]) <= max_size:
+                return level
+        return None
+
+    def scale(self, level_image):
+        # Full resolution pixels per pixel of a level (or of the preview)
+        return (self.image.shape[1] / level_image.shape[1],
+                self.image.shape[0] / level_image.shape[0])
+
+def downsample(image, max_size):
+    # Returns image shrunk so its longest side is at most max_size, and the
+    # (x, y) scale of the result relative to image
+    h, w = image.shape[:2]
+    scale = min(1, max_size / max(h, w))
+    if scale == 1:
+        return image, (1.0, 1.0)
+    size = (max(1, round(w * scale)), max(1, round(h * scale)))
+    small = area_downsample(image, size)
+    return small, (size[0] / w, size[1] / h)
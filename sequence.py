@@ -0,0 +1,128 @@
+# Image sequences, for aligning a series of images one after another
+#
+# Decoded images are kept in an LRU cache of at most cache_bytes, and the
+# next few pairs (and their points csvs) are loaded on a background thread, so
+# moving through the sequence doesn't wait on decoding. Entries are keyed by
+# the file's modification time too, so files saved since are read again.
+
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+from image_io import IMAGE_SUFFIXES
+import image_cache
+from points import read_csv
+
+@dataclass
+class Pair:
+    index: int
+    reference_path: str
+    image_path: str
+    points_path: str = None
+    reference: object = None
+    image: object = None
+    # [pts, c_pos, c_size] as returned by read_csv
+    points: list = None
+
+def points_path(image_path):
+    # Points are looked for next to the image, with the same name
+    csv_fname = Path(image_path).with_suffix('.csv')
+    return str(csv_fname) if csv_fname.exists() else None
+
+class ImageSequence:
+    def __init__(self, images, reference=None, cache_bytes=2 << 30, prefetch=2,
+                 loader=image_cache.read):
+        # images is a list of image paths, aligned one by one against
+        # reference (a single path, or one path per image, None for none)
+        self.images = [str(f) for f in images]
+        if reference is None or isinstance(reference, (str, Path)):
+            self.references = [None if reference is None else str(reference)] * len(self.images)
+        else:
+            self.references = [None if f is None else str(f) for f in reference]
+        if len(self.references) != len(self.images):
+            raise ValueError('Need one reference per image')
+
+        self.loader = loader
+        self.cache_bytes = cache_bytes
+        self.prefetch = prefetch
+        self.index = 0
+        self.cache = OrderedDict()
+        # Reentrant, done callbacks of finished futures run straight away
+        self.lock = threading.RLock()
+        self.executor = ThreadPoolExecutor(max_workers=2)
+
+    @classmethod
+    def from_folder(cls, folder, reference=None, **kwargs):
+        images = sorted(f for f in Path(folder).iterdir()
+                        if f.suffix.lower() in IMAGE_SUFFIXES
+                        and (reference is None or f.resolve() != Path(reference).resolve()))
+        return cls(images, reference, **kwargs)
+
+    def __len__(self):
+        return len(self.images)
+
+    def _future(self, fname, fn):
+        # Cached result of fn(fname) as a future
+        try:
+            stat = os.stat(fname)
+            key = (fn, fname, stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            # Missing, fn raises when the pair is shown
+            key = (fn, fname, None, None)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+            future = self.executor.submit(fn, fname)
+            self.cache[key] = future
+            future.add_done_callback(lambda f: self._evict())
+            return future
+
+    def _evict(self):
+        # Drops the least recently used entries (but never the newest) while
+        # the loaded images add up to more than cache_bytes
+        with self.lock:
+            sizes = [getattr(f.result(), 'nbytes', 0)
+                     if f.done() and not f.cancelled() and f.exception() is None else 0
+                     for f in self.cache.values()]
+            total = sum(sizes)
+            for size in sizes[:-1]:
+                if total <= self.cache_bytes:
+                    break
+                self.cache.popitem(last=False)
+                total -= size
+
+    def _futures(self, i):
+        futures = {'image': self._future(self.images[i], self.loader)}
+        if self.references[i] is not None:
+            futures['reference'] = self._future(self.references[i], self.loader)
+        csv_fname = points_path(self.images[i])
+        if csv_fname is not None:
+            futures['points'] = self._future(csv_fname, read_csv)
+        return futures, csv_fname
+
+    def get(self, i):
+        # Blocks until pair i is loaded, and starts loading the next ones
+        if not 0 <= i < len(self):
+            raise IndexError(f'No image {i} in a sequence of {len(self)}')
+        self.index = i
+        futures, csv_fname = self._futures(i)
+        for j in range(i + 1, min(i + 1 + self.prefetch, len(self))):
+            self._futures(j)
+
+        pair = Pair(i, self.references[i], self.images[i], csv_fname)
+        for name, future in futures.items():
+            setattr(pair, name, future.result())
+        return pair
+
+    def next(self):
+        return self.get(min(self.index + 1, len(self) - 1))
+
+    def previous(self):
+        return self.get(max(self.index - 1, 0))
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+# Local alignment server, so that everyone aligning on one machine shares a
+# bounded pool of worker processes instead of each decoding and warping on
+# their own
+#
+#   python server.py -j 8                       # on a unix socket
+#   python server.py --address localhost:8765   # or on localhost
+#
+# Clients (the gui, scripts, see Client) send one json line per connection:
+#
+#   {"op": "submit", "priority": 0, "job": {...}}
+#   {"op": "cancel", "id": 3}
+#   {"op": "status"}
+#
+# A submit gets a json line back for every event of its job, "queued" (with
+# the job id), "progress" (after each stage of batch.run_job), and finally
+# "done", with the output, the error (null if it worked), the stage timings
+# and the alignment metrics (see metrics.py), or "cancelled". Jobs with a
+# higher priority run first, jobs with the same priority in the order they
+# came in. A job is
+#
+#   reference, image   image paths (absolute, or relative to the server's
+#                      working directory)
+#   points             (2, N, 2) reference and image points as read_csv
+#                      returns them (null for unset points), or
+#   points_csv         the path of a points csv
+#   crop               [x, y, width, height], or null for the full image
+#   output             path of the aligned image
+#   model              'affine' (default) or one of nonrigid.MODELS
+#   cache              use the disk cache (see image_cache.py)
+#
+# The address is MANUALALIGN_SERVER (or --address), by default a unix socket
+# of the current user's. Jobs read and write files with the server's own
+# permissions, so only the server's user can connect to its socket, or with
+# --group the members of that group as well (run it as a user that can't
+# write anywhere else, for a group). TCP is only served on localhost, and
+# only to clients sending the server's token (MANUALALIGN_SERVER_TOKEN, which
+# unix socket servers check as well if it's set).
+# JobServer(address).start() runs an instance in the background of the
+# current process, for scripts and tests.
+
+import argparse
+import hmac
+import itertools
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from batch import Job, STAGES, run_job, init_worker
+from transformations import overlapping_pts
+
+if hasattr(socket, 'AF_UNIX'):
+    DEFAULT_ADDRESS = str(Path(tempfile.gettempdir()) / f'manualalign-{os.getuid()}.sock')
+else:
+    DEFAULT_ADDRESS = 'localhost:8765'
+DEFAULT_ADDRESS = os.environ.get('MANUALALIGN_SERVER', DEFAULT_ADDRESS)
+DEFAULT_TOKEN = os.environ.get('MANUALALIGN_SERVER_TOKEN') or None
+
+def parse_address(address):
+    # 'host:port' for tcp, anything else is a unix socket path
+    host, _, port = str(address).rpartition(':')
+    if host and port.isdigit():
+        return socket.AF_INET, (host, int(port))
+    return socket.AF_UNIX, str(address)
+
+def make_job(spec, job_id=0):
+    # batch.Job from a job's json
+    for key in ('reference', 'image', 'output'):
+        if key not in spec:
+            raise ValueError(f'Job is missing {key}')
+    crop = spec.get('crop')
+    if 'points_csv' in spec:
+        points = str(spec['points_csv'])
+    else:
+        pts = np.array(spec['points'], dtype=np.float64).reshape(2, -1, 2)
+        ref_pts, trans_pts = overlapping_pts(pts)
+        c_pos = None if crop is None else np.array(crop[:2], dtype=np.float64)
+        c_size = None if crop is None else np.array(crop[2:], dtype=np.float64)
+        points = (ref_pts, trans_pts, c_pos, c_size)
+    return Job(job_id, str(spec['reference']), str(spec['image']), points, str(spec['output']),
+               crop=crop is not None, model=spec.get('model', 'affine'),
+               cache=bool(spec.get('cache', False)))
+
+def job_spec(reference, image, pts, output, c_pos=None, c_size=None, model='affine', cache=False):
+    # A job's json, pts being (2, N, 2) with NaN for unset points
+    pts = np.asarray(pts, dtype=np.float64)
+    crop = None if c_pos is None or c_size is None else \
+        [float(v) for v in (*c_pos, *c_size)]
+    # Paths are made absolute, the server has its own working directory
+    return {'reference': os.path.abspath(reference), 'image': os.path.abspath(image),
+            'points': np.where(np.isnan(pts), None, pts).tolist(), 'crop': crop,
+            'output': None if output is None else os.path.abspath(output),
+            'model': model, 'cache': cache}
+
+def _ignore_interrupt():
+    # Ctrl+C is for the server, which shuts its workers down itself
+    import signal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def _init_worker():
+    _ignore_interrupt()
+    init_worker()
+
+def _run(job, events):
+    # In a worker process, events is a Manager queue back to the server. One
+    # strip thread per warp, the worker processes already use every core
+    progress = lambda stage: events.put((job.index, stage))
+    return run_job(job, progress, threads=1)
+
+def _set_permissions(path, group=None):
+    # Socket only usable by its owner, and group if given
+    if group is None:
+        os.chmod(path, 0o600)
+        return
+    import grp
+    os.chown(path, -1, grp.getgrnam(group).gr_gid)
+    os.chmod(path, 0o660)
+
+if hasattr(socket, 'AF_UNIX'):
+    class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class JobServer:
+    def __init__(self, address=DEFAULT_ADDRESS, workers=None, group=None, token=DEFAULT_TOKEN):
+        from multiprocessing.managers import SyncManager
+        self.address = address
+        self.workers = workers or os.cpu_count()
+        self.token = token
+        # (-priority, order, job id), only as many jobs as there are workers
+        # are handed to the pool, the rest wait here in priority order
+        self.queue = queue.PriorityQueue()
+        self.slots = threading.Semaphore(self.workers)
+        self.order = itertools.count()
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        # job id -> (job, queue of events for the client that submitted it)
+        self.jobs = {}
+        # job id -> queue of events, of jobs whose done event is on its way
+        self.finishing = {}
+        self.running = set()
+        self.cancelled = set()
+
+        family, addr = parse_address(address)
+        if family == socket.AF_UNIX:
+            if os.path.exists(addr):
+                os.remove(addr)
+            self.server = _UnixServer(addr, self.handler(), bind_and_activate=False)
+            self.server.server_bind()
+            # Set before listening, so no one else can connect in between
+            _set_permissions(addr, group)
+        else:
+            if addr[0] not in ('localhost', '127.0.0.1', '::1'):
+                raise ValueError(f'Only serving on localhost, not {addr[0]}')
+            if not token:
+                raise ValueError('Serving on tcp needs a token (MANUALALIGN_SERVER_TOKEN)')
+            self.server = _TCPServer(addr, self.handler(), bind_and_activate=False)
+            self.server.server_bind()
+        self.server.server_activate()
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker)
+        self.manager = SyncManager()
+        self.manager.start(_ignore_interrupt)
+        self.events = self.manager.Queue()
+        self.threads = [threading.Thread(target=self.dispatch, daemon=True),
+                        threading.Thread(target=self.forward, daemon=True)]
+
+    def handler(self):
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                def send(message):
+                    self.wfile.write((json.dumps(message) + '\n').encode())
+                    self.wfile.flush()
+                try:
+                    message = json.loads(self.rfile.readline())
+                    server.respond(message, send)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                except Exception as e:
+                    send({'event': 'error', 'message': f'{type(e).__name__}: {e}'})
+        return Handler
+
+    def respond(self, message, send):
+        if self.token is not None and \
+                not hmac.compare_digest(str(message.get('token', '')), self.token):
+            raise PermissionError('Wrong server token')
+        op = message.get('op')
+        if op == 'status':
+            send(self.status())
+        elif op == 'cancel':
+            send({'event': 'cancel', 'id': message['id'], 'ok': self.cancel(message['id'])})
+        elif op == 'submit':
+            job_id, events = self.submit(message['job'], message.get('priority', 0))
+            send({'event': 'queued', 'id': job_id})
+            while True:
+                event = events.get()
+                send(event)
+                if event['event'] in ('done', 'cancelled'):
+                    return
+        else:
+            raise ValueError(f'Unknown op {op}')
+
+    def submit(self, spec, priority=0):
+        # Returns the job id and the queue its events are put on
+        job_id = next(self.ids)
+        job = make_job(spec, job_id)
+        events = queue.Queue()
+        with self.lock:
+            self.jobs[job_id] = (job, events)
+        self.queue.put((-priority, next(self.order), job_id))
+        logging.info(f'Queued job {job_id} ({job.output}), priority {priority}')
+        return job_id, events
+
+    def cancel(self, job_id):
+        # Only jobs that haven't started can be cancelled
+        with self.lock:
+            if job_id not in self.jobs or job_id in self.running:
+                return False
+            self.cancelled.add(job_id)
+            return True
+
+    def status(self):
+        with self.lock:
+            return {'event': 'status', 'workers': self.workers, 'running': len(self.running),
+                    'queued': len(self.jobs) - len(self.running)}
+
+    def dispatch(self):
+        while True:
+            self.slots.acquire()
+            _, _, job_id = self.queue.get()
+            if job_id is None:
+                return
+            with self.lock:
+                job, events = self.jobs[job_id]
+                if job_id in self.cancelled:
+                    self.cancelled.discard(job_id)
+                    del self.jobs[job_id]
+                    self.slots.release()
+                    events.put({'event': 'cancelled', 'id': job_id})
+                    continue
+                self.running.add(job_id)
+            future = self.pool.submit(_run, job, self.events)
+            future.add_done_callback(lambda f, job_id=job_id: self.finished(job_id, f))
+
+    def finished(self, job_id, future):
+        with self.lock:
+            self.finishing[job_id] = self.jobs.pop(job_id)[1]
+            self.running.discard(job_id)
+        self.slots.release()
+        try:
+            r = future.result()
+            result = {'output': r.output, 'error': r.error, 'timings': r.timings,
+                      'metrics': r.metrics}
+        except Exception as e:
+            # The worker process died
+            result = {'output': None, 'error': f'{type(e).__name__}: {e}', 'timings': {},
+                      'metrics': {}}
+        logging.info(f'Job {job_id} done' + (f': {result["error"]}' if result['error'] else ''))
+        # Behind the worker's progress on the same queue, so the client gets
+        # all of it before done
+        self.events.put((job_id, {'event': 'done', 'id': job_id, **result}))
+
+    def forward(self):
+        # Progress from the workers (stage names) and done events to the
+        # clients
+        while True:
+            try:
+                job_id, event = self.events.get()
+            except (EOFError, OSError):
+                # The manager was shut down
+                return
+            if job_id is None:
+                return
+            done = isinstance(event, dict)
+            with self.lock:
+                entry = self.jobs.get(job_id)
+                events = entry[1] if entry is not None else self.finishing.get(job_id)
+                if done:
+                    self.finishing.pop(job_id, None)
+            if events is None:
+                continue
+            if done:
+                events.put(event)
+            elif event in STAGES:
+                events.put({'event': 'progress', 'id': job_id, 'stage': event,
+                            'fraction': (STAGES.index(event) + 1) / len(STAGES)})
+
+    def serve_forever(self):
+        for thread in self.threads:
+            thread.start()
+        logging.info(f'Serving on {self.address} with {self.workers} workers')
+        self.server.serve_forever()
+
+    def start(self):
+        # Serves on a background thread, for running a local instance
+        # alongside scripts (or tests)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.queue.put((float('-inf'), 0, None))
+        self.slots.release()
+        self.events.put((None, None))
+        self.pool.shutdown(wait=True)
+        self.manager.shutdown()
+        family, addr = parse_address(self.address)
+        if family == socket.AF_UNIX and os.path.exists(addr):
+            os.remove(addr)
+
+class Client:
+    def __init__(self, address=DEFAULT_ADDRESS, timeout=None, token=DEFAULT_TOKEN):
+        self.address = address
+        self.timeout = timeout
+        self.token = token
+
+    def request(self, message):
+        # Yields every json line the server sends back, raises RuntimeError
+        # on errors
+        if self.token is not None:
+            message = {**message, 'token': self.token}
+        family, addr = parse_address(self.address)
+        with socket.socket(family, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(addr)
+            sock.sendall((json.dumps(message) + '\n').encode())
+            with sock.makefile('r') as f:
+                for line in f:
+                    event = json.loads(line)
+                    if event['event'] == 'error':
+                        raise RuntimeError(event['message'])
+                    yield event
+
+    def available(self):
+        try:
+            self.status()
+        except (OSError, RuntimeError):
+            return False
+        return True
+
+    def status(self):
+        return next(self.request({'op': 'status'}))
+
+    def cancel(self, job_id):
+        return next(self.request({'op': 'cancel', 'id': job_id}))['ok']
+
+    def submit(self, spec, priority=0, progress=None):
+        # Runs a job (see job_spec), returns its "done" (or "cancelled")
+        # event. progress, if given, is called with the fraction done. If it
+        # raises (like workers.Task.progress, when cancelled) the job is
+        # cancelled if it hasn't started yet
+        job_id = None
+        for event in self.request({'op': 'submit', 'job': spec, 'priority': priority}):
+            if event['event'] == 'queued':
+                job_id = event['id']
+            elif event['event'] in ('done', 'cancelled'):
+                return event
+            if progress is not None:
+                try:
+                    progress(event.get('fraction', 0.0))
+                except BaseException:
+                    if job_id is not None:
+                        self.cancel(job_id)
+                    raise
+        raise ConnectionError('Server closed the connection')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve alignment jobs to local clients')
+    parser.add_argument('--address', default=DEFAULT_ADDRESS,
+                        help=f'unix socket path or host:port (default: {DEFAULT_ADDRESS})')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='number of worker processes (default: all cores)')
+    parser.add_argument('--group', help='let the members of this group use the unix socket')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    try:
+        server = JobServer(args.address, args.jobs, args.group)
+    except (ValueError, KeyError, OSError) as e:
+        parser.error(str(e))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,126 @@
+# Least squares point set registration, in numpy
+#
+# Everything takes either one point set, shape (N, 2), or a batch of point
+# sets, shape (B, N, 2), and solves the whole batch at once. The returned
+# 3x3 matrices map src points onto dst points.
+
+import numpy as np
+
+MIN_POINTS = {'similarity': 2, 'affine': 3, 'homography': 4}
+# Dimensions the points have to span, 1 for points that aren't all the same,
+# 2 for points that aren't all on one line
+MIN_RANK = {'similarity': 1, 'affine': 2, 'homography': 2}
+# Relative to the spread of the points along their widest direction
+RANK_TOLERANCE = 1e-6
+
+def apply_transform(M, pts):
+    pts = np.asarray(pts, dtype=np.float64)
+    ones = np.ones(pts.shape[:-1] + (1,))
+    mapped = np.concatenate([pts, ones], axis=-1) @ np.swapaxes(M, -1, -2)
+    return mapped[..., :2] / mapped[..., 2:]
+
+def residuals(M, src, dst):
+    return np.linalg.norm(apply_transform(M, src) - dst, axis=-1)
+
+def point_rank(pts):
+    # (B,) number of dimensions each point set spans
+    sv = np.linalg.svd(pts - pts.mean(axis=1, keepdims=True), compute_uv=False)
+    return np.sum(sv > RANK_TOLERANCE * np.maximum(sv[:, :1], np.finfo(float).tiny), axis=1)
+
+def _check_degenerate(src, dst, model):
+    # Raises ValueError for point sets the model can't be fit to, instead of
+    # a singular matrix (or NaNs) from the solver
+    problem = 'the same point' if MIN_RANK[model] == 1 else 'on one line'
+    for pts in ((src, dst) if model == 'homography' else (src,)):
+        bad = np.flatnonzero(point_rank(pts) < MIN_RANK[model])
+        if len(bad):
+            where = '' if len(pts) == 1 else f' in point set {bad[0]}'
+            raise ValueError(f'All points are {problem}{where}, {model} can\'t be fit to them')
+
+def _similarity(src, dst):
+    src_c = src.mean(axis=1, keepdims=True)
+    dst_c = dst.mean(axis=1, keepdims=True)
+    s = src - src_c
+    d = dst - dst_c
+    norm = np.sum(s ** 2, axis=(1, 2))
+    a = np.sum(s * d, axis=(1, 2)) / norm
+    b = np.sum(s[..., 0] * d[..., 1] - s[..., 1] * d[..., 0], axis=1) / norm
+
+    M = np.zeros((len(src), 3, 3))
+    M[:, 0, 0] = a
+    M[:, 0, 1] = -b
+    M[:, 1, 0] = b
+    M[:, 1, 1] = a
+    M[:, :2, 2] = dst_c[:, 0] - np.einsum('bij,bj->bi', M[:, :2, :2], src_c[:, 0])
+    M[:, 2, 2] = 1
+    return M
+
+def _affine(src, dst):
+    src_c = src.mean(axis=1, keepdims=True)
+    dst_c = dst.mean(axis=1, keepdims=True)
+    s = src - src_c
+    d = dst - dst_c
+    # Normal equations (S^T S) A^T = S^T D, one 2x2 system per point set
+    A = np.linalg.solve(s.swapaxes(1, 2) @ s, s.swapaxes(1, 2) @ d).swapaxes(1, 2)
+
+    M = np.zeros((len(src), 3, 3))
+    M[:, :2, :2] = A
+    M[:, :2, 2] = dst_c[:, 0] - np.einsum('bij,bj->bi', A, src_c[:, 0])
+    M[:, 2, 2] = 1
+    return M
+
+def _normalizing(pts):
+    # Hartley normalization, centroid at 0 and mean distance sqrt(2)
+    c = pts.mean(axis=1)
+    scale = np.sqrt(2) / np.mean(np.linalg.norm(pts - c[:, None], axis=-1), axis=1)
+    T = np.zeros((len(pts), 3, 3))
+    T[:, 0, 0] = scale
+    T[:, 1, 1] = scale
+    T[:, :2, 2] = -scale[:, None] * c
+    T[:, 2, 2] = 1
+    return T
+
+def _homography(src, dst):
+    T_src = _normalizing(src)
+    T_dst = _normalizing(dst)
+    s = apply_transform(T_src, src)
+    d = apply_transform(T_dst, dst)
+
+    # Direct linear transform, two rows per correspondence
+    B, N = s.shape[:2]
+    x, y = s[..., 0], s[..., 1]
+    u, v = d[..., 0], d[..., 1]
+    zero = np.zeros_like(x)
+    one = np.ones_like(x)
+    rows_x = np.stack([-x, -y, -one, zero, zero, zero, u * x, u * y, u], axis=-1)
+    rows_y = np.stack([zero, zero, zero, -x, -y, -one, v * x, v * y, v], axis=-1)
+    A = np.concatenate([rows_x, rows_y], axis=1)
+    H = np.linalg.svd(A)[2][:, -1].reshape(B, 3, 3)
+
+    M = np.linalg.inv(T_dst) @ H @ T_src
+    return M / M[:, 2:, 2:]
+
+_SOLVERS = {'similarity': _similarity, 'affine': _affine, 'homography': _homography}
+
+def solve_transform(src, dst, model='affine'):
+    # Returns the fitted matrices and the per point residuals (in pixels)
+    if model not in _SOLVERS:
+        raise ValueError(f'Unknown model {model}, expected one of {list(_SOLVERS)}')
+    src = np.asarray(src, dtype=np.float64)
+    dst = np.asarray(dst, dtype=np.float64)
+    if src.shape != dst.shape or src.shape[-1] != 2 or src.ndim not in (2, 3):
+        raise ValueError(f'Expected matching (N, 2) or (B, N, 2) point sets, '
+                         f'got {src.shape} and {dst.shape}')
+    if src.shape[-2] < MIN_POINTS[model]:
+        raise ValueError(f'{model} needs at least {MIN_POINTS[model]} points, '
+                         f'got {src.shape[-2]}')
+
+    single = src.ndim == 2
+    if single:
+        src, dst = src[None], dst[None]
+    _check_degenerate(src, dst, model)
+    M = _SOLVERS[model](src, dst)
+    res = residuals(M, src, dst)
+    if single:
+        return M[0], res[0]
+    return M, res
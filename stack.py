@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# Applies one alignment to every frame of a multi-page TIFF, a video or a
+# folder of images
+#
+# Frames are streamed through generators, read -> warp (and crop) -> write,
+# so only a few frames are ever in memory. Reading runs on its own thread
+# and warps on a thread pool, overlapping with the writes:
+#
+#   python stack.py stack.tif points.csv reference.tif aligned.tif
+
+import argparse
+import logging
+import queue
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from image_io import read_image, write_image, IMAGE_SUFFIXES
+from points import read_csv
+from transformations import overlapping_pts, estimate_transform, warp_image, warp_crop
+from nonrigid import warp_nonrigid, check_points, MIN_POINTS
+
+VIDEO_SUFFIXES = {'.avi', '.mp4', '.mov', '.mkv', '.wmv'}
+
+def iter_tiff(fname):
+    import tifffile
+    with tifffile.TiffFile(fname) as tif:
+        for page in tif.pages:
+            yield page.asarray()
+
+def iter_video(fname):
+    import cv2
+    capture = cv2.VideoCapture(str(fname))
+    if not capture.isOpened():
+        raise IOError(f'Could not open {fname}')
+    try:
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            # cv2 decodes to BGR
+            yield frame[:, :, ::-1] if frame.ndim == 3 else frame
+    finally:
+        capture.release()
+
+def iter_files(fnames):
+    # Full bit depth and channels, like every other image read
+    for fname in fnames:
+        yield read_image(fname)
+
+def iter_frames(source):
+    # source is a (multi-page) TIFF, a video, a folder of images or a list of
+    # image files
+    if isinstance(source, (list, tuple)):
+        return iter_files(source)
+    source = Path(source)
+    if source.is_dir():
+        return iter_files(sorted(f for f in source.iterdir() if f.suffix.lower() in IMAGE_SUFFIXES))
+    if source.suffix.lower() in ('.tif', '.tiff'):
+        return iter_tiff(source)
+    if source.suffix.lower() in VIDEO_SUFFIXES:
+        return iter_video(source)
+    return iter_files([source])
+
+def prefetch(iterable, size=2):
+    # Runs iterable on a background thread, at most size items ahead
+    items = queue.Queue(maxsize=size)
+    done = object()
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                while not stop.is_set():
+                    try:
+                        items.put((item, None), timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+        except Exception as e:
+            items.put((done, e))
+            return
+        items.put((done, None))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+
+def align_frames(frames, A, out_size, c_pos=None, c_size=None, threads=2, nonrigid=None):
+    # Warps (and crops, if c_pos and c_size are given) every frame with A, or
+    # with nonrigid, (model, ref_pts, trans_pts), keeping at most 2 * threads
+    # frames in flight, in order
+    def align(frame):
+        if nonrigid is not None:
+            # The maps are built for the first frame and cached for the rest
+            model, ref_pts, trans_pts = nonrigid
+            return warp_nonrigid(frame, ref_pts, trans_pts, out_size, model, c_pos, c_size)
+        if c_pos is not None and c_size is not None:
+            return warp_crop(frame, A, out_size, c_pos, c_size)
+        # Strips would fight the frame pool for the same cores
+        return warp_image(frame, A, out_size, threads=1 if threads > 1 else None)
+
+    if threads <= 1:
+        for frame in frames:
+            yield align(frame)
+        return
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        pending = deque()
+        for frame in frames:
+            pending.append(pool.submit(align, frame))
+            if len(pending) >= 2 * threads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def write_stack(frames, output, suffix='.tif'):
+    # Writes to a BigTIFF stack if output is a .tif/.tiff file, and one file
+    # per frame (named frame_00000<suffix>, ...) into the output folder
+    # otherwise. Returns the number of frames written
+    output = Path(output)
+    count = 0
+    if output.suffix.lower() in ('.tif', '.tiff'):
+        import tifffile
+        output.parent.mkdir(parents=True, exist_ok=True)
+        with tifffile.TiffWriter(output, bigtiff=True) as tif:
+            for frame in frames:
+                tif.write(frame, contiguous=True)
+                count += 1
+    else:
+        output.mkdir(parents=True, exist_ok=True)
+        for frame in frames:
+            write_image(output / f'frame_{count:05d}{suffix}', frame)
+            count += 1
+    return count
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Align every frame of a stack with one set of points')
+    parser.add_argument('source', help='multi-page TIFF, video or folder of images')
+    parser.add_argument('points', help='points csv saved from align.py')
+    parser.add_argument('reference', help='reference image (sets the output size)')
+    parser.add_argument('output', help='.tif for a BigTIFF stack, otherwise a folder of frames')
+    parser.add_argument('--no-crop', action='store_true',
+                        help='save full aligned frames instead of the csv crop')
+    parser.add_argument('--threads', type=int, default=2, help='frames warped at once (default: 2)')
+    parser.add_argument('--format', default='.tif', help='frame file format for folder output')
+    parser.add_argument('--model', default='affine', choices=['affine', 'tps', 'piecewise'],
+                        help='warp model (default: affine)')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    [pts, c_pos, c_size] = read_csv(args.points)
+    ref_pts, trans_pts = overlapping_pts(pts)
+    if len(ref_pts) < MIN_POINTS.get(args.model, 2):
+        print('Not enough valid points selected', file=sys.stderr)
+        return 1
+    # The matrix is solved once and shared by every frame
+    try:
+        A, _ = estimate_transform(ref_pts, trans_pts)
+        if args.model != 'affine':
+            check_points(args.model, ref_pts, trans_pts)
+    except ValueError as e:
+        print(f'Cannot align: {e}', file=sys.stderr)
+        return 1
+    nonrigid = None if args.model == 'affine' else (args.model, ref_pts, trans_pts)
+    out_size = read_image(args.reference).shape[1::-1]
+    if args.no_crop:
+        c_pos, c_size = None, None
+
+    t = time.perf_counter()
+    frames = prefetch(iter_frames(args.source))
+    aligned = align_frames(frames, A, out_size, c_pos, c_size, threads=args.threads,
+                           nonrigid=nonrigid)
+    count = write_stack(aligned, args.output, args.format)
+    print(f'Aligned {count} frames in {time.perf_counter() - t:.2f}s')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,19 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+# The modules are flat files at the top of the repo
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+@pytest.fixture
+def pts():
+    # (2, 6, 2) reference and image points, the third only set in the
+    # reference and the fifth in neither (NaN)
+    pts = np.array([[[10, 20], [300, 40], [150, 260], [40, 200], [0, 0], [280, 300]],
+                    [[12, 25], [305, 38], [0, 0], [41, 207], [0, 0], [275, 310]]],
+                   dtype=np.float64)
+    pts[1, 2] = np.nan
+    pts[:, 4] = np.nan
+    return pts
@@ -0,0 +1,24 @@
+import numpy as np
+
+from metrics import Metrics
+from points import read_csv, write_csv
+
+def test_round_trip(tmp_path, pts):
+    fname = tmp_path / 'points.csv'
+    write_csv(fname, pts, np.array([5.0, 6.0]), np.array([100.0, 80.0]))
+    read_pts, c_pos, c_size = read_csv(fname)
+    np.testing.assert_array_equal(read_pts, pts)
+    np.testing.assert_array_equal(c_pos, [5, 6])
+    np.testing.assert_array_equal(c_size, [100, 80])
+
+def test_round_trip_with_metrics(tmp_path, pts):
+    # The metrics and residual columns are left out on reading
+    fname = tmp_path / 'points.csv'
+    metrics = Metrics(residuals=np.array([0.5, 0.25, 1.0, 0.75]), rms=0.68, max_error=1.0,
+                      ncc=0.9, mi=1.2)
+    write_csv(fname, pts, np.array([5.0, 6.0]), np.array([100.0, 80.0]), metrics)
+    rows = fname.read_text().splitlines()
+    assert rows[0].split(',')[4:] == ['0.68', '1.0', '0.9', '1.2']
+    assert rows[1].split(',')[4] == '0.5' and rows[3].split(',')[4] == 'nan'
+    read_pts, c_pos, c_size = read_csv(fname)
+    np.testing.assert_array_equal(read_pts, pts)
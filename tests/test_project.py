@@ -0,0 +1,43 @@
+import numpy as np
+
+from metrics import Metrics, FIELDS
+from project import Project, pair_points
+
+def test_round_trip(tmp_path, pts):
+    fname = tmp_path / 'project.npz'
+    # A point at (0, 0) is a real point in a project
+    pts[:, 0] = 0
+    matrix = np.array([[1, 0, 2], [0, 1, -3], [0, 0, 1]], dtype=np.float64)
+    metrics = Metrics(residuals=np.arange(4) / 4, rms=0.4, max_error=0.75, ncc=0.9, mi=1.2)
+
+    project = Project()
+    project.add_pair('ref.tif', 'a.tif', pair_points(pts), [5, 6, 100, 80], matrix,
+                     hash_files=False)
+    project.update_pair(0, metrics=metrics)
+    # No points, crop or matrix
+    project.add_pair('ref.tif', 'b.tif', hash_files=False)
+    project.save(fname)
+
+    loaded = Project.load(fname)
+    assert loaded.reference_paths == ['ref.tif', 'ref.tif']
+    assert loaded.image_paths == ['a.tif', 'b.tif']
+    # Points set in neither image are left out, the rest keep their NaNs
+    kept = np.concatenate([np.arange(4), [5]])
+    np.testing.assert_array_equal(loaded.points(0), pts.transpose(1, 0, 2)[kept])
+    np.testing.assert_array_equal(loaded.points_and_crop(0)[0], pts[:, kept])
+    np.testing.assert_array_equal(loaded.residuals(0), [0, 0.25, np.nan, 0.5, 0.75])
+    np.testing.assert_array_equal(loaded.crops[0], [5, 6, 100, 80])
+    np.testing.assert_array_equal(loaded.matrices[0], matrix)
+    np.testing.assert_array_equal(loaded.metrics[0], metrics.values())
+
+    assert loaded.points(1).shape == (0, 2, 2)
+    assert loaded.crop(1) == (None, None)
+    assert np.isnan(loaded.matrices[1]).all()
+    assert np.isnan(loaded.metrics[1]).all() and len(loaded.metrics[1]) == len(FIELDS)
+
+def test_new_points_clear_metrics(pts):
+    project = Project()
+    project.add_pair('ref.tif', 'a.tif', pair_points(pts), hash_files=False)
+    project.update_pair(0, metrics=Metrics(residuals=np.ones(4), rms=1, max_error=1, ncc=1, mi=1))
+    project.update_pair(0, points=pair_points(pts))
+    assert np.isnan(project.metrics[0]).all() and np.isnan(project.residuals(0)).all()
@@ -0,0 +1,102 @@
+import grp
+import os
+import threading
+
+import numpy as np
+import pytest
+
+from image_io import read_image, write_image
+from server import JobServer, Client, job_spec
+
+@pytest.fixture
+def pair(tmp_path):
+    # A reference and the same image shifted by (5, 3)
+    rng = np.random.default_rng(0)
+    ref = (rng.random((120, 160)) * 255).astype(np.uint8)
+    img = np.roll(ref, (3, 5), axis=(0, 1))
+    write_image(str(tmp_path / 'ref.tif'), ref, 'tifffile')
+    write_image(str(tmp_path / 'img.tif'), img, 'tifffile')
+    pts = np.array([[[20, 20], [120, 30], [60, 90]],
+                    [[25, 23], [125, 33], [65, 93]]], dtype=np.float64)
+    return tmp_path, pts
+
+@pytest.fixture
+def server(tmp_path):
+    server = JobServer(str(tmp_path / 'server.sock'), workers=1, token=None).start()
+    yield server
+    server.shutdown()
+
+def test_submit(server, pair):
+    path, pts = pair
+    output = str(path / 'aligned.tif')
+    spec = job_spec(path / 'ref.tif', path / 'img.tif', pts, output)
+    fractions = []
+    event = Client(server.address, token=None).submit(spec, progress=fractions.append)
+    assert event['event'] == 'done' and event['error'] is None
+    assert event['output'] == output
+    assert event['metrics']['rms'] < 1e-6
+    assert read_image(output).shape == (120, 160)
+    # queued, then one event per stage
+    assert fractions == [0.0, 0.25, 0.5, 0.75, 1.0]
+
+def test_failed_job(server, pair):
+    path, pts = pair
+    spec = job_spec(path / 'missing.tif', path / 'img.tif', pts, str(path / 'aligned.tif'))
+    event = Client(server.address, token=None).submit(spec)
+    assert event['event'] == 'done' and 'missing.tif' in event['error']
+
+def test_cancel(pair):
+    path, pts = pair
+    server = JobServer(str(path / 'server.sock'), workers=1, token=None)
+    # With the only worker slot taken before the server starts, the job stays
+    # queued until it's released
+    server.slots.acquire()
+    server.start()
+    client = Client(server.address, token=None)
+    spec = job_spec(path / 'ref.tif', path / 'img.tif', pts, str(path / 'aligned.tif'))
+    events = []
+    thread = threading.Thread(target=lambda: events.append(client.submit(spec)))
+    thread.start()
+    for _ in range(100):
+        if client.status()['queued'] == 1:
+            break
+        threading.Event().wait(0.05)
+    assert client.cancel(1)
+    server.slots.release()
+    thread.join(10)
+    assert events and events[0]['event'] == 'cancelled'
+    assert not client.cancel(1)
+    assert not os.path.exists(path / 'aligned.tif')
+    server.shutdown()
+
+def test_shutdown(tmp_path):
+    address = str(tmp_path / 'server.sock')
+    server = JobServer(address, workers=1, token=None).start()
+    assert os.stat(address).st_mode & 0o777 == 0o600
+    assert Client(address, token=None).available()
+    server.shutdown()
+    assert not os.path.exists(address)
+    assert not Client(address, token=None).available()
+
+def test_group_socket(tmp_path):
+    address = str(tmp_path / 'server.sock')
+    group = grp.getgrgid(os.getgid()).gr_name
+    server = JobServer(address, workers=1, group=group, token=None).start()
+    try:
+        assert os.stat(address).st_mode & 0o777 == 0o660
+        assert os.stat(address).st_gid == os.getgid()
+    finally:
+        server.shutdown()
+
+def test_token():
+    with pytest.raises(ValueError):
+        JobServer('localhost:0', workers=1, token=None)
+    server = JobServer('localhost:0', workers=1, token='secret').start()
+    try:
+        address = f'localhost:{server.server.server_address[1]}'
+        assert Client(address, token='secret').status()['workers'] == 1
+        with pytest.raises(RuntimeError, match='token'):
+            Client(address, token='wrong').status()
+        assert not Client(address, token=None).available()
+    finally:
+        server.shutdown()
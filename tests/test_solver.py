@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from solver import solve_transform, apply_transform, point_rank
+
+SRC = np.array([[10, 20], [300, 40], [150, 260], [40, 200], [280, 300]], dtype=np.float64)
+
+# Known matrices of every model, taking SRC onto the reference
+SIMILARITY = np.array([[0.9, -0.3, 12.5],
+                       [0.3, 0.9, -7.25],
+                       [0, 0, 1]])
+AFFINE = np.array([[1.1, 0.2, -15],
+                   [-0.05, 0.85, 30],
+                   [0, 0, 1]])
+HOMOGRAPHY = np.array([[1.02, 0.05, 4],
+                       [-0.03, 0.97, -9],
+                       [2e-4, -1e-4, 1]])
+
+@pytest.mark.parametrize('model, M, n', [('similarity', SIMILARITY, 2),
+                                         ('similarity', SIMILARITY, 5),
+                                         ('affine', AFFINE, 3),
+                                         ('affine', AFFINE, 5),
+                                         ('homography', HOMOGRAPHY, 4),
+                                         ('homography', HOMOGRAPHY, 5)])
+def test_exact_recovery(model, M, n):
+    src = SRC[:n]
+    found, residuals = solve_transform(src, apply_transform(M, src), model=model)
+    np.testing.assert_allclose(found, M, rtol=1e-9, atol=1e-9)
+    assert residuals.shape == (n,) and residuals.max() < 1e-8
+
+def test_batch():
+    # Every point set of a batch is solved on its own
+    dst = np.stack([apply_transform(SIMILARITY, SRC), apply_transform(AFFINE, SRC)])
+    found, residuals = solve_transform(np.stack([SRC, SRC]), dst, model='affine')
+    np.testing.assert_allclose(found, [SIMILARITY, AFFINE], atol=1e-9)
+    assert residuals.shape == (2, len(SRC))
+
+@pytest.mark.parametrize('model', ['affine', 'homography'])
+def test_collinear_rejected(model):
+    src = np.array([[0, 0], [10, 10], [20, 20], [35, 35]], dtype=np.float64)
+    with pytest.raises(ValueError, match='one line'):
+        solve_transform(src, src + 5, model=model)
+
+def test_collinear_reference_rejected():
+    # A homography could map a proper image point set onto a line, but it
+    # isn't invertible then
+    dst = np.array([[0, 0], [10, 10], [20, 20], [35, 35]], dtype=np.float64)
+    with pytest.raises(ValueError, match='one line'):
+        solve_transform(SRC[:4], dst, model='homography')
+
+def test_coincident_rejected():
+    src = np.full((3, 2), 7.0)
+    with pytest.raises(ValueError, match='same point'):
+        solve_transform(src, src, model='similarity')
+
+def test_too_few_points():
+    with pytest.raises(ValueError, match='at least 4'):
+        solve_transform(SRC[:3], SRC[:3], model='homography')
+
+def test_point_rank():
+    line = np.array([[0, 0], [1, 2], [2, 4]], dtype=np.float64)
+    same = np.ones((3, 2))
+    assert point_rank(np.stack([SRC[:3], line, same])).tolist() == [2, 1, 0]
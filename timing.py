@@ -0,0 +1,123 @@
+# Timing of the load, solve, warp, overlay, crop and save stages
+#
+# Code to be timed runs inside of a span, which records how long it took along
+# with any fields given (image shape, bytes moved, ...). The last
+# MAX_SAMPLES durations of every stage are kept in memory for summary(), and
+# every span is written as one json line to the log, if one is open:
+#
+#   with span('warp', shape=img.shape) as fields:
+#       out = warp(...)
+#       fields['bytes'] = out.nbytes
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+
+import numpy as np
+
+# Durations kept per stage for the percentiles, the count and total cover
+# every span
+MAX_SAMPLES = 10000
+# The log is moved to fname.1 (fname.2, ...) once it's this big
+LOG_BYTES = 10 << 20
+LOG_BACKUPS = 1
+
+_lock = threading.Lock()
+_durations = defaultdict(lambda: deque(maxlen=MAX_SAMPLES))
+# {stage: [count, total seconds]}
+_totals = defaultdict(lambda: [0, 0.0])
+_log = None
+
+def open_log(fname, max_bytes=LOG_BYTES, backups=LOG_BACKUPS):
+    # Spans are appended to fname as json lines from now on, keeping at most
+    # backups full old logs besides it
+    global _log
+    handler = RotatingFileHandler(fname, maxBytes=max_bytes, backupCount=backups)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    with _lock:
+        if _log is not None:
+            _log.close()
+        _log = handler
+
+def close_log():
+    global _log
+    with _lock:
+        if _log is not None:
+            _log.close()
+            _log = None
+
+def record(stage, seconds, **fields):
+    entry = {'stage': stage, 'time': time.time(), 'seconds': seconds,
+             'thread': threading.current_thread().name, **fields}
+    with _lock:
+        _durations[stage].append(seconds)
+        _totals[stage][0] += 1
+        _totals[stage][1] += seconds
+        if _log is not None:
+            _log.handle(logging.makeLogRecord({'msg': json.dumps(entry, default=_to_json)}))
+
+def _to_json(value):
+    # numpy scalars and arrays, shapes are tuples and fine already
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return str(value)
+
+@contextmanager
+def span(stage, **fields):
+    # Yields fields, to add to while the span runs. Failed spans are recorded
+    # too, with the exception type as their error
+    t = time.perf_counter()
+    try:
+        yield fields
+    except BaseException as e:
+        fields['error'] = type(e).__name__
+        raise
+    finally:
+        record(stage, time.perf_counter() - t, **fields)
+
+def image_fields(image, prefix=''):
+    # Shape, dtype and size in bytes of an image, to pass on to a span
+    if image is None:
+        return {}
+    return {f'{prefix}shape': list(image.shape), f'{prefix}dtype': str(image.dtype),
+            f'{prefix}bytes': int(image.nbytes)}
+
+def file_bytes(fname):
+    try:
+        return os.path.getsize(fname)
+    except OSError:
+        return None
+
+def summary():
+    # {stage: {'count', 'total', 'p50', 'p95', 'max'}} in seconds, the
+    # percentiles and max of the last MAX_SAMPLES spans
+    with _lock:
+        durations = {stage: np.array(d) for stage, d in _durations.items()}
+        totals = {stage: tuple(t) for stage, t in _totals.items()}
+    return {stage: {'count': totals[stage][0], 'total': totals[stage][1],
+                    'p50': float(np.percentile(d, 50)), 'p95': float(np.percentile(d, 95)),
+                    'max': float(d.max())}
+            for stage, d in sorted(durations.items())}
+
+def format_summary():
+    lines = [f'{"stage":12s} {"count":>6s} {"p50 ms":>9s} {"p95 ms":>9s} {"max ms":>9s} {"total s":>8s}']
+    for stage, s in summary().items():
+        lines.append(f'{stage:12s} {s["count"]:6d} {1000 * s["p50"]:9.1f} {1000 * s["p95"]:9.1f} '
+                     f'{1000 * s["max"]:9.1f} {s["total"]:8.2f}')
+    return '\n'.join(lines)
+
+def reset():
+    with _lock:
+        _durations.clear()
+        _totals.clear()
+
+def log_summary():
+    if _durations:
+        logging.info('Timing summary\n' + format_summary())
@@ -1,52 +1,74 @@
 # A set of helper functions for align.py
 
+# cv2 and the solver are imported on first use, to keep the gui quick to start
+
 import numpy as np
-import cv2
-from pymicro.view.vol_utils import compute_affine_transform
+from timing import span, image_fields
 
-def transform_5pt(img, ref_pts, trans_pts, out_size):
-    translation, transformation = compute_affine_transform(ref_pts, trans_pts)
-    ref_centroid = np.mean(ref_pts, axis=0)
-    trans_centroid = np.mean(trans_pts, axis=0)
-    T = np.array([[1, 0, -trans_centroid[0]],
-                  [0, 1, -trans_centroid[1]],
-                  [0, 0, 1]], dtype=np.float32)
-    R = np.array([[1, 0, ref_centroid[0]],
-                  [0, 1, ref_centroid[1]],
-                  [0, 0, 1]], dtype=np.float32)
-    M = np.zeros((3,3), dtype=np.float32)
-    M[:-1,:-1] = transformation
-    M[2,2] = 1
-
-    A = np.dot(R, np.dot(M, T))
-
-    aligned = cv2.warpPerspective(img, A, out_size)
-    return aligned
+def estimate_transform(ref_pts, trans_pts):
+    # Similarity for 2 points, affine for more. Returns the matrix taking the
+    # image onto the reference and the per point residuals
+    from solver import solve_transform
+    model = 'similarity' if len(ref_pts) == 2 else 'affine'
+    with span('solve', model=model, points=len(ref_pts)):
+        return solve_transform(trans_pts, ref_pts, model=model)
 
-def transform_2pt(img, ref_pts, trans_pts, out_size):
-    r0 = np.sqrt((ref_pts[1,0] - ref_pts[0,0]) ** 2 + (ref_pts[1,1] - ref_pts[0,1]) ** 2)
-    r1 = np.sqrt((trans_pts[1,0] - trans_pts[0,0]) ** 2 + (trans_pts[1,1] - trans_pts[0,1]) ** 2)
-    scale = r0 / r1
+def warp_image(img, A, out_size, border_value=0, out=None, threads=None):
+    # See warp.warp, out can be a memory map (warp.open_output)
+    from warp import warp
+    with span('warp', out_size=list(out_size), **image_fields(img)):
+        return warp(img, A, out_size, border_value, out=out, threads=threads)
 
-    theta_0 = np.arccos((ref_pts[1, 0] - ref_pts[0, 0]) / r0) * (ref_pts[1, 1] - ref_pts[0, 1]) \
-                            / np.abs(ref_pts[1, 1] - ref_pts[0, 1])
-    theta_1 = np.arccos((trans_pts[1, 0] - trans_pts[0, 0]) / r1) * (trans_pts[1, 1] - trans_pts[0, 1]) \
-                            / np.abs(trans_pts[1, 1] - trans_pts[0, 1])
+def warp_crop(img, A, out_size, c_pos, c_size, border_value=0, threads=None):
+    # Same as crop_image(warp_image(img, A, out_size), c_pos, c_size), but
+    # only the rows of the crop inside of the out_size frame are warped and
+    # everything else is border_value
+    x0, y0 = int(c_pos[0]), int(c_pos[1])
+    w, h = int(c_size[0]), int(c_size[1])
+    out = np.full((h, w) + img.shape[2:], border_value, dtype=img.dtype)
 
-    dtheta = theta_0 - theta_1
+    src_x, src_y = max(x0, 0), max(y0, 0)
+    end_x, end_y = min(x0 + w, out_size[0]), min(y0 + h, out_size[1])
+    if end_x > src_x and end_y > src_y:
+        # From column 0, cv2 rounds its sub-pixel weights per column relative
+        # to the output origin, so moving that origin in x changes pixels (by
+        # up to a few grey levels on noisy images). Moving it in y doesn't
+        T = np.array([[1, 0, 0],
+                      [0, 1, -src_y],
+                      [0, 0, 1]], dtype=np.float64)
+        rows = warp_image(img, T @ A, (end_x, end_y - src_y), border_value, threads=threads)
+        out[src_y - y0:end_y - y0, src_x - x0:end_x - x0] = rows[:, src_x:]
+    return out
 
-    R = np.array([[np.cos(dtheta), -np.sin(dtheta), 0],
-                  [np.sin(dtheta), np.cos(dtheta), 0],
-                  [0,0,1]])
+def transform_5pt(img, ref_pts, trans_pts, out_size):
+    from solver import solve_transform
+    A, _ = solve_transform(trans_pts, ref_pts, model='affine')
+    return warp_image(img, A, out_size)
+
+def transform_2pt(img, ref_pts, trans_pts, out_size):
+    from solver import solve_transform
+    A, _ = solve_transform(trans_pts, ref_pts, model='similarity')
+    return warp_image(img, A, out_size)
 
-    # taking translation data from the first selected point pair
-    pt0 = np.dot(R[:-1,:-1], np.transpose(trans_pts[0,:]))
-    translate_x = ref_pts[0, 0] - scale * pt0[0]
-    translate_y = ref_pts[0, 1] - scale * pt0[1]
+def overlapping_pts(pts):
+    # Unset points are NaN, only pairs set in both images are used
+    selected_pts = ~np.isnan(pts).any(axis=2)
+    overlapping = np.logical_and(selected_pts[0], selected_pts[1])
+    return pts[0, overlapping], pts[1, overlapping]
 
-    M = np.array([[scale, 0, translate_x],
-                  [0, scale, translate_y],
-                  [0,0,1]])
+def crop_image(image, c_pos, c_size):
+    # Crops (x, y, width, height), parts of the crop outside of the image are
+    # filled in black
+    x0, y0 = int(c_pos[0]), int(c_pos[1])
+    w, h = int(c_size[0]), int(c_size[1])
+    if x0 >= 0 and y0 >= 0 and y0 + h <= image.shape[0] and x0 + w <= image.shape[1]:
+        return image[y0:y0 + h, x0:x0 + w]
 
-    aligned = cv2.warpPerspective(img, np.dot(M,R), out_size)
-    return aligned
+    with span('crop', **image_fields(image)) as fields:
+        matt = np.zeros((h, w) + image.shape[2:], dtype=image.dtype)
+        src_x, src_y = max(x0, 0), max(y0, 0)
+        end_x, end_y = min(x0 + w, image.shape[1]), min(y0 + h, image.shape[0])
+        if end_x > src_x and end_y > src_y:
+            matt[src_y - y0:end_y - y0, src_x - x0:end_x - x0] = image[src_y:end_y, src_x:end_x]
+        fields['bytes'] = matt.nbytes
+    return matt
@@ -0,0 +1,119 @@
+# Strip tiled warping engine
+#
+# The output is split into bands of rows that are warped on a thread pool
+# (OpenCV releases the GIL while warping) and written straight into one
+# preallocated output, which can be a memory map for outputs larger than RAM.
+
+import os
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+
+# cv2 warps at most this many channels at once
+MAX_CHANNELS = 4
+# Below this many output pixels the image is warped in one call
+MIN_PARALLEL_PIXELS = 1 << 20
+MIN_STRIP_ROWS = 64
+
+def default_threads():
+    return min(os.cpu_count() or 1, 8)
+
+# Number of warps running strips on threads, and cv2's thread count before
+# the first of them started
+_cv2_threads = {'users': 0, 'saved': None}
+_cv2_lock = threading.Lock()
+
+@contextmanager
+def cv2_single_threaded():
+    # cv2 splits every call over all cores itself, on top of the strip
+    # threads. Its thread count is process wide, so it's set back once the
+    # last of any concurrent warps is done
+    import cv2
+    with _cv2_lock:
+        if _cv2_threads['users'] == 0:
+            _cv2_threads['saved'] = cv2.getNumThreads()
+            cv2.setNumThreads(1)
+        _cv2_threads['users'] += 1
+    try:
+        yield
+    finally:
+        with _cv2_lock:
+            _cv2_threads['users'] -= 1
+            if _cv2_threads['users'] == 0:
+                cv2.setNumThreads(_cv2_threads['saved'])
+
+def is_affine(A):
+    return np.allclose(A[2], [0, 0, 1])
+
+def open_output(fname, shape, dtype):
+    # Memory mapped output, a (Big)TIFF for .tif/.tiff and .npy otherwise
+    if Path(fname).suffix.lower() in ('.tif', '.tiff'):
+        import tifffile
+        nbytes = np.prod(shape) * np.dtype(dtype).itemsize
+        return tifffile.memmap(fname, shape=shape, dtype=dtype, bigtiff=nbytes > 2**32 - 2**25)
+    return np.lib.format.open_memmap(fname, mode='w+', shape=shape, dtype=dtype)
+
+def channel_groups(img):
+    # Slices of at most MAX_CHANNELS channels covering img, all channels at
+    # once for images cv2 can handle in one pass
+    if img.ndim < 3 or img.shape[2] <= MAX_CHANNELS:
+        return [slice(None)]
+    return [slice(c, c + MAX_CHANNELS) for c in range(0, img.shape[2], MAX_CHANNELS)]
+
+def _warp_strip(img, A, out, y0, y1, border_value, affine):
+    import cv2
+    # Shift the output origin to the top of the strip
+    T = np.array([[1, 0, 0], [0, 1, -y0], [0, 0, 1]], dtype=np.float64) @ A
+    dst = out[y0:y1]
+    if not dst.flags.c_contiguous:
+        # Part of the channels of out, cv2 can't write there itself
+        dst = None
+    size = (out.shape[1], y1 - y0)
+    if affine:
+        res = cv2.warpAffine(img, T[:2], size, dst=dst, borderMode=cv2.BORDER_CONSTANT,
+                             borderValue=border_value)
+    else:
+        res = cv2.warpPerspective(img, T, size, dst=dst, borderMode=cv2.BORDER_CONSTANT,
+                                  borderValue=border_value)
+    if dst is None or not np.shares_memory(res, dst):
+        out[y0:y1] = res.reshape(out[y0:y1].shape)
+
+def warp(img, A, out_size, border_value=0, out=None, threads=None, strip_rows=None):
+    # out_size is (width, height) like cv2. out, if given, must have the
+    # output shape and img's dtype and is filled in place
+    A = np.asarray(A, dtype=np.float64)
+    shape = (out_size[1], out_size[0]) + img.shape[2:]
+    if out is None:
+        out = np.empty(shape, dtype=img.dtype)
+    elif out.shape != shape or out.dtype != img.dtype:
+        raise ValueError(f'Output should be {shape} {img.dtype}, got {out.shape} {out.dtype}')
+
+    groups = channel_groups(img)
+    if len(groups) > 1:
+        # Every group of channels is copied out of img once and warped on its
+        # own, not copied again for every strip
+        for c in groups:
+            warp(np.ascontiguousarray(img[:, :, c]), A, out_size, border_value, out=out[:, :, c],
+                 threads=threads, strip_rows=strip_rows)
+        return out
+
+    affine = is_affine(A)
+    threads = default_threads() if threads is None else threads
+    height = shape[0]
+    if threads <= 1 or shape[0] * shape[1] < MIN_PARALLEL_PIXELS:
+        strip_rows = height
+    elif strip_rows is None:
+        # A few strips per thread so uneven strips still balance out
+        strip_rows = max(MIN_STRIP_ROWS, int(np.ceil(height / (4 * threads))))
+    strips = [(y, min(y + strip_rows, height)) for y in range(0, height, strip_rows)]
+
+    if len(strips) == 1:
+        _warp_strip(img, A, out, 0, height, border_value, affine)
+        return out
+    with cv2_single_threaded(), ThreadPoolExecutor(max_workers=threads) as pool:
+        for f in [pool.submit(_warp_strip, img, A, out, y0, y1, border_value, affine)
+                  for y0, y1 in strips]:
+            f.result()
+    return out
@@ -0,0 +1,96 @@
+# Runs file io (and the warps that go with saving) on a thread pool, so the
+# gui never blocks. Results come back to the gui thread through Qt signals.
+
+import logging
+import traceback
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+
+class Cancelled(Exception):
+    pass
+
+class TaskSignals(QObject):
+    progress = pyqtSignal(float)
+    finished = pyqtSignal(object)
+    error = pyqtSignal(str)
+    cancelled = pyqtSignal()
+    done = pyqtSignal()
+
+class Task(QRunnable):
+    # If with_progress is set, fn gets task.progress as its `progress`
+    # keyword argument, to report progress and notice cancellation
+    def __init__(self, label, fn, *args, with_progress=False, **kwargs):
+        super(Task, self).__init__()
+        self.label = label
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        if with_progress:
+            self.kwargs['progress'] = self.progress
+        self.is_cancelled = False
+        self.signals = TaskSignals()
+
+    def cancel(self):
+        self.is_cancelled = True
+
+    def progress(self, fraction):
+        # Also the cancellation point for long running tasks
+        if self.is_cancelled:
+            raise Cancelled()
+        self.signals.progress.emit(fraction)
+
+    def run(self):
+        try:
+            if self.is_cancelled:
+                raise Cancelled()
+            result = self.fn(*self.args, **self.kwargs)
+            if self.is_cancelled:
+                raise Cancelled()
+        except Cancelled:
+            logging.info(f'{self.label}: cancelled')
+            self.signals.cancelled.emit()
+        except Exception as e:
+            logging.error(f'{self.label}: {traceback.format_exc()}')
+            self.signals.error.emit(f'{type(e).__name__}: {e}')
+        else:
+            self.signals.finished.emit(result)
+        self.signals.done.emit()
+
+class IOPool(QObject):
+    sigBusy = pyqtSignal(str)
+    sigProgress = pyqtSignal(float)
+    sigIdle = pyqtSignal()
+    sigError = pyqtSignal(str)
+
+    def __init__(self, threads=2):
+        super(IOPool, self).__init__()
+        self.pool = QThreadPool()
+        self.pool.setMaxThreadCount(threads)
+        self.tasks = []
+
+    def submit(self, label, fn, *args, finished=None, error=None, **kwargs):
+        task = Task(label, fn, *args, **kwargs)
+        if finished is not None:
+            task.signals.finished.connect(finished)
+        if error is not None:
+            task.signals.error.connect(error)
+        task.signals.error.connect(lambda message: self.sigError.emit(f'{label}: {message}'))
+        task.signals.progress.connect(self.sigProgress)
+        task.signals.done.connect(lambda: self.taskDone(task))
+        self.tasks.append(task)
+        self.sigBusy.emit(label)
+        self.pool.start(task)
+        return task
+
+    def taskDone(self, task):
+        self.tasks.remove(task)
+        if self.tasks:
+            self.sigBusy.emit(self.tasks[0].label)
+        else:
+            self.sigIdle.emit()
+
+    def cancelAll(self):
+        for task in self.tasks:
+            task.cancel()
+
+    def wait(self, msecs=-1):
+        return self.pool.waitForDone(msecs)